@@ -0,0 +1,391 @@
+import bisect
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from mariadb_connector import Alarm, AlarmTables, default_tables, get_active_alarms
+from events import Trigger
+from wind_estimator import AlarmInfo
+
+from log import get_logger, sampled
+
+logger = get_logger(__name__)
+
+
+def is_active(alarm: Alarm) -> bool:
+    return alarm.state == "active" and alarm.remain_scale > 0
+
+
+# widens the bisect window so float rounding at the threshold cannot drop an
+# alarm, the window is then checked with the same comparison as a full scan
+PRICE_EPSILON = 1e-9
+
+
+class PriceIndex:
+    """
+    Alarms sorted by price in one contiguous list, so the alarms deviating
+    at least `threshold` from a price are the two tails outside
+    [price - threshold, price + threshold] and are found by bisection.
+    Insert and removal are a bisection plus a memmove.
+    """
+
+    def __init__(self, alarms: Iterable[Alarm] = ()):
+        self._alarms: Dict[int, Alarm] = {alarm.id: alarm for alarm in alarms}
+        self._keys: List[Tuple[float, int]] = sorted(
+            (float(alarm.price), alarm.id) for alarm in self._alarms.values()
+        )
+
+    def add(self, alarm: Alarm):
+        self.remove(alarm.id)
+        self._alarms[alarm.id] = alarm
+        bisect.insort(self._keys, (float(alarm.price), alarm.id))
+
+    def remove(self, alarm_id: int):
+        alarm = self._alarms.pop(alarm_id, None)
+        if alarm is None:
+            return
+        key = (float(alarm.price), alarm_id)
+        index = bisect.bisect_left(self._keys, key)
+        if index < len(self._keys) and self._keys[index] == key:
+            del self._keys[index]
+
+    def outside(self, price: float, threshold: float) -> List[Tuple[Alarm, float]]:
+        """
+        Returns (alarm, price_delta) for every alarm with
+        abs(price - alarm.price) >= threshold, largest delta first.
+        """
+        low = bisect.bisect_right(
+            self._keys, (price - threshold + PRICE_EPSILON, float("inf"))
+        )
+        high = bisect.bisect_left(
+            self._keys, (price + threshold - PRICE_EPSILON, float("-inf"))
+        )
+        # the tails overlap for a threshold of (almost) zero
+        high = max(high, low)
+        # both tails as runs of decreasing delta, which sorted merges in O(n)
+        deltas = [(price - old_price, alarm_id) for old_price, alarm_id in self._keys[:low]]
+        deltas.extend(
+            (old_price - price, alarm_id)
+            for old_price, alarm_id in reversed(self._keys[high:])
+        )
+        deltas.sort(reverse=True)
+        return [
+            (self._alarms[alarm_id], price_delta)
+            for price_delta, alarm_id in deltas
+            if price_delta >= threshold
+        ]
+
+    def __len__(self):
+        return len(self._keys)
+
+
+# column name: (dtype, value of an empty row)
+ALARM_COLUMNS = {
+    "ids": (np.int64, 0),
+    "prices": (np.float64, 0.0),
+    "remain_scale": (np.int64, 0),
+    # wind scales from the on-chain metadata, -1 while unknown
+    "base_scale": (np.int64, -1),
+    "quote_scale": (np.int64, -1),
+}
+MIN_CAPACITY = 1024
+
+
+class AlarmColumns:
+    """
+    The fields that size a wind, as parallel NumPy columns with one row per
+    alarm, so the candidates of a price tick are sized with a few array
+    operations instead of a loop over Alarm objects. Rows are appended at
+    the end and removed by moving the last row into the gap, the columns
+    grow by doubling. Row order is arbitrary.
+
+    The wind scales of an alarm come from its metadata and are set with
+    `set_scales` once the metadata was fetched. Any change of the alarm
+    resets them, like it evicts the metadata from the WindEstimator cache.
+    """
+
+    def __init__(self, alarms: Iterable[Alarm] = ()):
+        alarms = list({alarm.id: alarm for alarm in alarms}.values())
+        self._rows: Dict[int, int] = {alarm.id: row for row, alarm in enumerate(alarms)}
+        self._size = len(alarms)
+        self._columns: Dict[str, np.ndarray] = {}
+        self._allocate(max(MIN_CAPACITY, 2 * self._size))
+        self._columns["ids"][: self._size] = [alarm.id for alarm in alarms]
+        self._columns["prices"][: self._size] = [float(alarm.price) for alarm in alarms]
+        self._columns["remain_scale"][: self._size] = [
+            alarm.remain_scale for alarm in alarms
+        ]
+
+    def _allocate(self, capacity: int):
+        columns = {}
+        for name, (dtype, empty) in ALARM_COLUMNS.items():
+            column = np.full(capacity, empty, dtype=dtype)
+            if name in self._columns:
+                column[: self._size] = self._columns[name][: self._size]
+            columns[name] = column
+        self._columns = columns
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self._columns["ids"][: self._size]
+
+    @property
+    def prices(self) -> np.ndarray:
+        return self._columns["prices"][: self._size]
+
+    @property
+    def remain_scale(self) -> np.ndarray:
+        return self._columns["remain_scale"][: self._size]
+
+    @property
+    def base_scale(self) -> np.ndarray:
+        return self._columns["base_scale"][: self._size]
+
+    @property
+    def quote_scale(self) -> np.ndarray:
+        return self._columns["quote_scale"][: self._size]
+
+    def __len__(self):
+        return self._size
+
+    def row(self, alarm_id: int) -> int:
+        """The row of an alarm, -1 if it is not in the columns."""
+        return self._rows.get(alarm_id, -1)
+
+    def add(self, alarm: Alarm):
+        row = self._rows.get(alarm.id)
+        if row is None:
+            if self._size == len(self._columns["ids"]):
+                self._allocate(2 * self._size)
+            row = self._size
+            self._size += 1
+            self._rows[alarm.id] = row
+        columns = self._columns
+        columns["ids"][row] = alarm.id
+        columns["prices"][row] = float(alarm.price)
+        columns["remain_scale"][row] = alarm.remain_scale
+        columns["base_scale"][row] = -1
+        columns["quote_scale"][row] = -1
+
+    def remove(self, alarm_id: int):
+        row = self._rows.pop(alarm_id, None)
+        if row is None:
+            return
+        last = self._size - 1
+        if row != last:
+            for column in self._columns.values():
+                column[row] = column[last]
+            self._rows[int(self._columns["ids"][row])] = row
+        for name, (_, empty) in ALARM_COLUMNS.items():
+            self._columns[name][last] = empty
+        self._size = last
+
+    def set_scales(self, alarm_id: int, base_scale: int, quote_scale: int):
+        row = self._rows.get(alarm_id)
+        if row is not None:
+            self._columns["base_scale"][row] = base_scale
+            self._columns["quote_scale"][row] = quote_scale
+
+    def max_buy_num(
+        self, rows: np.ndarray, new_price: float, base_asset: int, unit: int
+    ) -> np.ndarray:
+        """
+        The most units a wind at `new_price` can take from each of `rows`:
+        the alarm's scale for the direction of the price move, its remaining
+        units and what `base_asset` covers at one (price up) or three (price
+        down) `unit`s of base asset per unit, see WindEstimator.estimate.
+        The quote asset is left to the exact estimate. -1 for rows whose
+        scales are not known yet and -1 rows.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        max_buy_nums = np.full(len(rows), -1, dtype=np.int64)
+        known = np.flatnonzero(rows >= 0)
+        rows = rows[known]
+        up = new_price > self.prices[rows]
+        scales = np.where(up, self.base_scale[rows], self.quote_scale[rows])
+        sizes = np.minimum(scales, self.remain_scale[rows])
+        sizes = np.minimum(sizes, base_asset // np.where(up, unit, 3 * unit))
+        max_buy_nums[known] = np.where(scales >= 0, np.maximum(sizes, 0), -1)
+        return max_buy_nums
+
+
+class AlarmStore:
+    """
+    In-process index of the active alarms.
+
+    It is loaded from MariaDB once and then kept up to date by applying the
+    same alarm deltas the subscriber writes to the database, so readers never
+    have to re-scan the table. Deltas follow the upsert rules of
+    `update_alarm_to_db`: a known alarm only takes the new state and
+    remain_scale, an unknown alarm is inserted as is. Listeners are called
+    with every applied delta after the store was updated, and `trigger` is
+    notified.
+
+    Candidates are selected from the price indexes, the alarm columns only
+    size the selected ones and so only hold other people's alarms.
+    """
+
+    def __init__(
+        self,
+        tables: AlarmTables = default_tables,
+        trigger: Optional[Trigger] = None,
+    ):
+        self.tables = tables
+        self.trigger = trigger
+        self._lock = threading.Lock()
+        self._alarms: Dict[int, Alarm] = {}
+        self._snapshot: Optional[List[Alarm]] = None
+        # deltas applied before the store is loaded, replayed on top of it
+        self._pending: Optional[List[Alarm]] = []
+        self._listeners: List[Callable[[Alarm], None]] = []
+        # other people's alarms are wind candidates, ours are rung
+        self._others = PriceIndex()
+        self._mine = PriceIndex()
+        self._columns = AlarmColumns()
+        self.version = 0
+        self.loaded = False
+
+    def add_listener(self, listener: Callable[[Alarm], None]):
+        self._listeners.append(listener)
+
+    async def load(self, my_address: Optional[str] = None) -> bool:
+        # deltas that arrive while the table is being read are replayed on top,
+        # as are earlier ones the subscriber may not have flushed yet
+        with self._lock:
+            if self._pending is None:
+                self._pending = []
+        alarms = await get_active_alarms(my_address, self.tables)
+        if alarms is None:
+            return False
+        pending = self.reset(alarms)
+        logger.info(
+            "Loaded %d active alarms from %s, replayed %d",
+            len(alarms),
+            self.tables.alarms,
+            len(pending),
+        )
+        return True
+
+    def reset(self, alarms: List[Alarm]) -> List[Alarm]:
+        """
+        Loads `alarms` instead of the table, e.g. none for a backtest, and
+        returns the deltas replayed on top of them.
+        """
+        with self._lock:
+            pending, self._pending = self._pending or [], None
+            self._alarms = {alarm.id: alarm for alarm in alarms}
+            self._others = PriceIndex(alarm for alarm in alarms if not alarm.is_mine)
+            self._mine = PriceIndex(alarm for alarm in alarms if alarm.is_mine)
+            self._columns = AlarmColumns(alarm for alarm in alarms if not alarm.is_mine)
+            for alarm in pending:
+                self._apply(alarm)
+            self._changed()
+            self.loaded = True
+        return pending
+
+    def apply(self, alarms: List[Alarm]):
+        with self._lock:
+            for alarm in alarms:
+                self._apply(alarm)
+                if self._pending is not None:
+                    self._pending.append(alarm)
+            self._changed()
+        for listener in self._listeners:
+            for alarm in alarms:
+                try:
+                    listener(alarm)
+                except Exception as e:
+                    logger.error("Error in alarm listener %s", e, extra=sampled())
+        if self.trigger is not None:
+            self.trigger.notify("alarm")
+
+    def _apply(self, alarm: Alarm):
+        current = self._alarms.get(alarm.id)
+        if current is not None:
+            # never mutate an alarm that may be part of a handed out snapshot
+            alarm = Alarm(
+                id=current.id,
+                price=current.price,
+                created_at=current.created_at,
+                state=alarm.state,
+                is_mine=current.is_mine,
+                remain_scale=alarm.remain_scale,
+                watchmaker=current.watchmaker,
+            )
+        if is_active(alarm):
+            self._alarms[alarm.id] = alarm
+            if alarm.is_mine:
+                self._mine.add(alarm)
+            else:
+                self._others.add(alarm)
+                self._columns.add(alarm)
+        else:
+            self._alarms.pop(alarm.id, None)
+            (self._mine if alarm.is_mine else self._others).remove(alarm.id)
+            self._columns.remove(alarm.id)
+
+    def _changed(self):
+        self._snapshot = None
+        self.version += 1
+
+    def active_alarms(self) -> List[Alarm]:
+        """
+        Returns the active alarms. The list is only rebuilt after a change, so
+        polling it costs nothing while the alarm set is unchanged.
+        """
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = list(self._alarms.values())
+            return self._snapshot
+
+    def find_candidates(
+        self, new_price: float, threshold: float, shard: Tuple[int, int] = (0, 1)
+    ) -> Tuple[List[Tuple[Alarm, float]], List[int]]:
+        """
+        Same result as bot.find_candidates over all active alarms, but only
+        touches the alarms that deviate. Candidates come largest delta first.
+        Only candidates of the worker's `shard` are returned, our own
+        deviating alarms always are.
+        """
+        index, count = shard
+        with self._lock:
+            candidates = self._others.outside(new_price, threshold)
+            deviating_alarm_ids = [
+                alarm.id for alarm, _ in self._mine.outside(new_price, threshold)
+            ]
+        if count > 1:
+            candidates = [
+                candidate for candidate in candidates if candidate[0].id % count == index
+            ]
+        return candidates, deviating_alarm_ids
+
+    def on_alarm_info(self, alarm_id: int, alarm_info: AlarmInfo):
+        """Takes the wind scales from an alarm's freshly fetched metadata."""
+        metadata = alarm_info.metadata
+        with self._lock:
+            self._columns.set_scales(
+                alarm_id, metadata.base_asset_scale, metadata.quote_asset_scale
+            )
+
+    def max_buy_nums(
+        self, alarm_ids: Sequence[int], new_price: float, base_asset: int, unit: int
+    ) -> List[int]:
+        """
+        AlarmColumns.max_buy_num for the given candidates in one batch, -1
+        for alarms without known scales and for our own alarms.
+        """
+        with self._lock:
+            rows = np.fromiter(
+                (self._columns.row(alarm_id) for alarm_id in alarm_ids),
+                dtype=np.int64,
+                count=len(alarm_ids),
+            )
+            return self._columns.max_buy_num(rows, new_price, base_asset, unit).tolist()
+
+    def get(self, alarm_id: int) -> Optional[Alarm]:
+        with self._lock:
+            return self._alarms.get(alarm_id)
+
+    def __len__(self):
+        return len(self._alarms)
@@ -0,0 +1,192 @@
+import asyncio
+import os
+import time
+from typing import List, Optional
+
+from dotenv import load_dotenv
+from ticton import TicTonAsyncClient
+from ticton.arithmetic import FixedFloat
+from pytoncenter.address import Address as PyAddress
+from pytoncenter.v3.models import GetTransactionsRequest
+
+from mariadb_connector import (
+    Alarm,
+    AlarmTables,
+    default_tables,
+    get_active_alarms,
+    get_checkpoint,
+    get_latest_alarm_id,
+    update_alarm_to_db,
+)
+
+from log import get_logger, sampled
+
+load_dotenv()
+
+logger = get_logger(__name__)
+
+QPS = int(os.getenv("QPS", 9))
+# alarms fetched at once, rate_limiter keeps to QPS
+BACKFILL_CONCURRENCY = int(os.getenv("BACKFILL_CONCURRENCY", QPS))
+# alarms fetched and then written per transaction
+BACKFILL_BATCH_SIZE = 500
+# an alarm read is tried this often, waiting twice as long after each failure
+FETCH_RETRIES = 5
+FETCH_RETRY_INTERVAL = 1.0
+
+
+async def get_latest_lt(client: TicTonAsyncClient) -> Optional[int]:
+    latest_txs, _ = await client.toncenter.get_transactions(
+        GetTransactionsRequest(
+            account=client.oracle.to_string(),
+            limit=1,
+            sort="desc",
+        )
+    )
+    return latest_txs[0].lt if len(latest_txs) == 1 else None
+
+
+async def fetch_alarm(
+    client: TicTonAsyncClient,
+    semaphore: asyncio.Semaphore,
+    alarm_id: int,
+    my_address: str,
+) -> Alarm:
+    """Reads one alarm from the chain, retrying e.g. after a 429."""
+    retry_interval = FETCH_RETRY_INTERVAL
+    for _ in range(FETCH_RETRIES - 1):
+        try:
+            return await _fetch_alarm(client, semaphore, alarm_id, my_address)
+        except Exception as e:
+            logger.info(
+                "Retrying alarm %d in %.1fs %s",
+                alarm_id,
+                retry_interval,
+                e,
+                extra=sampled(),
+            )
+            # without holding the semaphore
+            await asyncio.sleep(retry_interval)
+            retry_interval *= 2
+    return await _fetch_alarm(client, semaphore, alarm_id, my_address)
+
+
+async def _fetch_alarm(
+    client: TicTonAsyncClient,
+    semaphore: asyncio.Semaphore,
+    alarm_id: int,
+    my_address: str,
+) -> Alarm:
+    async with semaphore:
+        alarm_address = await client.get_alarm_address(alarm_id)
+        alarm_state = await client.get_address_state(alarm_address)
+        if alarm_state != "active":
+            return Alarm(id=alarm_id, state="uninitialized", remain_scale=0)
+        metadata = await client.get_alarm_metadata(alarm_address)
+
+    price = await client._convert_fixedfloat_to_price(
+        FixedFloat(metadata.base_asset_price, skip_scale=True)
+    )
+    watchmaker = PyAddress(metadata.watchmaker_address).to_string(False)
+    return Alarm(
+        id=alarm_id,
+        price=round(price, 9),
+        created_at=metadata.created_at,
+        is_mine=watchmaker == my_address,
+        remain_scale=metadata.remain_scale,
+        watchmaker=watchmaker,
+    )
+
+
+async def backfill(
+    client: TicTonAsyncClient,
+    my_address: str,
+    tables: AlarmTables = default_tables,
+) -> int:
+    """
+    Brings the oracle's alarm `tables` up to date with the chain and returns
+    the lt the subscription has to continue from.
+
+    With a checkpoint, the subscription resumes from it and replays every
+    change to the known alarms since; only the alarms above the latest id in
+    the tables are read from the chain. Without one, the lt is taken before
+    any alarm is read, so every change after the snapshot is replayed by the
+    subscription; replaying a change that the snapshot already contains is
+    a no-op. That snapshot consists of the missing alarms and the alarms
+    the table believes to be active.
+
+    The alarms are read and written in batches in id order, concurrently
+    within a batch, so the tables have no gap below their latest id. A
+    backfill that fails part way keeps what it wrote, and the next one only
+    reads the alarms above it. Without a checkpoint that next one resumes
+    from the first one's lt, which is kept as `tables.backfill_checkpoint`
+    once the known alarms were refreshed. The lt is always written as the
+    checkpoint with the last batch, or alone, so other workers can follow
+    the tables once they are complete.
+    """
+    started = time.monotonic()
+    checkpoint = await get_checkpoint(tables.checkpoint)
+    if checkpoint is None:
+        # an earlier first backfill that did not finish
+        checkpoint = await get_checkpoint(tables.backfill_checkpoint)
+    # lt 0 replays from the oldest transaction
+    if checkpoint is not None:
+        handoff_lt = checkpoint
+    else:
+        handoff_lt = await get_latest_lt(client) or 0
+    await client.sync_oracle_metadata()
+    total_alarms = client.metadata.total_alarms
+
+    latest_alarm_id = await get_latest_alarm_id(tables)
+    if checkpoint is not None:
+        # the subscription replays what happened to them since the checkpoint
+        active_alarms = []
+    else:
+        active_alarms = await get_active_alarms(tables=tables)
+        if active_alarms is None:
+            raise Exception("active alarms could not be read")
+
+    first_missing_id = latest_alarm_id + 1 if latest_alarm_id else 0
+    alarm_ids = sorted(
+        {alarm.id for alarm in active_alarms}
+        | set(range(first_missing_id, total_alarms))
+    )
+    logger.info(
+        "Backfilling %d new and %d active alarms, resuming from lt %d",
+        total_alarms - first_missing_id,
+        len(active_alarms),
+        handoff_lt,
+    )
+
+    semaphore = asyncio.Semaphore(BACKFILL_CONCURRENCY)
+    for index in range(0, max(len(alarm_ids), 1), BACKFILL_BATCH_SIZE):
+        batch_ids = alarm_ids[index : index + BACKFILL_BATCH_SIZE]
+        alarms: List[Alarm] = []
+        for alarm in await asyncio.gather(
+            *[
+                fetch_alarm(client, semaphore, alarm_id, my_address)
+                for alarm_id in batch_ids
+            ],
+            return_exceptions=True,
+        ):
+            if isinstance(alarm, BaseException):
+                raise alarm
+            alarms.append(alarm)
+
+        if index + BACKFILL_BATCH_SIZE >= len(alarm_ids):
+            last_lt, name = handoff_lt, tables.checkpoint
+        elif checkpoint is None and batch_ids[-1] >= first_missing_id:
+            # the known alarms are refreshed, only missing ones follow
+            last_lt, name = handoff_lt, tables.backfill_checkpoint
+        else:
+            last_lt, name = None, None
+        if not await update_alarm_to_db(alarms, last_lt, tables, name):
+            raise Exception("alarms could not be written")
+
+    logger.info(
+        "Backfilled %d alarms up to lt %d in %.1fs",
+        len(alarm_ids),
+        handoff_lt,
+        time.monotonic() - started,
+    )
+    return handoff_lt
@@ -0,0 +1,271 @@
+import asyncio
+import os
+import threading
+import time
+from decimal import Decimal
+from functools import partial
+from typing import Dict, List, Optional, Tuple, Union
+
+from dotenv import load_dotenv
+from pytoncenter.address import Address as PyAddress
+from ticton import TicTonAsyncClient
+
+from events import Trigger
+from strategy import Balance
+
+from log import fields, get_logger
+
+load_dotenv()
+
+logger = get_logger(__name__)
+
+# read the wallet balance from the chain this often to correct the ledger
+BALANCE_RECONCILE_INTERVAL = float(os.getenv("BALANCE_RECONCILE_INTERVAL", 300))
+# a sent wind whose event did not show up within this time is assumed bounced
+BALANCE_HOLD_TIMEOUT = 300
+# seconds before a failed reconcile loop is started again
+RESTART_INTERVAL = 5
+
+
+# key of the base asset (TON) among the ledger's assets
+BASE_ASSET = "base"
+
+
+def quote_asset_key(client: TicTonAsyncClient) -> str:
+    return PyAddress(client.metadata.quote_asset_address).to_string(False)
+
+
+class Hold:
+    def __init__(
+        self,
+        base_asset: Decimal,
+        quote_asset: Decimal,
+        sent_at: float,
+        quote_asset_key: str = "",
+    ):
+        self.base_asset = base_asset
+        self.quote_asset = quote_asset
+        self.sent_at = sent_at
+        self.quote_asset_key = quote_asset_key
+        # read from the chain after the wind was sent, the read may contain it
+        self.base_asset_read = False
+        self.quote_asset_read = False
+
+    def __repr__(self):
+        return f"Hold({int(self.base_asset)}, {int(self.quote_asset)}, {self.sent_at})"
+
+
+class BalanceLedger:
+    """
+    Our wallet balance, tracked locally so an evaluation does not wait for a
+    chain read.
+
+    The ledger is seeded from the chain. Every wind we send reserves its
+    assets before it is sent and holds them until the subscriber sees our
+    wind on that alarm, which settles the hold into the balance. A hold
+    without an event is released after
+    BALANCE_HOLD_TIMEOUT, since the wind bounced. `run` reads the chain
+    again every BALANCE_RECONCILE_INTERVAL seconds. It reads sooner after
+    one of our alarms was rung or ticked, because the ledger does not know
+    those amounts. The balance errs on the low side: a settle that races a
+    chain read is applied again on top of it. A chain read is taken as the
+    balance for the winds sent before it, so their later settles do not
+    subtract them again. The read may have been taken before such a wind
+    landed though, so its assets stay held until a read that started after
+    the settle completes, and the settle asks for that read.
+
+    One ledger serves every oracle traded from the wallet: the base asset
+    is a single balance, quote assets are kept per jetton and holds per
+    oracle and alarm id. Every tracked client's quote asset is read on a
+    reconcile.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._assets: Dict[str, Decimal] = {BASE_ASSET: Decimal(0)}
+        self._holds: Dict[Tuple[str, int], List[Hold]] = {}
+        # settled while a chain read was in flight, re-applied on top of it
+        self._reads: List[Dict[str, Decimal]] = []
+        # (settled at, what an earlier read was taken to contain) of settled
+        # winds, held until a read newer than the settle completes
+        self._settled: List[Tuple[float, Hold]] = []
+        self._clients: Dict[str, TicTonAsyncClient] = {}
+        self._trigger = Trigger()
+        self._task: Optional[asyncio.Task] = None
+        self.seeded = False
+
+    def track(self, client: TicTonAsyncClient):
+        """Reads the quote asset of `client`'s oracle on every reconcile."""
+        self._clients.setdefault(quote_asset_key(client), client)
+
+    def reserve(
+        self,
+        client: TicTonAsyncClient,
+        alarm_id: int,
+        base_asset: Union[int, Decimal],
+        quote_asset: Union[int, Decimal],
+    ) -> Optional[Hold]:
+        """
+        Holds the assets of a wind about to be sent to `alarm_id` of
+        `client`'s oracle if the balance still covers them. Checked and held
+        at once, so oracles deciding on the same balance cannot spend it
+        twice. Returns None if the balance does not cover them.
+        """
+        quote_key = quote_asset_key(client)
+        hold = Hold(Decimal(base_asset), Decimal(quote_asset), time.monotonic(), quote_key)
+        key = (client.oracle.to_string(False), alarm_id)
+        with self._lock:
+            balance = self._balance(quote_key)
+            if balance.base_asset < hold.base_asset or balance.quote_asset < hold.quote_asset:
+                return None
+            self._holds.setdefault(key, []).append(hold)
+        return hold
+
+    def release(self, client: TicTonAsyncClient, alarm_id: int, hold: Hold):
+        """Drops the hold of a wind that was never sent."""
+        key = (client.oracle.to_string(False), alarm_id)
+        with self._lock:
+            holds = [held for held in self._holds.get(key, []) if held is not hold]
+            if holds:
+                self._holds[key] = holds
+            else:
+                self._holds.pop(key, None)
+
+    def settle(self, oracle: str, alarm_id: int):
+        """Our wind on `alarm_id` of `oracle` (a raw address) landed."""
+        with self._lock:
+            holds = self._holds.get((oracle, alarm_id))
+            if not holds:
+                logger.info("Wind on alarm %d was not held, reconciling", alarm_id)
+                self._trigger.notify("unknown_wind")
+                return
+            hold = holds.pop(0)
+            if not holds:
+                del self._holds[(oracle, alarm_id)]
+            spent = {}
+            if not hold.base_asset_read:
+                spent[BASE_ASSET] = hold.base_asset
+            if not hold.quote_asset_read:
+                spent[hold.quote_asset_key] = hold.quote_asset
+            for key, amount in spent.items():
+                self._assets[key] = self._assets.get(key, Decimal(0)) - amount
+                for settled in self._reads:
+                    settled[key] = settled.get(key, Decimal(0)) + amount
+            if len(spent) < 2:
+                # the last read may have been taken before the wind landed,
+                # hold what it was taken to contain until a newer read
+                if BASE_ASSET in spent:
+                    hold.base_asset = Decimal(0)
+                if hold.quote_asset_key in spent:
+                    hold.quote_asset = Decimal(0)
+                self._settled.append((time.monotonic(), hold))
+                self._trigger.notify("settled_after_read")
+
+    def refresh(self, reason: str):
+        """Asks for an early chain read, e.g. after our alarm was rung."""
+        self._trigger.notify(reason)
+
+    def _expire(self, now: float):
+        for key, holds in list(self._holds.items()):
+            holds = [hold for hold in holds if now - hold.sent_at <= BALANCE_HOLD_TIMEOUT]
+            if holds:
+                self._holds[key] = holds
+            else:
+                del self._holds[key]
+
+    def balance(self, client: TicTonAsyncClient) -> Balance:
+        """
+        The balance left for new winds on `client`'s oracle, a fresh Balance
+        for the strategy.
+        """
+        with self._lock:
+            return self._balance(quote_asset_key(client))
+
+    def _balance(self, quote_key: str) -> Balance:
+        self._expire(time.monotonic())
+        base_asset = self._assets[BASE_ASSET]
+        quote_asset = self._assets.get(quote_key, Decimal(0))
+        held = [hold for holds in self._holds.values() for hold in holds]
+        held.extend(hold for _, hold in self._settled)
+        for hold in held:
+            base_asset -= hold.base_asset
+            if hold.quote_asset_key == quote_key:
+                quote_asset -= hold.quote_asset
+        return Balance(max(base_asset, Decimal(0)), max(quote_asset, Decimal(0)))
+
+    async def reconcile(self, client: TicTonAsyncClient, owner_address: str) -> bool:
+        self.track(client)
+        quote_key = quote_asset_key(client)
+        settled: Dict[str, Decimal] = {}
+        with self._lock:
+            self._reads.append(settled)
+        read_started = time.monotonic()
+        try:
+            base_asset, quote_asset = await client._get_user_balance(owner_address)
+        except Exception as e:
+            logger.error("Error in balance reconcile %s", e)
+            return False
+        finally:
+            with self._lock:
+                self._reads = [read for read in self._reads if read is not settled]
+        with self._lock:
+            base_asset = Decimal(base_asset) - settled.get(BASE_ASSET, Decimal(0))
+            quote_asset = Decimal(quote_asset) - settled.get(quote_key, Decimal(0))
+            if self.seeded and quote_key in self._assets:
+                logger.info(
+                    "Reconciled balance",
+                    extra=fields(
+                        base_asset_drift=int(base_asset - self._assets[BASE_ASSET]),
+                        quote_asset_drift=int(quote_asset - self._assets[quote_key]),
+                    ),
+                )
+            self._assets[BASE_ASSET] = base_asset
+            self._assets[quote_key] = quote_asset
+            self.seeded = True
+            # the read is the balance now, the settles of these must not
+            # subtract what it may already contain
+            for holds in self._holds.values():
+                for hold in holds:
+                    if hold.sent_at < read_started:
+                        hold.base_asset_read = True
+                        if hold.quote_asset_key == quote_key:
+                            hold.quote_asset_read = True
+            # and it contains the winds settled before it started
+            settled = []
+            for settled_at, hold in self._settled:
+                if settled_at < read_started:
+                    hold.base_asset = Decimal(0)
+                    if hold.quote_asset_key == quote_key:
+                        hold.quote_asset = Decimal(0)
+                if hold.base_asset or hold.quote_asset:
+                    settled.append((settled_at, hold))
+            self._settled = settled
+        return True
+
+    async def run(self, owner_address: str):
+        """Reconciles with the chain in the background until cancelled."""
+        self._trigger.bind()
+        while True:
+            reasons = await self._trigger.wait(max_staleness=BALANCE_RECONCILE_INTERVAL)
+            logger.info("Reconciling balance", extra=fields(reasons=sorted(reasons)))
+            for client in list(self._clients.values()):
+                await self.reconcile(client, owner_address)
+
+    def start(self, owner_address: str) -> asyncio.Task:
+        """
+        Starts `run` once, however many oracles share the ledger. If it
+        fails it is started again after RESTART_INTERVAL.
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run(owner_address))
+            self._task.add_done_callback(partial(self._restart, owner_address))
+        return self._task
+
+    def _restart(self, owner_address: str, task: asyncio.Task):
+        if task.cancelled():
+            return
+        logger.error("Error in balance reconciliation, restarting %s", task.exception())
+        asyncio.get_running_loop().call_later(RESTART_INTERVAL, self.start, owner_address)
+
+
+balance_ledger = BalanceLedger()
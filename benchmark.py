@@ -0,0 +1,357 @@
+"""
+Offline microbenchmarks of the decision path in bot.main.
+
+Every stage runs on synthetic alarm sets against FakeTicTonClient and is
+reported with its p50/p99 latency per round and its throughput in alarms
+per second. Results can be saved as a baseline, and a later run against
+that baseline flags every stage whose p50 got slower than the tolerance
+and exits with status 1.
+
+    python benchmark.py --sizes 100,1000,10000,100000 --save-baseline bench.json
+    python benchmark.py --baseline bench.json
+
+The MariaDB stages write synthetic alarms and only run with --db, point
+MYSQL_DATABASE at a scratch database for them.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import random
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from alarm_store import AlarmColumns, PriceIndex
+from fake_client import FakeTicTonClient, fake_address
+from mariadb_connector import Alarm
+
+# the log lines of the decision path would dominate the measurements
+logging.disable(logging.INFO)
+
+from bot import THRESHOLD_PRICE, check_balance, find_candidates, screen_alarms
+from strategy import Balance, ProfitableAlarm, greedy_strategy, knapsack_strategy
+from wind_estimator import WindEstimator
+
+DEFAULT_SIZES = "100,1000,10000,100000"
+MARKET_PRICE = 2.5
+# the first alarm id of the synthetic alarms written with --db
+DB_ALARM_ID_OFFSET = 2 * 10**9
+# candidate prices screened at once by alarm_columns_multi
+MULTI_PRICES = 8
+
+
+def percentile(samples: List[float], q: float) -> float:
+    samples = sorted(samples)
+    return samples[max(math.ceil(q * len(samples)) - 1, 0)]
+
+
+class StageResult:
+    def __init__(self, stage: str, size: int, samples: List[float]):
+        self.stage = stage
+        self.size = size
+        self.rounds = len(samples)
+        self.p50 = percentile(samples, 0.5)
+        self.p99 = percentile(samples, 0.99)
+
+    @property
+    def key(self) -> str:
+        return f"{self.stage}@{self.size}"
+
+    @property
+    def throughput(self) -> float:
+        return self.size / self.p50 if self.p50 > 0 else float("inf")
+
+    def __repr__(self):
+        return f"StageResult({self.key}, p50={self.p50}, p99={self.p99})"
+
+
+async def measure(
+    stage: str,
+    size: int,
+    rounds: int,
+    run: Callable[[], Awaitable[None]],
+    setup: Optional[Callable[[], Awaitable[None]]] = None,
+) -> StageResult:
+    samples = []
+    for _ in range(rounds):
+        if setup is not None:
+            await setup()
+        started = time.perf_counter()
+        await run()
+        samples.append(time.perf_counter() - started)
+    return StageResult(stage, size, samples)
+
+
+def outside_rows(
+    columns: AlarmColumns, price: float, threshold: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The vectorized counterpart of PriceIndex.outside as a full scan: the
+    rows with abs(price - alarm.price) >= threshold and their deltas, in
+    the same order.
+    """
+    deltas = np.abs(price - columns.prices)
+    rows = np.flatnonzero(deltas >= threshold)
+    deltas = deltas[rows]
+    order = np.lexsort((columns.ids[rows], deltas))[::-1]
+    return rows[order], deltas[order]
+
+
+def deviating(columns: AlarmColumns, prices: Sequence[float], threshold: float) -> np.ndarray:
+    """
+    Screens several candidate prices at once: a (len(prices), len(columns))
+    mask of the alarms deviating at least `threshold` from each price.
+    """
+    prices = np.asarray(prices, dtype=np.float64)[:, np.newaxis]
+    return np.abs(prices - columns.prices) >= threshold
+
+
+def make_alarms(client: FakeTicTonClient, size: int, seed: int) -> List[Alarm]:
+    """
+    Alarms quoted around MARKET_PRICE, about a third of them deviate more
+    than THRESHOLD_PRICE and a tenth are ours.
+    """
+    rng = random.Random(seed)
+    spread = float(THRESHOLD_PRICE) * 1.5
+    alarms = []
+    for alarm_id in range(size):
+        price = round(MARKET_PRICE + rng.uniform(-spread, spread), 9)
+        remain_scale = rng.randint(1, 10)
+        is_mine = rng.random() < 0.1
+        client.add_alarm(
+            alarm_id,
+            price,
+            remain_scale,
+            watchmaker=fake_address(4 if is_mine else 3),
+        )
+        alarms.append(
+            Alarm(
+                id=alarm_id,
+                price=price,
+                is_mine=is_mine,
+                remain_scale=remain_scale,
+            )
+        )
+    return alarms
+
+
+async def bench_size(size: int, rounds: int, seed: int, db: bool) -> List[StageResult]:
+    client = FakeTicTonClient()
+    alarms = make_alarms(client, size, seed)
+    new_price_raw = int((await client._convert_price(MARKET_PRICE)).raw_value)
+    base_asset, quote_asset = client.balance
+    results = []
+
+    candidates: List = []
+
+    async def run_find_candidates():
+        nonlocal candidates
+        candidates, _ = find_candidates(alarms, MARKET_PRICE)
+
+    results.append(await measure("find_candidates", size, rounds, run_find_candidates))
+
+    index = PriceIndex(alarm for alarm in alarms if not alarm.is_mine)
+
+    async def run_price_index():
+        index.outside(MARKET_PRICE, float(THRESHOLD_PRICE))
+
+    results.append(await measure("price_index", size, rounds, run_price_index))
+
+    columns = AlarmColumns(alarm for alarm in alarms if not alarm.is_mine)
+
+    async def run_alarm_columns():
+        outside_rows(columns, MARKET_PRICE, float(THRESHOLD_PRICE))
+
+    results.append(await measure("alarm_columns", size, rounds, run_alarm_columns))
+
+    prices = [MARKET_PRICE + 0.01 * i for i in range(MULTI_PRICES)]
+
+    async def run_alarm_columns_multi():
+        deviating(columns, prices, float(THRESHOLD_PRICE))
+
+    results.append(
+        await measure("alarm_columns_multi", size, rounds, run_alarm_columns_multi)
+    )
+
+    estimator = WindEstimator(client)
+    profitable_alarms: List[ProfitableAlarm] = []
+
+    async def run_screen_alarms():
+        nonlocal profitable_alarms
+        profitable_alarms = [
+            profitable_alarm
+            async for profitable_alarm in screen_alarms(
+                estimator, candidates, new_price_raw, Balance(base_asset, quote_asset)
+            )
+        ]
+
+    async def clear_cache():
+        estimator.cache.clear()
+
+    results.append(
+        await measure(
+            "screen_alarms_cold", size, rounds, run_screen_alarms, clear_cache
+        )
+    )
+    results.append(await measure("screen_alarms_warm", size, rounds, run_screen_alarms))
+
+    for alarm_id, alarm_info in estimator.cache.items():
+        columns.set_scales(
+            alarm_id,
+            alarm_info.metadata.base_asset_scale,
+            alarm_info.metadata.quote_asset_scale,
+        )
+    unit = client.metadata.min_base_asset_threshold
+    max_buy_nums: List[int] = []
+
+    async def run_max_buy_nums():
+        nonlocal max_buy_nums
+        rows = [columns.row(alarm.id) for alarm, _ in candidates]
+        max_buy_nums = columns.max_buy_num(
+            rows, MARKET_PRICE, int(base_asset), unit
+        ).tolist()
+
+    results.append(await measure("max_buy_nums", size, rounds, run_max_buy_nums))
+
+    async def run_screen_alarms_sized():
+        async for _ in screen_alarms(
+            estimator,
+            candidates,
+            new_price_raw,
+            Balance(base_asset, quote_asset),
+            max_buy_nums,
+        ):
+            pass
+
+    results.append(
+        await measure("screen_alarms_sized", size, rounds, run_screen_alarms_sized)
+    )
+
+    need_assets = [
+        estimator.estimate(estimator.cache[alarm.id], new_price_raw, 1)[1]
+        for alarm, _ in candidates
+    ]
+
+    async def run_check_balance():
+        balance = Balance(base_asset, quote_asset)
+        for need_base_asset, need_quote_asset in need_assets:
+            await check_balance(balance, need_base_asset, need_quote_asset, 10)
+
+    results.append(await measure("check_balance", size, rounds, run_check_balance))
+
+    for name, strategy in [
+        ("greedy_strategy", greedy_strategy),
+        ("knapsack_strategy", knapsack_strategy),
+    ]:
+
+        async def run_strategy(strategy=strategy):
+            async for _ in strategy(profitable_alarms, Balance(base_asset, quote_asset)):
+                pass
+
+        results.append(await measure(name, size, rounds, run_strategy))
+
+    if db:
+        results.extend(await bench_db(alarms, rounds))
+    return results
+
+
+async def bench_db(alarms: List[Alarm], rounds: int) -> List[StageResult]:
+    from mariadb_connector import get_alarms_in_range, init, update_alarm_to_db
+
+    await init()
+    size = len(alarms)
+    db_alarms = [
+        Alarm(
+            id=DB_ALARM_ID_OFFSET + alarm.id,
+            price=alarm.price,
+            is_mine=alarm.is_mine,
+            remain_scale=alarm.remain_scale,
+        )
+        for alarm in alarms
+    ]
+    last_id = DB_ALARM_ID_OFFSET + size - 1
+
+    async def run_update():
+        assert await update_alarm_to_db(db_alarms), "update_alarm_to_db failed"
+
+    async def run_get():
+        result = await get_alarms_in_range(DB_ALARM_ID_OFFSET, last_id)
+        assert result is not None, "get_alarms_in_range failed"
+
+    return [
+        await measure("db_update_alarm", size, rounds, run_update),
+        await measure("db_get_alarm", size, rounds, run_get),
+    ]
+
+
+def rounds_for(size: int, rounds: int) -> int:
+    # keep a full run in the order of a minute
+    return max(3, min(rounds, 1_000_000 // size))
+
+
+def report(results: List[StageResult], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    regressions = []
+    print(
+        f"{'stage':<22}{'alarms':>8}{'rounds':>8}{'p50 ms':>12}{'p99 ms':>12}{'alarms/s':>14}"
+    )
+    for result in results:
+        line = (
+            f"{result.stage:<22}{result.size:>8}{result.rounds:>8}"
+            f"{result.p50 * 1000:>12.3f}{result.p99 * 1000:>12.3f}{result.throughput:>14.0f}"
+        )
+        previous = baseline.get(result.key)
+        if previous is not None:
+            change = result.p50 / previous["p50"] - 1 if previous["p50"] > 0 else 0
+            line += f"  {change:+.0%}"
+            if change > tolerance:
+                line += " REGRESSION"
+                regressions.append(result.key)
+        print(line)
+    return regressions
+
+
+async def main(args: argparse.Namespace) -> int:
+    sizes = [int(size) for size in args.sizes.split(",")]
+    results = []
+    for size in sizes:
+        results.extend(
+            await bench_size(size, rounds_for(size, args.rounds), args.seed, args.db)
+        )
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = report(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(
+                {
+                    result.key: {"p50": result.p50, "p99": result.p99}
+                    for result in results
+                },
+                f,
+                indent=2,
+            )
+    if regressions:
+        print(f"Regressed by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="alarm set sizes")
+    parser.add_argument("--rounds", type=int, default=50, help="rounds per stage")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", help="compare against this baseline file")
+    parser.add_argument("--save-baseline", help="write the results to this file")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="allowed p50 slowdown"
+    )
+    parser.add_argument("--db", action="store_true", help="also run the MariaDB stages")
+    raise SystemExit(asyncio.run(main(parser.parse_args())))
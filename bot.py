@@ -1,34 +1,56 @@
 import asyncio
-from math import exp
+import logging
 import os
-from warnings import catch_warnings
 from dotenv import load_dotenv
-import logging
-from typing import List, Dict, Union
-from threading import Thread
+from log import Summary, fields, get_logger, sampled
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 from decimal import Decimal
+from functools import partial
 import time
 
-from market_price import get_ton_usdt_price, set_ton_usdt_prices
-from subscriber import subscribe
-from mariadb_connector import get_alarm_from_db, get_latest_alarm_id
+from market_price import get_price, get_price_channel, set_prices
+from subscriber import MY_ADDRESS, subscribe
+from mariadb_connector import Alarm
+from balance_ledger import balance_ledger
+from oracles import Oracle, configured_oracles
 from ticton import TicTonAsyncClient
-from strategy import ProfitableAlarm, Balance, greedy_strategy
+from strategy import ProfitableAlarm, Balance, get_strategy
+from wind_estimator import WindEstimator
+from submitter import WalletSender, WindSubmitter
+from ring_scheduler import RingScheduler
+from sharding import SHARD
+import metrics
+from metrics import alarms_total, evaluation_seconds
 
 load_dotenv()
 
 THRESHOLD_PRICE = os.getenv("TICTON_THRESHOLD_PRICE", 0.7)
 QPS = int(os.getenv("QPS", 9))
+# wind estimates in flight at once, rate_limiter keeps to QPS
+ESTIMATE_CONCURRENCY = int(os.getenv("ESTIMATE_CONCURRENCY", QPS))
+# re-read the exact wind amounts from the alarm contract before sending
+CONFIRM_WIND_ESTIMATE = os.getenv("CONFIRM_WIND_ESTIMATE", "true").lower() == "true"
+# how to allocate the balance over the profitable alarms, see strategy.STRATEGIES
+STRATEGY = os.getenv("STRATEGY", "knapsack")
+# coalesce bursts of price/alarm updates into one evaluation
+EVAL_DEBOUNCE_SECONDS = float(os.getenv("EVAL_DEBOUNCE_SECONDS", 0.05))
+# evaluate at least this often even if nothing was notified
+EVAL_MAX_STALENESS_SECONDS = float(os.getenv("EVAL_MAX_STALENESS_SECONDS", 10))
+# never act on a price older than this
+MAX_PRICE_AGE_SECONDS = float(os.getenv("MAX_PRICE_AGE_SECONDS", 10))
+# a failed component of run() is started again after this many seconds
+RESTART_INTERVAL = 5
 
-# set up logger
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
+logger = get_logger(__name__)
 
 
 async def check_balance(
@@ -38,10 +60,10 @@ async def check_balance(
     max_buy_num: int = 0,
 ):
     if balance.base_asset < need_base or balance.quote_asset < need_quote:
-        logger.info("Not enough balance")
+        logger.info("Not enough balance", extra=sampled())
         return None
     if max_buy_num == 0:
-        logger.info("Max Buy Num is 0")
+        logger.info("Max Buy Num is 0", extra=sampled())
         return None
 
     # Check if enough balance
@@ -56,142 +78,427 @@ async def check_balance(
     return buy_num
 
 
-async def main():
-    client = await TicTonAsyncClient.init(testnet=True, qps=QPS)
-    my_address = os.getenv("MY_ADDRESS", "")
+def find_candidates(
+    alarms: List[Alarm],
+    new_price: float,
+    threshold: Union[str, float] = THRESHOLD_PRICE,
+) -> Tuple[List[Tuple[Alarm, float]], List[int]]:
+    """
+    Returns the (alarm, price_delta) pairs of other people's alarms that
+    deviate at least `threshold` from `new_price`, and the ids of our own
+    alarms that do. Scans all `alarms`, AlarmStore.find_candidates answers
+    the same from its price index.
+    """
+    threshold = float(threshold)
+    candidates = []
+    deviating_alarm_ids = []
+    for alarm in alarms:
+        old_price = float(alarm.price)
+        price_delta = abs(new_price - old_price)
+        if price_delta < threshold:
+            continue
+        if alarm.is_mine:
+            deviating_alarm_ids.append(alarm.id)
+            continue
+        candidates.append((alarm, price_delta))
+    return candidates, deviating_alarm_ids
 
-    logger.info("Syncing Oracle Metadata")
-    next_alarm_id, now_alarm_id = 0, 0
-    while next_alarm_id != now_alarm_id + 1:
-        try:
-            logger.info(
-                f"Syncing | Latest Alarm ID in Oracle: {next_alarm_id-1}, Now Alarm ID in Database: {now_alarm_id}"
+
+async def screen_alarm(
+    estimator: WindEstimator,
+    semaphore: asyncio.Semaphore,
+    alarm: Alarm,
+    price_delta: float,
+    new_price_raw: int,
+    balance: Balance,
+) -> Optional[ProfitableAlarm]:
+    try:
+        alarm_info = estimator.cache.get(alarm.id)
+        if alarm_info is None:
+            async with semaphore:
+                alarm_info = await estimator.get_alarm_info(alarm.id)
+
+        can_buy, need_asset_tup = estimator.estimate(alarm_info, new_price_raw, 1)
+
+        if not can_buy:
+            logger.error("No enough balance to buy asset.", extra=sampled(alarm=alarm.id))
+            return None
+
+        need_base_asset = need_asset_tup[0]
+        need_quote_asset = need_asset_tup[1]
+
+        max_buy_num = estimator.max_buy_num(alarm_info, new_price_raw)
+        max_buy_num = min(max_buy_num, alarm.remain_scale)
+    except Exception as e:
+        logger.error("Error in estimate wind %s", e, extra=sampled(alarm=alarm.id))
+        return None
+    try:
+        buy_num = await check_balance(
+            balance,
+            need_base_asset,
+            need_quote_asset,
+            max_buy_num,
+        )
+        if isinstance(buy_num, int):
+            return ProfitableAlarm(
+                id=alarm.id,
+                price_delta=price_delta,
+                need_base_asset=need_base_asset * buy_num,
+                need_quote_asset=need_quote_asset * buy_num,
+                buy_num=buy_num,
             )
-            await asyncio.sleep(10)
-            await client.sync_oracle_metadata()
-            next_alarm_id = client.metadata.total_alarms
-            now_alarm_id = await get_latest_alarm_id()
-        except Exception as e:
-            logger.error(f"Error in syncing Oracle Metadata {e}")
+    except Exception as e:
+        logger.error("Error in check balance %s", e, extra=sampled(alarm=alarm.id))
+    return None
+
+
+def size_alarm(
+    estimator: WindEstimator,
+    alarm: Alarm,
+    price_delta: float,
+    max_buy_num: int,
+    new_price_raw: int,
+    balance: Balance,
+) -> Optional[ProfitableAlarm]:
+    """
+    screen_alarm for an alarm whose metadata is cached and whose max buy num
+    was already computed in batch by AlarmStore.max_buy_nums. Only the quote
+    asset is checked here, with the exact estimate.
+    """
+    try:
+        alarm_info = estimator.cache[alarm.id]
+        can_buy, (need_base_asset, need_quote_asset) = estimator.estimate(
+            alarm_info, new_price_raw, 1
+        )
+        max_buy_num = min(max_buy_num, estimator.max_buy_num(alarm_info, new_price_raw))
+        if (
+            not can_buy
+            or max_buy_num == 0
+            or balance.base_asset < need_base_asset
+            or balance.quote_asset < need_quote_asset
+        ):
+            return None
+        buy_num = min(max_buy_num, int(balance.base_asset // need_base_asset))
+        if need_quote_asset > 0:
+            buy_num = min(buy_num, int(balance.quote_asset // need_quote_asset))
+        return ProfitableAlarm(
+            id=alarm.id,
+            price_delta=price_delta,
+            need_base_asset=need_base_asset * buy_num,
+            need_quote_asset=need_quote_asset * buy_num,
+            buy_num=buy_num,
+        )
+    except Exception as e:
+        logger.error("Error in size wind %s", e, extra=sampled(alarm=alarm.id))
+        return None
+
+
+async def screen_alarms(
+    estimator: WindEstimator,
+    candidates: List[Tuple[Alarm, float]],
+    new_price_raw: int,
+    balance: Balance,
+    max_buy_nums: Optional[Sequence[int]] = None,
+) -> AsyncIterator[ProfitableAlarm]:
+    """
+    Estimates the wind cost of every (alarm, price_delta) candidate
+    concurrently and yields the profitable ones in the order their estimates
+    complete. Estimates are local, only alarms missing from the metadata
+    cache go to the chain, at most ESTIMATE_CONCURRENCY at a time.
+
+    `max_buy_nums` are the batch results of AlarmStore.max_buy_nums for the
+    candidates. Candidates it rules out are skipped, and the cached ones are
+    sized right away without a task; only the rest is screened as above.
+    """
+    semaphore = asyncio.Semaphore(ESTIMATE_CONCURRENCY)
+    if max_buy_nums is None:
+        max_buy_nums = [-1] * len(candidates)
+    screened = []
+    for (alarm, price_delta), max_buy_num in zip(candidates, max_buy_nums):
+        if max_buy_num == 0:
+            continue
+        if max_buy_num > 0 and alarm.id in estimator.cache:
+            profitable_alarm = size_alarm(
+                estimator, alarm, price_delta, max_buy_num, new_price_raw, balance
+            )
+            if profitable_alarm is not None:
+                yield profitable_alarm
+        else:
+            screened.append((alarm, price_delta))
+    tasks = [
+        asyncio.create_task(
+            screen_alarm(
+                estimator, semaphore, alarm, price_delta, new_price_raw, balance
+            )
+        )
+        for alarm, price_delta in screened
+    ]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            profitable_alarm = await next_done
+            if profitable_alarm is not None:
+                yield profitable_alarm
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def confirm_alarm(
+    estimator: WindEstimator, profitable_alarm: ProfitableAlarm, new_price_raw: int
+) -> Optional[ProfitableAlarm]:
+    try:
+        can_buy, need_asset_tup = await estimator.confirm(
+            profitable_alarm.id, profitable_alarm.buy_num, new_price_raw
+        )
+        if not can_buy:
+            logger.error("Alarm %d can no longer be bought", profitable_alarm.id)
+            return None
+        profitable_alarm.need_base_asset = need_asset_tup[0]
+        profitable_alarm.need_quote_asset = need_asset_tup[1]
+        return profitable_alarm
+    except Exception as e:
+        logger.error("Error in confirm wind %s", e)
+        return None
+
+
+async def decide(
+    estimator: WindEstimator,
+    strategy: Callable[..., AsyncIterator[ProfitableAlarm]],
+    candidates: List[Tuple[Alarm, float]],
+    new_price_raw: int,
+    balance: Balance,
+    confirm: bool = CONFIRM_WIND_ESTIMATE,
+    max_buy_nums: Optional[Sequence[int]] = None,
+    oracle: str = "",
+) -> List[ProfitableAlarm]:
+    """
+    The decision of one evaluation: returns the winds to send for the
+    (alarm, price_delta) candidates. `balance` is used up by the strategy.
+    The alarms are counted for `oracle`, a raw address.
+    """
+    # (alarm id, price delta) of the largest deltas, all of them at DEBUG
+    logger.info(
+        "Candidates: %s",
+        Summary(candidates, key=lambda candidate: (candidate[0].id, candidate[1])),
+    )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("All candidates: %s", Summary(candidates, limit=len(candidates)))
+
+    profitable_alarms = []
+    async for profitable_alarm in screen_alarms(
+        estimator, candidates, new_price_raw, balance, max_buy_nums
+    ):
+        profitable_alarms.append(profitable_alarm)
 
+    logger.info(
+        "Profitable Alarms: %s",
+        Summary(profitable_alarms, key=lambda alarm: (alarm.id, alarm.buy_num)),
+    )
+    if logger.isEnabledFor(logging.DEBUG):
+        # confirm_alarm changes the alarms after this
+        logger.debug(
+            "All profitable alarms: %s",
+            Summary(profitable_alarms, limit=len(profitable_alarms)),
+        )
+    alarms_total.inc(len(profitable_alarms), oracle=oracle, stage="profitable")
+    selected_alarms = [
+        profitable_alarm
+        async for profitable_alarm in strategy(profitable_alarms, balance)
+    ]
+    if confirm:
+        selected_alarms = await asyncio.gather(
+            *[
+                confirm_alarm(estimator, profitable_alarm, new_price_raw)
+                for profitable_alarm in selected_alarms
+            ]
+        )
+    selected_alarms = [alarm for alarm in selected_alarms if alarm is not None]
+    alarms_total.inc(len(selected_alarms), oracle=oracle, stage="selected")
+    return selected_alarms
+
+
+async def main(
+    client: Optional[TicTonAsyncClient] = None,
+    oracle: Optional[Oracle] = None,
+    sender: Optional[WalletSender] = None,
+):
+    """
+    The evaluation loop of one oracle. Oracles of one wallet must share
+    their `sender`, it owns the wallet's seqno.
+    """
+    if oracle is None:
+        oracle = configured_oracles()[0]
+    if client is None:
+        client = await oracle.connect()
+    if sender is None:
+        sender = WalletSender(client)
+    my_address = os.getenv("MY_ADDRESS", "")
+    alarm_store = oracle.store
+    evaluation_trigger = oracle.trigger
+    estimator = WindEstimator(client)
+    strategy = get_strategy(STRATEGY)
+    submitter = WindSubmitter(client, sender, oracle.leases)
+    ring_scheduler = RingScheduler(client, sender)
+    alarm_store.add_listener(estimator.on_alarm_change)
+    alarm_store.add_listener(submitter.on_alarm_change)
+    estimator.add_listener(alarm_store.on_alarm_info)
+    get_price_channel(oracle.symbol).subscribe(evaluation_trigger)
+
+    logger.info("Waiting for the alarm backfill of %s", oracle)
+    await oracle.ready.wait()
+
+    logger.info("Loading Active Alarms")
+    while not await alarm_store.load(MY_ADDRESS):
+        await asyncio.sleep(1)
+
+    alarm_store.add_listener(ring_scheduler.on_alarm_change)
+    for alarm in alarm_store.active_alarms():
+        if alarm.is_mine:
+            ring_scheduler.schedule_alarm(alarm)
+    ring_task = asyncio.create_task(
+        supervise(f"ring scheduler of {oracle}", ring_scheduler.run)
+    )
+    # stopped with this loop, so a restarted main does not ring twice
+    asyncio.current_task().add_done_callback(lambda _: ring_task.cancel())
+
+    logger.info("Reading the wallet balance")
+    while not await balance_ledger.reconcile(client, my_address):
+        await asyncio.sleep(1)
+    # shared by the oracles of the wallet, restarts itself when it fails
+    balance_ledger.start(my_address)
+
+    evaluation_trigger.bind()
+    evaluation_trigger.notify("startup")
     while True:
+        reasons = await evaluation_trigger.wait(
+            EVAL_DEBOUNCE_SECONDS, EVAL_MAX_STALENESS_SECONDS
+        )
         try:
-            logger.info("=======================")
-            alarms = await get_alarm_from_db("state = 'active' AND remain_scale > 0")
-            logger.info(f"Active Alarms: \n{alarms}")
-            if alarms is None or len(alarms) == 0:
-                logger.info("No active alarms")
+            logger.info(
+                "Evaluating %s",
+                oracle.symbol,
+                extra=fields(reasons=sorted(reasons), alarms=len(alarm_store)),
+            )
+            if len(alarm_store) == 0:
+                logger.info("No active alarms", extra=sampled(key=oracle.symbol))
                 continue
-            new_price = await get_ton_usdt_price()
+            started = time.monotonic()
+            new_price, price_age = await get_price(oracle.symbol)
             if new_price is None:
                 continue
+            if price_age > MAX_PRICE_AGE_SECONDS:
+                logger.info(
+                    "Price is stale, last updated %.1fs ago",
+                    price_age,
+                    extra=sampled(key=oracle.symbol),
+                )
+                continue
             new_price = round(new_price, 9)
-            logger.info(f"New Price: {new_price}")
+            new_price_raw = await estimator.convert_price(new_price)
 
-            balance_result = await client._get_user_balance(my_address)
-
-            balance = Balance(
-                base_asset=balance_result[0], quote_asset=balance_result[1]
+            # minus the winds still in flight, no chain read on this path
+            balance = balance_ledger.balance(client)
+            # the strategy uses the balance up, log its values now
+            logger.info(
+                "New Price: %s",
+                new_price,
+                extra=fields(
+                    base_asset=int(balance.base_asset),
+                    quote_asset=int(balance.quote_asset),
+                ),
             )
         except Exception as e:
-            logger.error(f"Error in main {e}")
+            logger.error("Error in main %s", e)
             continue
 
-        profitable_alarms = []
-        for alarm in alarms:
-            old_price = float(alarm.price)
-            price_delta = abs(new_price - old_price)
-            if price_delta < float(THRESHOLD_PRICE):
-                if alarm.is_mine and alarm.created_at < (time.time() - 60):
-                    try:
-                        result = await client.ring(alarm.id)
-                        logger.info(f"ring result: {result}")
-                        continue
-                    except Exception as e:
-                        logger.error(f"Error in ring {e}")
-                        continue
-                continue
-            if alarm.is_mine:
-                try:
-                    result = await client.ring(alarm.id)
-                    logger.info(f"ring result: {result}")
-                    continue
-                except Exception as e:
-                    logger.error(f"Error in ring {e}")
-                    continue
-            logger.info(f"Alarm ID: {alarm.id}, Price Delta: {price_delta}")
-            try:
-                (
-                    can_buy,
-                    need_asset_tup,
-                    alarm_info,
-                ) = await client._estimate_wind(alarm.id, 1, new_price)
-
-                if not can_buy:
-                    logger.error("No enough balance to buy asset.")
-                    continue
-
-                if need_asset_tup is None:
-                    logger.error("Need asset is None")
-                    continue
-
-                need_base_asset = need_asset_tup[0]
-                need_quote_asset = need_asset_tup[1]
-
-                if new_price > old_price:
-                    max_buy_num = alarm_info.base_asset_scale
+        try:
+            candidates, deviating_alarm_ids = alarm_store.find_candidates(
+                new_price, float(THRESHOLD_PRICE), SHARD
+            )
+            # the store still shows the units our winds in flight take
+            in_flight = submitter.in_flight()
+            if in_flight:
+                candidates = [
+                    candidate for candidate in candidates if candidate[0].id not in in_flight
+                ]
+            for alarm_id in deviating_alarm_ids:
+                # ring our own alarm before someone winds it
+                ring_scheduler.schedule(alarm_id, time.time())
+            # scales, remaining units and base asset for all candidates at once
+            max_buy_nums = alarm_store.max_buy_nums(
+                [alarm.id for alarm, _ in candidates],
+                new_price,
+                int(balance.base_asset),
+                client.metadata.min_base_asset_threshold,
+            )
+            selected_alarms = await decide(
+                estimator,
+                strategy,
+                candidates,
+                new_price_raw,
+                balance,
+                max_buy_nums=max_buy_nums,
+                oracle=oracle.raw_address,
+            )
+            for result in await submitter.submit(selected_alarms, new_price_raw, started):
+                if result.error is not None:
+                    logger.error("Error in wind %d %s", result.alarm.id, result.error)
                 else:
-                    max_buy_num = alarm_info.quote_asset_scale
-
-                max_buy_num = min(max_buy_num, alarm.remain_scale)
-            except Exception as e:
-                logger.error(f"Error in estimate wind {e}")
-                continue
-            try:
-                buy_num = await check_balance(
-                    balance,
-                    need_base_asset,
-                    need_quote_asset,
-                    max_buy_num,
-                )
-                if isinstance(buy_num, int):
-                    profitable_alarms.append(
-                        ProfitableAlarm(
-                            id=alarm.id,
-                            price_delta=price_delta,
-                            need_base_asset=need_base_asset * buy_num,
-                            need_quote_asset=need_quote_asset * buy_num,
-                            buy_num=buy_num,
-                        )
+                    logger.info(
+                        "Wind result",
+                        extra=fields(
+                            alarm=result.alarm.id, seqno=result.seqno, latency=result.latency
+                        ),
                     )
-            except Exception as e:
-                logger.error(f"Error in check balance {e}")
-                continue
+        except Exception as e:
+            # the next evaluation starts over
+            logger.error("Error in evaluation %s", e)
+            continue
+        evaluation_seconds.observe(time.monotonic() - started)
 
-        logger.info(f"Profitable Alarms: \n{profitable_alarms}")
-        async for profitable_alarm in greedy_strategy(profitable_alarms, balance):
-            try:
-                result = await client.wind(
-                    alarm_id=profitable_alarm.id,
-                    buy_num=profitable_alarm.buy_num,
-                    new_price=new_price,
-                    skip_estimate=True,
-                    need_base_asset=profitable_alarm.need_base_asset,
-                    need_quote_asset=profitable_alarm.need_quote_asset,
-                )
-                logger.info(f"Wind result: {result}")
-            except Exception as e:
-                logger.error(f"Error in wind {e}")
+
+async def supervise(name: str, start: Callable[[], Awaitable[None]]):
+    """
+    Runs `start()` until it returns and starts it again after
+    RESTART_INTERVAL whenever it fails, so a failing component of `run`
+    does not stop the others.
+    """
+    while True:
+        try:
+            await start()
+            return
+        except Exception as e:
+            logger.error("Error in %s, restarting %s", name, e)
+        await asyncio.sleep(RESTART_INTERVAL)
 
 
-if __name__ == "__main__":
-    threads = [
-        Thread(target=asyncio.run, args=(set_ton_usdt_prices(),), daemon=True),
-        Thread(target=asyncio.run, args=(subscribe(),), daemon=True),
-        Thread(target=asyncio.run, args=(main(),), daemon=True),
+async def run():
+    """
+    Runs the price feed, and the subscriber and the bot of every configured
+    oracle, on one event loop. Prices and alarm events are handed over in
+    memory. The oracles share the exchange clients of one price feed, one
+    toncenter client with its rate limit, and the wallet sender. Each of
+    them runs under `supervise`.
+    """
+    oracles = configured_oracles()
+    client = await oracles[0].connect()
+    clients = [client] + [
+        await oracle.connect(client.toncenter) for oracle in oracles[1:]
     ]
-    for thread in threads:
-        thread.start()
+    sender = WalletSender(client)
+    await asyncio.gather(
+        supervise("price feed", partial(set_prices, [oracle.symbol for oracle in oracles])),
+        *[
+            supervise(f"subscriber of {oracle}", partial(subscribe, client, oracle))
+            for client, oracle in zip(clients, oracles)
+        ],
+        *[
+            supervise(f"bot of {oracle}", partial(main, client, oracle, sender))
+            for client, oracle in zip(clients, oracles)
+        ],
+        supervise("metrics server", metrics.serve),
+    )
 
-    for thread in threads:
-        thread.join()
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,98 @@
+import asyncio
+import threading
+from typing import Optional, Set
+
+
+class Trigger:
+    """
+    Wakes up a single asyncio consumer when something it depends on changes.
+
+    Producers may live on other threads (and other event loops), so `notify`
+    is thread-safe. The consumer calls `bind` once from its own loop and then
+    `wait`s for the set of reasons collected since the previous wake-up.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._event: Optional[asyncio.Event] = None
+        self._reasons: Set[str] = set()
+
+    def bind(self):
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+            self._event = asyncio.Event()
+            if self._reasons:
+                self._event.set()
+
+    def notify(self, reason: str):
+        with self._lock:
+            self._reasons.add(reason)
+            loop, event = self._loop, self._event
+        if loop is None or event is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            event.set()
+            return
+        try:
+            loop.call_soon_threadsafe(event.set)
+        except RuntimeError:  # consumer loop already closed
+            pass
+
+    def _drain(self) -> Set[str]:
+        with self._lock:
+            self._event.clear()
+            reasons, self._reasons = self._reasons, set()
+        return reasons
+
+    async def wait(self, debounce: float = 0, max_staleness: float = 10) -> Set[str]:
+        """
+        Waits until at least one notification arrives, then keeps collecting
+        for `debounce` seconds so a burst of updates results in one wake-up.
+        Returns {"staleness"} if nothing happened within `max_staleness`.
+        """
+        assert self._event is not None, "Trigger must be bound before waiting"
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + max_staleness
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self._event.wait(), timeout=max(deadline - loop.time(), 0)
+                )
+            except asyncio.TimeoutError:
+                return self._drain() or {"staleness"}
+            with self._lock:
+                if self._reasons:
+                    break
+                # woken by a notification that was already drained
+                self._event.clear()
+
+        if debounce > 0:
+            await asyncio.sleep(debounce)
+        return self._drain()
+
+
+class Signal:
+    """
+    A one-shot flag that can be set from any thread and awaited from any
+    event loop, e.g. to hold a consumer back until its data is ready.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def set(self):
+        self._event.set()
+
+    def is_set(self) -> bool:
+        return self._event.is_set()
+
+    async def wait(self, timeout: Optional[float] = None) -> bool:
+        if self._event.is_set():
+            return True
+        return await asyncio.to_thread(self._event.wait, timeout)
+
@@ -0,0 +1,134 @@
+import asyncio
+from decimal import Decimal
+from typing import Dict, Optional, Tuple
+
+from ticton.arithmetic import FixedFloat
+from ticton.decoder import AlarmMetadata, OracleMetadata
+from pytoncenter.address import Address as PyAddress
+
+from wind_estimator import PRICE_SCALE, AlarmInfo, WindEstimator
+
+# TON/USDT on the testnet oracle
+BASE_ASSET_DECIMALS = 9
+QUOTE_ASSET_DECIMALS = 6
+NULL_ADDRESS = "0:" + "0" * 64
+
+
+def fake_address(index: int) -> PyAddress:
+    return PyAddress("0:" + format(index, "064x"))
+
+
+class FakeTicTonClient:
+    """
+    In-memory stand-in for the parts of TicTonAsyncClient the bot reads, for
+    benchmarks and offline runs. Alarms live in `alarms`, every chain call
+    awaits `latency` seconds to model a toncenter round trip and is counted
+    in `calls`.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        base_asset_balance: int = 1000 * 10**BASE_ASSET_DECIMALS,
+        quote_asset_balance: int = 10000 * 10**QUOTE_ASSET_DECIMALS,
+    ):
+        self.latency = latency
+        self.oracle = fake_address(1)
+        self.metadata = OracleMetadata(
+            base_asset_address=NULL_ADDRESS,
+            quote_asset_address=fake_address(2).to_string(),
+            base_asset_decimals=BASE_ASSET_DECIMALS,
+            quote_asset_decimals=QUOTE_ASSET_DECIMALS,
+            min_base_asset_threshold=10**BASE_ASSET_DECIMALS,
+            base_asset_wallet_address=NULL_ADDRESS,
+            quote_asset_wallet_address=NULL_ADDRESS,
+            is_initialized=True,
+            latest_base_asset_price=0,
+            latest_timestamp=0,
+            total_alarms=0,
+        )
+        self.alarms: Dict[int, AlarmMetadata] = {}
+        self.addresses: Dict[str, int] = {}
+        self.balance = (Decimal(base_asset_balance), Decimal(quote_asset_balance))
+        self.calls: Dict[str, int] = {}
+
+    async def _call(self, name: str):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+    def price_to_raw(self, price: float) -> int:
+        return int(price * 10**QUOTE_ASSET_DECIMALS * PRICE_SCALE) // 10**BASE_ASSET_DECIMALS
+
+    def add_alarm(
+        self,
+        alarm_id: int,
+        price: float,
+        remain_scale: int = 1,
+        watchmaker: Optional[PyAddress] = None,
+        created_at: int = 0,
+    ):
+        watchmaker = watchmaker or fake_address(3)
+        self.alarms[alarm_id] = AlarmMetadata(
+            watchmaker_address=watchmaker.to_string(),
+            base_asset_scale=remain_scale,
+            quote_asset_scale=remain_scale,
+            remain_scale=remain_scale,
+            base_asset_price=self.price_to_raw(price),
+            base_asset_amount=remain_scale * self.metadata.min_base_asset_threshold,
+            quote_asset_amount=0,
+            created_at=created_at,
+            alarm_index=alarm_id,
+        )
+        self.metadata.total_alarms = max(self.metadata.total_alarms, alarm_id + 1)
+
+    def update_alarm(self, alarm_id: int, remain_scale: int):
+        metadata = self.alarms.get(alarm_id)
+        if metadata is not None:
+            self.alarms[alarm_id] = metadata.model_copy(
+                update={"remain_scale": remain_scale}
+            )
+
+    def close_alarm(self, alarm_id: int):
+        self.alarms.pop(alarm_id, None)
+
+    async def sync_oracle_metadata(self):
+        await self._call("sync_oracle_metadata")
+
+    async def get_alarm_address(self, alarm_id: int) -> PyAddress:
+        await self._call("get_alarm_address")
+        # the oracle and the wallets take the first addresses
+        address = fake_address(alarm_id + 16)
+        self.addresses[address.to_string()] = alarm_id
+        return address
+
+    async def get_address_state(self, address: PyAddress) -> str:
+        await self._call("get_address_state")
+        alarm_id = self.addresses.get(address.to_string())
+        return "active" if alarm_id in self.alarms else "uninitialized"
+
+    async def get_alarm_metadata(self, alarm_address: PyAddress) -> AlarmMetadata:
+        await self._call("get_alarm_metadata")
+        return self.alarms[self.addresses[alarm_address.to_string()]]
+
+    async def _convert_price(self, price: float) -> FixedFloat:
+        assert price > 0, "price must be greater than 0"
+        return FixedFloat(price) * 10**QUOTE_ASSET_DECIMALS / 10**BASE_ASSET_DECIMALS
+
+    async def _convert_fixedfloat_to_price(self, price: FixedFloat) -> float:
+        return price.to_float() * 10**BASE_ASSET_DECIMALS / 10**QUOTE_ASSET_DECIMALS
+
+    async def _estimate_from_oracle_get_method(
+        self, alarm_address: str, buy_num: int, new_price: int
+    ) -> Tuple[bool, int, int]:
+        await self._call("get_estimate")
+        alarm_id = self.addresses[alarm_address]
+        alarm_info = AlarmInfo(PyAddress(alarm_address), self.alarms[alarm_id])
+        can_buy, (need_base_asset, need_quote_asset) = WindEstimator(self).estimate(
+            alarm_info, new_price, buy_num
+        )
+        return can_buy, int(need_base_asset), int(need_quote_asset)
+
+    async def _get_user_balance(self, owner_address) -> Tuple[Decimal, Decimal]:
+        await self._call("get_user_balance")
+        return self.balance
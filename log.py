@@ -0,0 +1,169 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+from typing import Callable, Dict, Hashable, Optional, Sequence, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# DEBUG also logs the full candidate and profitable alarm lists
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# "text" writes the classic lines, "json" one object per record
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+# a sampled message is written at most this often per call site
+LOG_SAMPLE_INTERVAL = float(os.getenv("LOG_SAMPLE_INTERVAL", 10))
+# records waiting for the writer thread, more are dropped instead of blocking
+LOG_QUEUE_SIZE = 10000
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+
+def fields(**values) -> dict:
+    """The `extra` of a log call that attaches structured `values`."""
+    return {"fields": values}
+
+
+def sampled(
+    interval: float = LOG_SAMPLE_INTERVAL, key: Hashable = None, **values
+) -> dict:
+    """
+    Like `fields`, and the record is only written if its call site did not
+    write one within the last `interval` seconds, separately per `key`
+    (e.g. an exchange). The next written record counts the suppressed ones.
+    """
+    return {"fields": values, "sample_interval": interval, "sample_key": key}
+
+
+class Summary:
+    """
+    A list in a log message: its length and its first `limit` items. The
+    items are taken through `key` (by default their repr) right away, since
+    they may change before the record is written; only the text is built
+    on the writer thread.
+    """
+
+    def __init__(
+        self, items: Sequence, limit: int = 5, key: Optional[Callable] = None
+    ):
+        self.count = len(items)
+        self.items = tuple((key or repr)(item) for item in items[:limit])
+
+    def __str__(self):
+        items = list(self.items)
+        if self.count > len(items):
+            return f"{self.count} {items} and {self.count - len(items)} more"
+        return f"{self.count} {items}"
+
+
+class SampleFilter(logging.Filter):
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        # call site and key -> (last written, suppressed since)
+        self._sites: Dict[Tuple[str, int, Hashable], Tuple[float, int]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        interval = getattr(record, "sample_interval", None)
+        if interval is None:
+            return True
+        site = (record.pathname, record.lineno, getattr(record, "sample_key", None))
+        with self._lock:
+            written_at, suppressed = self._sites.get(site, (float("-inf"), 0))
+            if record.created - written_at < interval:
+                self._sites[site] = (written_at, suppressed + 1)
+                return False
+            self._sites[site] = (record.created, 0)
+        if suppressed:
+            record.fields = {**getattr(record, "fields", {}), "suppressed": suppressed}
+        return True
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the writer thread without formatting them, so the
+    message arguments are only turned into text there. Arguments must not
+    change after the log call. A full queue drops the record.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            record.fields = {**getattr(record, "fields", {}), "dropped": dropped}
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        values = getattr(record, "fields", None)
+        if values:
+            line += " " + " ".join(f"{key}={value}" for key, value in values.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "t": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, separators=(",", ":"))
+
+
+_handler: Optional[AsyncQueueHandler] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+_setup_lock = threading.Lock()
+
+
+def _setup() -> AsyncQueueHandler:
+    global _handler, _listener
+    with _setup_lock:
+        if _handler is None:
+            log_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+            stream_handler = logging.StreamHandler()
+            stream_handler.setFormatter(
+                JsonFormatter() if LOG_FORMAT == "json" else TextFormatter(TEXT_FORMAT)
+            )
+            _listener = logging.handlers.QueueListener(log_queue, stream_handler)
+            _listener.start()
+            # write what is still queued before the process exits
+            atexit.register(_listener.stop)
+            _handler = AsyncQueueHandler(log_queue)
+            _handler.addFilter(SampleFilter())
+    return _handler
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    The logger of a module. Every logger of the process writes through one
+    queue, from a background thread, so a log call never waits on the
+    output stream.
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(LOG_LEVEL)
+    handler = _setup()
+    if handler not in logger.handlers:
+        logger.addHandler(handler)
+    # the queue is the only way out, root handlers would write twice
+    logger.propagate = False
+    return logger
@@ -1,22 +1,18 @@
 import os
-import re
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import asyncio
-from typing import Literal, Optional, Union
+from typing import Callable, Literal, Optional, Union
 
 import mysql.connector as connector
 
-import logging
+from metrics import db_query_seconds
 
-# set up logger
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
+from log import get_logger
 
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
+logger = get_logger(__name__)
 
 
 load_dotenv()
@@ -31,6 +27,7 @@ class Alarm:
         state: Literal["uninitialized", "active"] = "active",
         is_mine: bool = False,
         remain_scale: int = 1,
+        watchmaker: str = "",
     ):
         self.id = id
         self.state = state
@@ -38,153 +35,454 @@ class Alarm:
         self.is_mine = is_mine
         self.remain_scale = remain_scale
         self.created_at = created_at
+        # raw address of the alarm's owner, empty if unknown
+        self.watchmaker = watchmaker
 
     def __repr__(self):
         return f"Alarm(id={self.id}, state={self.state}, price={self.price}, is_mine={self.is_mine}), remain_scale={self.remain_scale}, created_at={self.created_at}\n"
 
 
-async def create_connection():
-    try:
-        connection = connector.connect(
-            host=os.getenv("MYSQL_HOST"),  # Assuming MariaDB is running on localhost
-            database=os.getenv("MYSQL_DATABASE"),
-            user=os.getenv("MYSQL_USER"),
-            password=os.getenv("MYSQL_PASSWORD"),
+POOL_SIZE = int(os.getenv("MYSQL_POOL_SIZE", 4))
+HEALTH_CHECK_INTERVAL = float(os.getenv("MYSQL_HEALTH_CHECK_INTERVAL", 30))
+
+
+def create_connection():
+    return connector.connect(
+        host=os.getenv("MYSQL_HOST"),  # Assuming MariaDB is running on localhost
+        database=os.getenv("MYSQL_DATABASE"),
+        user=os.getenv("MYSQL_USER"),
+        password=os.getenv("MYSQL_PASSWORD"),
+    )
+
+
+class PooledConnection:
+    """
+    A live connection plus the prepared statements created on it, and one
+    plain cursor for the batched writes, whose statements differ in their
+    number of rows.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.statements = {}
+        self.cursor = None
+        self.last_used = time.monotonic()
+
+    def execute(self, sql: str, params: Union[tuple, list] = (), prepared: bool = True):
+        if not prepared:
+            if self.cursor is None:
+                self.cursor = self.connection.cursor()
+            self.cursor.execute(sql, params)
+            return self.cursor
+        statement = self.statements.get(sql)
+        if statement is None:
+            statement = (self.connection.cursor(prepared=True), sql)
+            self.statements[sql] = statement
+        # the driver only reuses a prepared statement for the identical sql object
+        cursor, sql = statement
+        cursor.execute(sql, params)
+        return cursor
+
+    def ensure_alive(self):
+        if time.monotonic() - self.last_used < HEALTH_CHECK_INTERVAL:
+            return
+        try:
+            self.connection.ping(reconnect=False)
+        except Exception as e:
+            logger.info("Reconnecting to MariaDB %s", e)
+            # prepared statements do not survive a reconnect
+            self.statements.clear()
+            self.cursor = None
+            self.connection.reconnect(attempts=3, delay=1)
+
+    def close(self):
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """
+    Keeps up to `size` MariaDB connections open and runs queries on a dedicated
+    thread pool of the same size, so blocking driver calls never run on the
+    caller's event loop and a free connection is always available to a worker.
+    """
+
+    def __init__(self, size: int = POOL_SIZE):
+        self.size = size
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._executor = ThreadPoolExecutor(
+            max_workers=size, thread_name_prefix="mariadb"
         )
-        if connection.is_connected():
-            return connection
-        else:
-            return None
-    except Exception as e:
-        logger.error(f"Error while connecting to MariaDB {e}")
 
+    def _acquire(self) -> PooledConnection:
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            return PooledConnection(create_connection())
+        conn.ensure_alive()
+        return conn
+
+    def _release(self, conn: PooledConnection):
+        conn.last_used = time.monotonic()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _call(self, func: Callable, args: tuple):
+        conn = self._acquire()
+        try:
+            result = func(conn, *args)
+            conn.connection.commit()
+        except Exception:
+            # the connection may be in an unknown state, do not hand it out again
+            conn.close()
+            raise
+        self._release(conn)
+        return result
+
+    async def run(self, func: Callable, *args):
+        loop = asyncio.get_running_loop()
+        with db_query_seconds.time(query=func.__name__.lstrip("_")):
+            return await loop.run_in_executor(self._executor, self._call, func, args)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+pool = ConnectionPool()
+
+
+ALARM_COLUMNS = "id, state, price, is_mine, remain_scale, created_at, watchmaker"
+ALARM_ROW = "(%s, %s, %s, %s, %s, %s, %s)"
+# alarms written by one statement of a batched write
+ROWS_PER_STATEMENT = 500
+
+
+class AlarmTables:
+    """
+    The tables and checkpoint of one oracle's alarms. The statements are
+    built once per instance, so each keeps its prepared statements. The
+    batched writes leave their rows (`{rows}`) or ids (`{ids}`) open, see
+    `_update_alarm`.
+    """
+
+    def __init__(self, suffix: str = ""):
+        self.alarms = f"alarms{suffix}"
+        self.archive = f"alarms_archive{suffix}"
+        self.checkpoint = f"last_lt{suffix}"
+        # lt of a first backfill that was interrupted, see backfill.backfill
+        self.backfill_checkpoint = f"backfill_lt{suffix}"
+
+        self.active_alarms_sql = f"""
+    SELECT {ALARM_COLUMNS} FROM {self.alarms}
+    WHERE state = 'active' AND remain_scale > 0
+"""
+        self.alarms_in_range_sql = f"""
+    SELECT {ALARM_COLUMNS} FROM {self.alarms}
+    WHERE id BETWEEN %s AND %s
+"""
+        self.alarm_sql = f"""
+    SELECT {ALARM_COLUMNS} FROM {self.alarms} WHERE id = %s
+    UNION ALL
+    SELECT {ALARM_COLUMNS} FROM {self.archive} WHERE id = %s
+"""
+        self.update_alarms_sql = f"""
+    INSERT INTO {self.alarms} ({ALARM_COLUMNS})
+    VALUES {{rows}}
+    ON DUPLICATE KEY UPDATE
+    state = VALUES(state),
+    remain_scale = VALUES(remain_scale),
+    watchmaker = IF(VALUES(watchmaker) = '', watchmaker, VALUES(watchmaker))
+"""
+        self.archive_alarms_sql = f"""
+    INSERT INTO {self.archive} ({ALARM_COLUMNS})
+    SELECT {ALARM_COLUMNS} FROM {self.alarms} WHERE id IN ({{ids}})
+    ON DUPLICATE KEY UPDATE
+    state = VALUES(state),
+    remain_scale = VALUES(remain_scale)
+"""
+        self.delete_alarms_sql = f"""
+    DELETE FROM {self.alarms} WHERE id IN ({{ids}})
+"""
+        self.latest_alarm_id_sql = f"""
+    SELECT GREATEST(
+        COALESCE((SELECT MAX(id) FROM {self.alarms}), 0),
+        COALESCE((SELECT MAX(id) FROM {self.archive}), 0)
+    )
+"""
 
-async def init():
-    try:
-        connection = await create_connection()
-        if connection is not None and connection.is_connected():
-            cursor = connection.cursor()
-            create_table_sql = """
-            CREATE TABLE IF NOT EXISTS alarms (
+    def __repr__(self):
+        return f"AlarmTables({self.alarms}, {self.archive}, {self.checkpoint})"
+
+
+# the tables of the oracle in TICTON_ORACLE_ADDRESS
+default_tables = AlarmTables()
+
+
+def _init(conn: PooledConnection, tables: AlarmTables):
+    cursor = conn.connection.cursor()
+    for table in (tables.alarms, tables.archive):
+        cursor.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {table} (
                 id INT PRIMARY KEY,
                 state VARCHAR(100) DEFAULT 'active',
                 price DECIMAL(16, 9) DEFAULT 0,
                 is_mine BOOLEAN DEFAULT FALSE,
                 remain_scale INT DEFAULT 1,
-                created_at INT DEFAULT 0
+                created_at INT DEFAULT 0,
+                watchmaker VARCHAR(100) DEFAULT ''
             )
             """
-            cursor.execute(create_table_sql)
-            connection.commit()
-            connection.close()
-            logger.info("Successfully Initialized MariaDB")
-
-            return True
+        )
+        # tables created by older versions, their rows keep an unknown watchmaker
+        cursor.execute(
+            f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS"
+            " watchmaker VARCHAR(100) DEFAULT ''"
+        )
+    # the hot table only holds active alarms and every lookup is by id, an
+    # index on (state, remain_scale) from older versions only slows writes
+    cursor.execute(
+        f"DROP INDEX IF EXISTS idx_{tables.alarms}_state_remain_scale"
+        f" ON {tables.alarms}"
+    )
+    # move what older versions left behind
+    cursor.execute(
+        f"""
+        INSERT INTO {tables.archive} ({ALARM_COLUMNS})
+        SELECT {ALARM_COLUMNS} FROM {tables.alarms}
+        WHERE state <> 'active' OR remain_scale <= 0
+        ON DUPLICATE KEY UPDATE
+        state = VALUES(state),
+        remain_scale = VALUES(remain_scale)
+        """
+    )
+    cursor.execute(
+        f"DELETE FROM {tables.alarms} WHERE state <> 'active' OR remain_scale <= 0"
+    )
+    create_checkpoint_table_sql = """
+    CREATE TABLE IF NOT EXISTS checkpoints (
+        name VARCHAR(100) PRIMARY KEY,
+        lt BIGINT UNSIGNED NOT NULL
+    )
+    """
+    cursor.execute(create_checkpoint_table_sql)
+    cursor.close()
+
+
+async def init(tables: AlarmTables = default_tables):
+    try:
+        await pool.run(_init, tables)
+        logger.info("Successfully Initialized MariaDB %s", tables.alarms)
+        return True
 
     except Exception as e:
-        logger.error("Error while initializing MariaDB", e)
+        logger.error("Error while initializing MariaDB %s", e)
         return False
 
 
-async def get_alarm_from_db(filter: Optional[str] = None):
+def _fetch_alarms(cursor, my_address: Optional[str] = None) -> list[Alarm]:
+    result = []
+    for (
+        id,
+        state,
+        price,
+        is_mine,
+        remain_scale,
+        created_at,
+        watchmaker,
+    ) in cursor.fetchall():
+        # is_mine was written for the subscriber's wallet, with several
+        # wallets every reader decides by the watchmaker
+        if my_address is not None and watchmaker:
+            is_mine = watchmaker == my_address
+        alarm = Alarm(
+            id=id,
+            state=state,
+            price=price,
+            is_mine=bool(is_mine),
+            remain_scale=remain_scale,
+            created_at=created_at,
+            watchmaker=watchmaker,
+        )
+        result.append(alarm)
+    return result
+
+
+def _get_active_alarms(
+    conn: PooledConnection, my_address: Optional[str], tables: AlarmTables
+):
+    return _fetch_alarms(conn.execute(tables.active_alarms_sql), my_address)
+
+
+def _get_alarms_in_range(
+    conn: PooledConnection, first_id: int, last_id: int, tables: AlarmTables
+):
+    return _fetch_alarms(conn.execute(tables.alarms_in_range_sql, (first_id, last_id)))
+
+
+def _get_alarm(conn: PooledConnection, alarm_id: int, tables: AlarmTables):
+    alarms = _fetch_alarms(conn.execute(tables.alarm_sql, (alarm_id, alarm_id)))
+    return alarms[0] if alarms else None
+
+
+async def get_active_alarms(
+    my_address: Optional[str] = None, tables: AlarmTables = default_tables
+) -> Optional[list[Alarm]]:
+    """
+    Returns the alarms that can be wound, or None on error. With
+    `my_address` (a raw address) is_mine refers to that wallet.
+    """
     try:
-        connection = await create_connection()
-        if connection is not None and connection.is_connected():
-            cursor = connection.cursor()
-            select_sql = """
-            SELECT id,state, price, is_mine, remain_scale, created_at FROM alarms
-            WHERE {}
-            """
-            select_sql = select_sql.format("1=1" if filter is None else filter)
-            cursor.execute(select_sql)
-            result = []
-            for (
-                id,
-                state,
-                price,
-                is_mine,
-                remain_scale,
-                created_at,
-            ) in cursor.fetchall():
-                alarm = Alarm(
-                    id=id,
-                    state=state,
-                    price=price,
-                    is_mine=is_mine,
-                    remain_scale=remain_scale,
-                    created_at=created_at,
-                )
-                result.append(alarm)
+        return await pool.run(_get_active_alarms, my_address, tables)
+
+    except Exception as e:
+        logger.error("Error while fetching active alarms from MariaDB %s", e)
+        return None
 
-            cursor.close()
-            connection.close()
-            return result
+
+async def get_alarms_in_range(
+    first_id: int, last_id: int, tables: AlarmTables = default_tables
+) -> Optional[list[Alarm]]:
+    """Returns the not yet archived alarms with ids in [first_id, last_id]."""
+    try:
+        return await pool.run(_get_alarms_in_range, first_id, last_id, tables)
 
     except Exception as e:
-        logger.error(f"Error while fetching alarm info from MariaDB {e}")
+        logger.error("Error while fetching alarms from MariaDB %s", e)
         return None
 
 
-async def update_alarm_to_db(alarms: list[Alarm]):
+async def get_alarm(
+    alarm_id: int, tables: AlarmTables = default_tables
+) -> Optional[Alarm]:
+    """Returns the alarm from either table, or None if it is unknown."""
     try:
-        if alarms is None or len(alarms) == 0:
-            return False
+        return await pool.run(_get_alarm, alarm_id, tables)
 
-        connection = await create_connection()
-        if connection is not None and connection.is_connected():
-            cursor = connection.cursor()
-            update_sql = """
-                INSERT INTO alarms (id, state, price, is_mine, remain_scale, created_at)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                ON DUPLICATE KEY UPDATE
-                state = VALUES(state),
-                remain_scale = VALUES(remain_scale)
-            """
-            insert_list = []
-            for alarm in alarms:
-                insert_list.append(
-                    (
-                        alarm.id,
-                        alarm.state,
-                        alarm.price,
-                        alarm.is_mine,
-                        alarm.remain_scale,
-                        alarm.created_at,
-                    )
+    except Exception as e:
+        logger.error("Error while fetching alarm %d from MariaDB %s", alarm_id, e)
+        return None
+
+
+UPDATE_CHECKPOINT_SQL = """
+    INSERT INTO checkpoints (name, lt) VALUES (%s, %s)
+    ON DUPLICATE KEY UPDATE lt = VALUES(lt)
+"""
+
+
+def _update_alarm(
+    conn: PooledConnection,
+    alarms: list[Alarm],
+    last_lt: Optional[int],
+    tables: AlarmTables,
+    checkpoint: str,
+):
+    # one multi-row statement per chunk instead of a round-trip per alarm
+    for start in range(0, len(alarms), ROWS_PER_STATEMENT):
+        chunk = alarms[start : start + ROWS_PER_STATEMENT]
+        params = []
+        for alarm in chunk:
+            params.extend(
+                (
+                    alarm.id,
+                    alarm.state,
+                    alarm.price,
+                    alarm.is_mine,
+                    alarm.remain_scale,
+                    alarm.created_at,
+                    alarm.watchmaker,
                 )
-            cursor.executemany(update_sql, insert_list)
-            connection.commit()
-            cursor.close()
-            connection.close()
+            )
+        rows = ", ".join([ALARM_ROW] * len(chunk))
+        conn.execute(tables.update_alarms_sql.format(rows=rows), params, prepared=False)
+
+        # rung and fully wound alarms are moved to the cold table
+        closed_ids = [
+            alarm.id
+            for alarm in chunk
+            if alarm.state != "active" or alarm.remain_scale <= 0
+        ]
+        if closed_ids:
+            ids = ", ".join(["%s"] * len(closed_ids))
+            conn.execute(
+                tables.archive_alarms_sql.format(ids=ids), closed_ids, prepared=False
+            )
+            conn.execute(
+                tables.delete_alarms_sql.format(ids=ids), closed_ids, prepared=False
+            )
+    if last_lt is not None:
+        # committed in the same transaction as the alarms
+        conn.execute(UPDATE_CHECKPOINT_SQL, (checkpoint, last_lt))
+
+
+async def update_alarm_to_db(
+    alarms: list[Alarm],
+    last_lt: Optional[int] = None,
+    tables: AlarmTables = default_tables,
+    checkpoint: Optional[str] = None,
+):
+    """
+    Upserts `alarms`, closed ones end up in the archive table. If `last_lt`
+    is given, the subscriber checkpoint (or the one named `checkpoint`) is
+    moved to it atomically with the alarms, also without any alarm.
+    """
+    try:
+        if not alarms and last_lt is None:
+            return False
 
-            return True
+        await pool.run(
+            _update_alarm, alarms, last_lt, tables, checkpoint or tables.checkpoint
+        )
+        return True
 
+    except Exception as e:
+        logger.error("Error while updating alarm info to MariaDB %s", e)
         return False
 
-    except Exception as e:
-        logger.error(f"Error while updating alarm info to MariaDB {e}")
+
+CHECKPOINT_SQL = """
+    SELECT lt FROM checkpoints WHERE name = %s
+"""
 
 
-async def get_latest_alarm_id():
+def _get_checkpoint(conn: PooledConnection, name: str):
+    cursor = conn.execute(CHECKPOINT_SQL, (name,))
+    row = cursor.fetchone()
+    cursor.fetchall()
+    return int(row[0]) if row is not None else None
+
+
+async def get_checkpoint(name: str = "last_lt") -> Optional[int]:
     try:
-        connection = await create_connection()
-        if connection is not None and connection.is_connected():
-            cursor = connection.cursor()
-            select_sql = """
-            SELECT id FROM alarms ORDER BY id DESC LIMIT 1
-            """
-            cursor.execute(select_sql)
-            latest_id = cursor.fetchone()
+        return await pool.run(_get_checkpoint, name)
+
+    except Exception as e:
+        logger.error("Error while fetching checkpoint from MariaDB %s", e)
+        return None
 
-            cursor.close()
-            connection.close()
 
-            return latest_id[0] if latest_id is not None else 0
-        else:
-            return 0
+def _get_latest_alarm_id(conn: PooledConnection, tables: AlarmTables):
+    cursor = conn.execute(tables.latest_alarm_id_sql)
+    latest_id = cursor.fetchone()
+    # drain the result set so the prepared statement can be executed again
+    cursor.fetchall()
+    return latest_id[0] if latest_id is not None else 0
+
+
+async def get_latest_alarm_id(tables: AlarmTables = default_tables):
+    try:
+        return await pool.run(_get_latest_alarm_id, tables)
 
     except Exception as e:
-        logger.error(f"Error while fetching latest alarm id from MariaDB {e}")
+        logger.error("Error while fetching latest alarm id from MariaDB %s", e)
         return 0
 
 
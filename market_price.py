@@ -1,76 +1,389 @@
 import ccxt.async_support as ccxt
+import ccxt.pro as ccxtpro
 import asyncio
 import os
-import redis
+import statistics
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple
+import redis.asyncio as redis
 from dotenv import load_dotenv
+from events import Trigger
+from metrics import price_fetch_seconds, price_source_age_seconds
+from recorder import recorder
 
-import logging
+from log import get_logger, sampled
 
-# set up logger
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
+logger = get_logger(__name__)
 
 load_dotenv()
 
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_DB = int(os.getenv("REDIS_DB", 0))
+# mirror prices to redis, only needed when the price feed runs in another process
+USE_REDIS = os.getenv("USE_REDIS", "false").lower() == "true"
+
+MARKETS_REFRESH_INTERVAL = float(os.getenv("MARKETS_REFRESH_INTERVAL", 3600))
+POLL_INTERVAL = float(os.getenv("PRICE_POLL_INTERVAL", 3))
+# "poll" fetches REST tickers every POLL_INTERVAL, "stream" follows websockets
+PRICE_FEED_MODE = os.getenv("PRICE_FEED_MODE", "poll")
+STREAM_RETRY_INTERVAL = float(os.getenv("STREAM_RETRY_INTERVAL", 30))
+# quotes older than this are left out of the aggregated price
+SOURCE_MAX_AGE = float(os.getenv("PRICE_SOURCE_MAX_AGE", 15))
+# "median" or "trimmed_mean"
+PRICE_AGGREGATION = os.getenv("PRICE_AGGREGATION", "median")
 
 EXCHANGE_LIST = [
     "bybit",
     "gateio",
     "okx",
 ]
+DEFAULT_SYMBOL = "TON/USDT"
 
-redis_client = redis.StrictRedis(
-    host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True
+# on_price(exchange_id, symbol, price, latency in seconds)
+OnPrice = Callable[[str, str, float, float], None]
+
+redis_client = (
+    redis.StrictRedis(
+        host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True
+    )
+    if USE_REDIS
+    else None
 )
 
 
-async def fetch_price_from_exchange(exchange_id, symbol="TON/USDT"):
-    try:
-        exchange_class = getattr(ccxt, exchange_id)
-        async with exchange_class() as exchange:
-            await exchange.load_markets()
-            if symbol in exchange.markets:
-                ticker = await exchange.fetch_ticker(symbol)
-                return ticker["last"]
-    except Exception as e:
-        logger.error(f"Error while fetching price from {exchange_id} {e}")
-        return None
+class PriceFeed:
+    """
+    Keeps one warm ccxt client per exchange, so every tick reuses the same
+    HTTP session and the market metadata is only downloaded once and then
+    refreshed every MARKETS_REFRESH_INTERVAL seconds. All `symbols` are
+    fetched through the same client, in one tickers request where the
+    exchange supports it, so another pair costs no extra request.
+
+    With `streaming=True` the clients come from ccxt.pro and `stream` follows
+    the exchange ticker websocket, falling back to REST polling for that
+    exchange while its stream is down. `exchange_config` is merged into the
+    ccxt constructor options per exchange, e.g. to point `urls` at a local
+    fake websocket server or to preload `markets`.
+    """
+
+    def __init__(
+        self,
+        exchange_ids: List[str] = EXCHANGE_LIST,
+        symbols: Sequence[str] = (DEFAULT_SYMBOL,),
+        streaming: bool = False,
+        exchange_config: Optional[Dict[str, dict]] = None,
+    ):
+        self.exchange_ids = exchange_ids
+        self.symbols = list(dict.fromkeys(symbols))
+        self.streaming = streaming
+        self.exchange_config = exchange_config or {}
+        self.exchanges: Dict[str, ccxt.Exchange] = {}
+        self.markets_loaded_at: Dict[str, float] = {}
+
+    async def get_exchange(self, exchange_id: str) -> ccxt.Exchange:
+        exchange = self.exchanges.get(exchange_id)
+        if exchange is None:
+            module = ccxtpro if self.streaming else ccxt
+            exchange_class = getattr(module, exchange_id)
+            exchange = exchange_class(
+                {"enableRateLimit": True, **self.exchange_config.get(exchange_id, {})}
+            )
+            self.exchanges[exchange_id] = exchange
+
+        loaded_at = self.markets_loaded_at.get(exchange_id)
+        if loaded_at is None or time.monotonic() - loaded_at > MARKETS_REFRESH_INTERVAL:
+            await exchange.load_markets(reload=loaded_at is not None)
+            self.markets_loaded_at[exchange_id] = time.monotonic()
+        return exchange
+
+    def listed_symbols(self, exchange: ccxt.Exchange) -> List[str]:
+        return [symbol for symbol in self.symbols if symbol in exchange.markets]
+
+    async def fetch_prices(self, exchange_id: str) -> Dict[str, float]:
+        """The last price of every symbol listed on `exchange_id`."""
+        try:
+            exchange = await self.get_exchange(exchange_id)
+            symbols = self.listed_symbols(exchange)
+            if len(symbols) > 1 and exchange.has.get("fetchTickers"):
+                tickers = await exchange.fetch_tickers(symbols)
+            else:
+                tickers = {
+                    symbol: await exchange.fetch_ticker(symbol) for symbol in symbols
+                }
+            return {
+                symbol: ticker["last"]
+                for symbol, ticker in tickers.items()
+                if symbol in symbols and ticker.get("last") is not None
+            }
+        except Exception as e:
+            logger.error(
+                "Error while fetching price from %s %s",
+                exchange_id,
+                e,
+                extra=sampled(key=exchange_id),
+            )
+            return {}
+
+    async def poll_once(self, exchange_id: str, on_price: OnPrice):
+        started = time.monotonic()
+        prices = await self.fetch_prices(exchange_id)
+        latency = time.monotonic() - started
+        for symbol, price in prices.items():
+            on_price(exchange_id, symbol, price, latency)
+        return latency
+
+    async def poll(self, exchange_id: str, on_price: OnPrice):
+        """
+        Polls `exchange_id` every POLL_INTERVAL seconds on its own schedule, so
+        a slow or hung exchange never delays the others.
+        """
+        while True:
+            latency = await self.poll_once(exchange_id, on_price)
+            await asyncio.sleep(max(POLL_INTERVAL - latency, 0))
+
+    async def watch(self, exchange: ccxt.Exchange, symbol: str, on_price: OnPrice):
+        while True:
+            ticker = await exchange.watch_ticker(symbol)
+            if ticker["last"] is None:
+                continue
+            # time from the exchange matching engine to us
+            latency = 0.0
+            if ticker.get("timestamp"):
+                latency = max(time.time() - ticker["timestamp"] / 1000, 0)
+            on_price(exchange.id, symbol, ticker["last"], latency)
+
+    async def stream(self, exchange_id: str, on_price: OnPrice):
+        """
+        Calls `on_price` on every ticker message from `exchange_id`. While the
+        stream is down the exchange is polled over REST and the stream is
+        retried every STREAM_RETRY_INTERVAL seconds.
+        """
+        while True:
+            try:
+                exchange = await self.get_exchange(exchange_id)
+                symbols = self.listed_symbols(exchange)
+                if not symbols:
+                    logger.error(
+                        "%s not listed on %s", ", ".join(self.symbols), exchange_id
+                    )
+                    return
+                # ccxt.pro subscribes all symbols on the exchange's one websocket
+                tasks = [
+                    asyncio.create_task(self.watch(exchange, symbol, on_price))
+                    for symbol in symbols
+                ]
+                try:
+                    await asyncio.gather(*tasks)
+                finally:
+                    for task in tasks:
+                        task.cancel()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(
+                    "Stream from %s dropped, polling instead %s", exchange_id, e
+                )
+
+            retry_at = time.monotonic() + STREAM_RETRY_INTERVAL
+            while time.monotonic() < retry_at:
+                latency = await self.poll_once(exchange_id, on_price)
+                await asyncio.sleep(max(POLL_INTERVAL - latency, 0))
+
+    async def close(self):
+        for exchange in self.exchanges.values():
+            try:
+                await exchange.close()
+            except Exception as e:
+                logger.error("Error while closing %s %s", exchange.id, e)
+        self.exchanges.clear()
+        self.markets_loaded_at.clear()
+
+
+class PriceSource:
+    def __init__(self, exchange_id: str, price: float, timestamp: float, latency: float):
+        self.exchange_id = exchange_id
+        self.price = price
+        self.timestamp = timestamp
+        self.latency = latency
+
+    def __repr__(self):
+        return f"PriceSource({self.exchange_id}, {self.price}, {self.timestamp}, {self.latency})"
+
+
+def median(prices: List[float]) -> float:
+    return statistics.median(prices)
+
+
+def trimmed_mean(prices: List[float]) -> float:
+    # drop the highest and the lowest quote once there are enough of them
+    prices = sorted(prices)
+    if len(prices) > 2:
+        prices = prices[1:-1]
+    return sum(prices) / len(prices)
+
+
+AGGREGATORS = {
+    "median": median,
+    "trimmed_mean": trimmed_mean,
+}
 
 
-async def fetch_ton_usdt_prices():
-    tasks = [fetch_price_from_exchange(exchange) for exchange in EXCHANGE_LIST]
-    prices = await asyncio.gather(*tasks)
-    return [price for price in prices if price is not None]
+class PriceChannel:
+    """
+    Hands the latest aggregated price of `symbol` from the feed to the bot.
+    Within one process this is a plain attribute read; with USE_REDIS the
+    price is also mirrored to redis, and read back from there by processes
+    that do not run the feed themselves. Subscribed triggers are notified
+    whenever the price changes.
+    """
 
+    def __init__(self, symbol: str = DEFAULT_SYMBOL):
+        self.symbol = symbol
+        # "ton_usdt_price" and "ton_usdt_price_timestamp" for TON/USDT
+        self.key = f"{symbol.lower().replace('/', '_')}_price"
+        self.latest: Optional[Tuple[float, float]] = None
+        self.triggers: List[Trigger] = []
+        self._tasks: Set[asyncio.Task] = set()
 
-async def set_ton_usdt_prices():
-    while True:
-        await asyncio.sleep(3)
-        prices = await fetch_ton_usdt_prices()
-        if prices:
-            price = sum(prices) / len(prices)
-            redis_client.set("ton_usdt_price", price)
-        else:
-            continue
+    def subscribe(self, trigger: Trigger):
+        self.triggers.append(trigger)
 
+    def notify(self, reason: str):
+        for trigger in self.triggers:
+            trigger.notify(reason)
 
-async def get_ton_usdt_price():
-    price = redis_client.get("ton_usdt_price")
-    if isinstance(price, str):
-        price = float(price)
-        return price
-    else:  # price is None
+    def publish(self, price: float, timestamp: float):
+        self.latest = (price, timestamp)
+        recorder.record("price", price=price, symbol=self.symbol)
+        if redis_client is None:
+            return
+        task = asyncio.get_running_loop().create_task(
+            self._mirror(price, timestamp)
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _mirror(self, price: float, timestamp: float):
+        try:
+            await redis_client.mset(
+                {self.key: price, f"{self.key}_timestamp": timestamp}
+            )
+        except Exception as e:
+            logger.error("Error while publishing price to redis %s", e, extra=sampled())
+
+    async def get(self) -> Optional[Tuple[float, float]]:
+        if self.latest is not None or redis_client is None:
+            return self.latest
+        price, timestamp = await redis_client.mget(self.key, f"{self.key}_timestamp")
+        if isinstance(price, str) and isinstance(timestamp, str):
+            return float(price), float(timestamp)
         return None
 
 
+price_channels: Dict[str, PriceChannel] = {}
+
+
+def get_price_channel(symbol: str = DEFAULT_SYMBOL) -> PriceChannel:
+    channel = price_channels.get(symbol)
+    if channel is None:
+        channel = price_channels[symbol] = PriceChannel(symbol)
+    return channel
+
+
+class PriceAggregator:
+    """
+    Holds the latest quote of `symbol` from every exchange and publishes the
+    aggregate the moment any of them updates. Quotes older than
+    SOURCE_MAX_AGE seconds are left out of the aggregate.
+    """
+
+    def __init__(self, symbol: str = DEFAULT_SYMBOL, method: str = PRICE_AGGREGATION):
+        assert method in AGGREGATORS, f"unknown price aggregation {method}"
+        self.aggregate = AGGREGATORS[method]
+        self.channel = get_price_channel(symbol)
+        self.sources: Dict[str, PriceSource] = {}
+        self.last_price: Optional[float] = None
+
+    def source_ages(self) -> Dict[Tuple[str, ...], float]:
+        now = time.time()
+        return {
+            (source.exchange_id,): now - source.timestamp
+            for source in self.sources.values()
+        }
+
+    def fresh_sources(self, now: float) -> List[PriceSource]:
+        return [
+            source
+            for source in self.sources.values()
+            if now - source.timestamp <= SOURCE_MAX_AGE
+        ]
+
+    def on_price(self, exchange_id: str, price: float, latency: float = 0):
+        now = time.time()
+        self.sources[exchange_id] = PriceSource(exchange_id, price, now, latency)
+        price_fetch_seconds.observe(latency, exchange=exchange_id)
+        sources = self.fresh_sources(now)
+        price = self.aggregate([source.price for source in sources])
+        self.publish(price, now)
+
+    def publish(self, price: float, timestamp: float):
+        self.channel.publish(price, timestamp)
+        if price != self.last_price:
+            self.last_price = price
+            self.channel.notify("price")
+
+
+async def set_prices(
+    symbols: Sequence[str] = (DEFAULT_SYMBOL,),
+    streaming: bool = PRICE_FEED_MODE == "stream",
+):
+    """Feeds the price channels of all `symbols` from one set of exchange clients."""
+    feed = PriceFeed(symbols=symbols, streaming=streaming)
+    aggregators = {symbol: PriceAggregator(symbol) for symbol in feed.symbols}
+
+    def on_price(exchange_id: str, symbol: str, price: float, latency: float):
+        aggregators[symbol].on_price(exchange_id, price, latency)
+
+    def source_ages() -> Dict[Tuple[str, ...], float]:
+        return {
+            (symbol, *labels): age
+            for symbol, aggregator in aggregators.items()
+            for labels, age in aggregator.source_ages().items()
+        }
+
+    price_source_age_seconds.set_function(source_ages)
+    follow = feed.stream if streaming else feed.poll
+    try:
+        tasks = [follow(exchange, on_price) for exchange in feed.exchange_ids]
+        await asyncio.gather(*tasks)
+    finally:
+        await feed.close()
+
+
+async def set_ton_usdt_prices(streaming: bool = PRICE_FEED_MODE == "stream"):
+    await set_prices([DEFAULT_SYMBOL], streaming)
+
+
+async def get_price(
+    symbol: str = DEFAULT_SYMBOL,
+) -> Tuple[Optional[float], Optional[float]]:
+    """
+    Returns the aggregated price of `symbol` and its age in seconds, or
+    (None, None) if no price was published yet.
+    """
+    latest = await get_price_channel(symbol).get()
+    if latest is None:
+        return None, None
+    price, timestamp = latest
+    return price, max(time.time() - timestamp, 0)
+
+
+async def get_ton_usdt_price() -> Tuple[Optional[float], Optional[float]]:
+    return await get_price(DEFAULT_SYMBOL)
+
+
 if __name__ == "__main__":
-    asyncio.run(set_ton_usdt_prices())
+    from oracles import ORACLE_PAIRS
+
+    asyncio.run(set_prices([symbol for _, symbol in ORACLE_PAIRS]))
@@ -0,0 +1,276 @@
+import asyncio
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+from log import get_logger
+
+load_dotenv()
+
+logger = get_logger(__name__)
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# 0 disables the endpoint
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))
+# sent winds and rings without a matching event are dropped after this time
+CONFIRMATION_TIMEOUT = 600
+
+# seconds, from a millisecond up to a minute
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+Labels = Tuple[str, ...]
+
+
+def format_labels(names: Sequence[str], values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """
+    Base of the metrics below. Metrics may be updated from any thread (the
+    database is queried from the pool's threads) and are rendered in the
+    Prometheus text format.
+    """
+
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Labels:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def get(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    """
+    A value that goes up and down. Instead of being set, the values can
+    also be computed at scrape time by a function given to `set_function`.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._function: Optional[Callable[[], Dict[Labels, float]]] = None
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], Dict[Labels, float]]):
+        self._function = function
+
+    def render(self) -> List[str]:
+        if self._function is not None:
+            try:
+                values = self._function()
+            except Exception as e:
+                logger.error("Error in gauge %s %s", self.name, e)
+                values = {}
+            with self._lock:
+                self._values = dict(values)
+        return super().render()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: (counts per bucket plus +Inf, sum)
+        self._values: Dict[Labels, Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            value = self._values.get(self._key(labels))
+            return sum(value[0]) if value is not None else 0
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            values = sorted((key, list(counts), total) for key, (counts, total) in self._values.items())
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = format_labels(self.labelnames, key, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+registry: List[Metric] = []
+
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+price_fetch_seconds = Histogram(
+    "price_fetch_seconds",
+    "Time from requesting (poll) or quoting (stream) a price to receiving it",
+    ["exchange"],
+)
+price_source_age_seconds = Gauge(
+    "price_source_age_seconds",
+    "Age of the latest quote per pair and exchange",
+    ["symbol", "exchange"],
+)
+evaluation_seconds = Histogram(
+    "evaluation_seconds", "Duration of one bot.main evaluation"
+)
+db_query_seconds = Histogram(
+    "db_query_seconds", "Duration of a MariaDB call including the commit", ["query"]
+)
+estimate_seconds = Histogram(
+    "estimate_seconds",
+    "Duration of the chain calls behind a wind estimate",
+    ["call"],
+)
+confirmation_seconds = Histogram(
+    "confirmation_seconds",
+    "Time from sending a wind or ring to its event in the subscriber",
+    ["action"],
+)
+rate_limit_wait_seconds = Histogram(
+    "rate_limit_wait_seconds",
+    "Time a toncenter request waited for the shared rate limit",
+    ["lane"],
+)
+rate_limit_throttled_total = Counter(
+    "rate_limit_throttled_total", "toncenter responses with status 429"
+)
+alarms_total = Counter(
+    "alarms_total",
+    "Alarms per oracle and stage: profitable, selected, leased by another worker,"
+    " unfunded after another oracle's winds, sent, captured by us, lost to others",
+    ["oracle", "stage"],
+)
+
+
+class ConfirmationTracker:
+    """
+    Correlates the winds and rings we send with the events the subscriber
+    sees for the same alarm, and records the time in between. Every oracle
+    numbers its alarms from 0, so they are told apart by the oracle's raw
+    address.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sent: Dict[Tuple[str, str, int], float] = {}
+
+    def sent(self, action: str, oracle: str, alarm_id: int):
+        now = time.monotonic()
+        with self._lock:
+            for key, sent_at in list(self._sent.items()):
+                if now - sent_at > CONFIRMATION_TIMEOUT:
+                    del self._sent[key]
+            self._sent[(action, oracle, alarm_id)] = now
+
+    def confirmed(
+        self, action: str, oracle: str, alarm_id: int, ours: bool = True
+    ) -> bool:
+        """Returns True if the event belongs to something we sent."""
+        with self._lock:
+            sent_at = self._sent.pop((action, oracle, alarm_id), None)
+        if sent_at is None:
+            return False
+        if ours:
+            confirmation_seconds.observe(time.monotonic() - sent_at, action=action)
+        return True
+
+
+confirmations = ConfirmationTracker()
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain")
+
+
+async def serve(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    """Serves GET /metrics until cancelled."""
+    if port == 0:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+        logger.info("Serving metrics on http://%s:%d/metrics", host, port)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
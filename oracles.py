@@ -0,0 +1,132 @@
+import hashlib
+import os
+from typing import List, Optional, Tuple
+
+from dotenv import load_dotenv
+from pytoncenter import AsyncTonCenterClientV3, get_client
+from pytoncenter.address import Address as PyAddress
+from ticton import TicTonAsyncClient
+
+from alarm_store import AlarmStore
+from events import Signal, Trigger
+from market_price import DEFAULT_SYMBOL
+from mariadb_connector import AlarmTables
+from rate_limiter import QPS, rate_limiter
+from sharding import ALARM_LEASE_PREFIX, AlarmLeases, alarm_leases
+
+from log import get_logger
+
+load_dotenv()
+
+logger = get_logger(__name__)
+
+# oracles served by one runtime with the pair each one quotes, e.g.
+# "kQC...=TON/USDT,kQD...=TON/USDC"; by default TICTON_ORACLE_ADDRESS in TON/USDT
+ORACLES = os.getenv("ORACLES", "")
+
+
+def parse_oracles(value: str) -> List[Tuple[str, str]]:
+    """Returns the (address, symbol) pairs of an ORACLES value."""
+    pairs = []
+    for entry in value.split(","):
+        address, _, symbol = entry.strip().partition("=")
+        if address:
+            pairs.append((address.strip(), symbol.strip() or DEFAULT_SYMBOL))
+    return pairs
+
+
+ORACLE_PAIRS = parse_oracles(ORACLES) or [
+    (os.getenv("TICTON_ORACLE_ADDRESS", ""), DEFAULT_SYMBOL)
+]
+
+
+class Oracle:
+    """
+    What one oracle of the runtime keeps to itself: its pair, alarm tables,
+    alarm store, evaluation trigger and alarm leases. The exchange clients,
+    the toncenter client with its rate limit, the wallet and the balance
+    ledger are shared by all oracles.
+
+    The first oracle keeps the table names, checkpoint and lease keys of a
+    single oracle setup. The others get a suffix derived from their
+    address, so their tables stay the same when the list is reordered
+    behind the first one.
+    """
+
+    def __init__(self, address: str, symbol: str = DEFAULT_SYMBOL, first: bool = True):
+        self.address = address
+        self.raw_address = PyAddress(address).to_string(False)
+        self.symbol = symbol
+        self.first = first
+        self.suffix = (
+            "" if first else "_" + hashlib.sha1(self.raw_address.encode()).hexdigest()[:8]
+        )
+        self.tables = AlarmTables(self.suffix)
+        # wakes up the evaluation loop in bot.main on new prices and alarm changes
+        self.trigger = Trigger()
+        # set once the alarm table caught up with the chain and the subscriber is live
+        self.ready = Signal()
+        self.store = AlarmStore(self.tables, self.trigger)
+        self.leases = (
+            alarm_leases
+            if first
+            else AlarmLeases(
+                alarm_leases.redis_client,
+                prefix=f"{ALARM_LEASE_PREFIX}{self.suffix[1:]}:",
+            )
+        )
+        self.client: Optional[TicTonAsyncClient] = None
+
+    async def connect(
+        self, toncenter: Optional[AsyncTonCenterClientV3] = None
+    ) -> TicTonAsyncClient:
+        """
+        Creates the oracle's client on `toncenter`, pass the toncenter client
+        of another oracle to share its session and request budget.
+        """
+        if toncenter is None:
+            toncenter = get_client(
+                version="v3",
+                network="testnet",
+                api_key=os.getenv("TICTON_TONCENTER_API_KEY"),
+                qps=QPS,
+            )
+        # TicTonAsyncClient.init would prefer TICTON_ORACLE_ADDRESS to any address
+        metadata = await TicTonAsyncClient.get_oracle_metadata(toncenter, self.address)
+        self.client = TicTonAsyncClient(
+            metadata=metadata,
+            toncenter=toncenter,
+            oracle_addr=self.address,
+            mnemonics=os.getenv("TICTON_WALLET_MNEMONICS"),
+            wallet_version=os.getenv("TICTON_WALLET_VERSION", "v4r2"),  # type: ignore
+            threshold_price=float(os.getenv("TICTON_THRESHOLD_PRICE", 0.01)),
+            logger=get_logger("ticton"),
+        )
+        rate_limiter.install(self.client)
+        logger.info(
+            "Serving oracle %s in %s on %s", self.address, self.symbol, self.tables
+        )
+        return self.client
+
+    def __repr__(self):
+        return f"Oracle({self.address}, {self.symbol})"
+
+
+_oracles: Optional[List[Oracle]] = None
+
+
+def configured_oracles() -> List[Oracle]:
+    """
+    The oracles of ORACLE_PAIRS, created once, so everything started in the
+    process (e.g. bot.main and subscriber.subscribe on their own) shares
+    each oracle's store and ready signal.
+    """
+    global _oracles
+    if _oracles is None:
+        addresses = [PyAddress(address).to_string(False) for address, _ in ORACLE_PAIRS]
+        assert len(set(addresses)) == len(addresses), "ORACLES lists an oracle twice"
+        _oracles = [
+            Oracle(address, symbol, first=index == 0)
+            for index, (address, symbol) in enumerate(ORACLE_PAIRS)
+        ]
+    return _oracles
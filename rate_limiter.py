@@ -0,0 +1,193 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, List, Optional, Tuple
+
+import redis.asyncio as redis
+from dotenv import load_dotenv
+from ticton import TicTonAsyncClient
+
+from metrics import rate_limit_throttled_total, rate_limit_wait_seconds
+
+from log import get_logger, sampled
+
+load_dotenv()
+
+logger = get_logger(__name__)
+
+# toncenter requests per second of the API key, shared by all clients
+QPS = int(os.getenv("QPS", 9))
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+REDIS_DB = int(os.getenv("REDIS_DB", 0))
+# share the budget with other processes using the same API key through redis
+RATE_LIMIT_REDIS = os.getenv("RATE_LIMIT_REDIS", "false").lower() == "true"
+RATE_LIMIT_KEY = "ticton:toncenter:bucket"
+
+# most urgent first, a free request always goes to the most urgent waiter
+LANES = ("wind", "estimate", "ring", "background")
+# after a 429 the rate is halved, then grows back by this much per second
+RATE_RECOVERY_PER_SECOND = 0.1
+MIN_RATE = 0.5
+
+# token bucket shared through redis, refilled with the caller's rate on the
+# redis clock; returns the seconds to wait, 0 if a token was taken
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens') or burst)
+local updated = tonumber(redis.call('HGET', KEYS[1], 'updated') or now)
+tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], 60)
+return tostring(wait)
+"""
+
+_lane: ContextVar[str] = ContextVar("rate_limit_lane", default="background")
+
+
+@contextmanager
+def request_lane(lane: str) -> Iterator[None]:
+    """Runs the toncenter requests made inside the block in `lane`."""
+    assert lane in LANES, f"unknown lane {lane}"
+    token = _lane.set(lane)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+def is_throttled(error: BaseException) -> bool:
+    # TonCenterException carries the status as code, aiohttp errors as status
+    return getattr(error, "code", None) == 429 or getattr(error, "status", None) == 429
+
+
+class RateLimiter:
+    """
+    One token bucket for every toncenter request of the process. It replaces
+    the limiter of each client's toncenter requestor (see `install`), so the
+    bot, the subscriber and the backfill draw from the same budget.
+
+    Requests wait in priority lanes set with `request_lane`, and whenever a
+    token frees up it goes to the oldest waiter of the most urgent lane. A
+    429 halves the rate and empties the bucket. The rate then grows back by
+    RATE_RECOVERY_PER_SECOND up to `qps`. With a redis client, the bucket
+    lives in redis and is shared with other processes. Lanes are only
+    ordered within a process, and the local bucket takes over while redis
+    is unreachable.
+    """
+
+    def __init__(
+        self,
+        qps: float = QPS,
+        redis_client: Optional[redis.Redis] = None,
+        key: str = RATE_LIMIT_KEY,
+    ):
+        self.qps = qps
+        self.rate = float(qps)
+        self.burst = max(float(qps), 1.0)
+        self.redis_client = redis_client
+        self.key = key
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._take_script = None
+
+    def install(self, client: TicTonAsyncClient):
+        client.toncenter.limiter = self
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self.rate = min(float(self.qps), self.rate + elapsed * RATE_RECOVERY_PER_SECOND)
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+
+    def _take_local(self) -> float:
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    async def _take(self) -> float:
+        """Takes a token, or returns the seconds until one is available."""
+        if self.redis_client is None:
+            return self._take_local()
+        self._refill()
+        try:
+            if self._take_script is None:
+                self._take_script = self.redis_client.register_script(TAKE_SCRIPT)
+            return float(await self._take_script(keys=[self.key], args=[self.rate, self.burst]))
+        except Exception as e:
+            logger.error(
+                "Error in redis rate limit, using the local bucket %s", e, extra=sampled()
+            )
+            return self._take_local()
+
+    def throttled(self):
+        self._refill()
+        self.rate = max(MIN_RATE, self.rate / 2)
+        self._tokens = 0.0
+        rate_limit_throttled_total.inc()
+        logger.info("Throttled by toncenter, rate lowered to %.2f/s", self.rate)
+
+    async def acquire(self):
+        lane = _lane.get()
+        started = time.monotonic()
+        if not self._waiters and await self._take() == 0:
+            rate_limit_wait_seconds.observe(0.0, lane=lane)
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (LANES.index(lane), next(self._sequence), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+        rate_limit_wait_seconds.observe(time.monotonic() - started, lane=lane)
+
+    async def _dispatch(self):
+        while True:
+            # waiters that were cancelled meanwhile do not get a token
+            while self._waiters and self._waiters[0][2].done():
+                heapq.heappop(self._waiters)
+            if not self._waiters:
+                return
+            wait = await self._take()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc is not None and is_throttled(exc):
+            self.throttled()
+        return False
+
+
+rate_limiter = RateLimiter(
+    redis_client=(
+        redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+        if RATE_LIMIT_REDIS
+        else None
+    )
+)
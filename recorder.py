@@ -0,0 +1,106 @@
+import atexit
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+import zlib
+from typing import Iterator, Optional
+
+from dotenv import load_dotenv
+
+from log import get_logger
+
+load_dotenv()
+
+logger = get_logger(__name__)
+
+# append subscriber events and prices to this file, e.g. record.jsonl.gz
+RECORD_PATH = os.getenv("RECORD_PATH", "")
+RECORD_FLUSH_INTERVAL = 5.0
+
+
+class Recorder:
+    """
+    Appends what the bot sees to a gzipped JSON lines log, one object per
+    line with the wall clock time `t`, the kind `k` and the kind's fields:
+
+    - price: price, symbol
+    - tick: lt, id, price, created_at, watchmaker
+    - wind: lt, id, remain_scale, new_id, price, created_at, timekeeper
+    - ring: lt, id
+
+    `record` only queues the record. A writer thread serializes,
+    compresses and writes it, and flushes the log every
+    RECORD_FLUSH_INTERVAL seconds. `close` writes what is queued and ends
+    the gzip stream, it runs at exit. A recorder without a path does
+    nothing.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._queue: "queue.SimpleQueue[Optional[dict]]" = queue.SimpleQueue()
+        self._writer: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def record(self, kind: str, **fields):
+        if not self.path:
+            return
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(
+                        target=self._write, name="recorder", daemon=True
+                    )
+                    self._writer.start()
+        self._queue.put({"t": time.time(), "k": kind, **fields})
+
+    def _write(self):
+        try:
+            with gzip.open(self.path, "at") as f:
+                flushed_at = time.monotonic()
+                while True:
+                    try:
+                        entry = self._queue.get(timeout=RECORD_FLUSH_INTERVAL)
+                    except queue.Empty:
+                        entry = {}
+                    if entry is None:
+                        return
+                    if entry:
+                        f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+                    if time.monotonic() - flushed_at > RECORD_FLUSH_INTERVAL:
+                        f.flush()
+                        flushed_at = time.monotonic()
+        except Exception as e:
+            logger.error("Error while recording to %s %s", self.path, e)
+
+    def close(self):
+        with self._lock:
+            writer, self._writer = self._writer, None
+        if writer is not None:
+            self._queue.put(None)
+            writer.join()
+
+
+def read_log(path: str) -> Iterator[dict]:
+    """Yields the records of a log written by Recorder, in order."""
+    with gzip.open(path, "rt") as f:
+        try:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line of a log that was not closed may be cut off
+                    logger.error("Skipping a broken line in %s", path)
+        except (EOFError, zlib.error) as e:
+            # a log that was flushed but never closed has no end of stream
+            logger.error("Log %s ends early, %s", path, e)
+
+
+recorder = Recorder(RECORD_PATH)
+atexit.register(recorder.close)
@@ -0,0 +1,290 @@
+"""
+Replays a log written by recorder.Recorder through the decision path of
+bot.main, against FakeTicTonClient and a simulated wallet.
+
+Recorded alarms are applied to the fake chain as they happened, every
+recorded price runs one decision, and the chosen winds land after
+--latency seconds if the alarm still has the units by then. The replay
+runs as fast as possible, or with --speed 1 in real time. Only the prices
+of --symbol are replayed, logs of a multi oracle runtime hold the alarm
+events of its first oracle.
+
+    python replay.py record.jsonl.gz --threshold 0.5 --strategy greedy
+"""
+import argparse
+import asyncio
+import logging
+import time
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from fake_client import FakeTicTonClient
+from alarm_store import AlarmStore
+from market_price import DEFAULT_SYMBOL
+from mariadb_connector import Alarm
+from recorder import read_log
+
+# the log lines of the decision path would flood the replay output
+logging.disable(logging.INFO)
+
+from bot import STRATEGY, THRESHOLD_PRICE, decide
+from strategy import Balance, ProfitableAlarm, get_strategy
+from wind_estimator import WindEstimator
+
+# alarms opened by simulated winds, far above the recorded alarm ids
+SIMULATED_ALARM_ID_OFFSET = 10**9
+
+
+class PendingWind:
+    def __init__(self, alarm: ProfitableAlarm, price: float, lands_at: float):
+        self.alarm = alarm
+        self.price = price
+        self.lands_at = lands_at
+
+    def __repr__(self):
+        return f"PendingWind({self.alarm.id}, {self.price}, {self.lands_at})"
+
+
+class Backtest:
+    """
+    Keeps the alarms of the replayed log, the fake chain and the simulated
+    wallet in step, and counts what the strategy would have achieved.
+    """
+
+    def __init__(
+        self,
+        strategy: str = STRATEGY,
+        threshold: float = float(THRESHOLD_PRICE),
+        latency: float = 5.0,
+        confirm: bool = False,
+        base_asset_balance: Optional[int] = None,
+        quote_asset_balance: Optional[int] = None,
+        symbol: str = DEFAULT_SYMBOL,
+    ):
+        self.client = FakeTicTonClient()
+        if base_asset_balance is not None or quote_asset_balance is not None:
+            base_asset, quote_asset = self.client.balance
+            self.client.balance = (
+                Decimal(base_asset if base_asset_balance is None else base_asset_balance),
+                Decimal(quote_asset if quote_asset_balance is None else quote_asset_balance),
+            )
+        self.estimator = WindEstimator(self.client)
+        self.strategy = get_strategy(strategy)
+        self.threshold = threshold
+        self.latency = latency
+        self.confirm = confirm
+        self.symbol = symbol
+        self.alarms: Dict[int, Alarm] = {}
+        # selects and sizes the candidates like the live bot
+        self.store = AlarmStore()
+        self.store.reset([])
+        self.store.add_listener(self.estimator.on_alarm_change)
+        self.estimator.add_listener(self.store.on_alarm_info)
+        self.pending: List[PendingWind] = []
+        self.next_alarm_id = SIMULATED_ALARM_ID_OFFSET
+        self.stats: Dict[str, float] = {
+            "prices": 0,
+            "decisions": 0,
+            "selected": 0,
+            "landed": 0,
+            "missed": 0,
+            "duplicates": 0,
+            "expected_profit": 0.0,
+        }
+        self.decision_seconds: List[float] = []
+        # alarms our own landed winds took units from
+        self.wound: Set[int] = set()
+
+    def apply(self, alarm: Alarm):
+        # same upsert rules as update_alarm_to_db
+        current = self.alarms.get(alarm.id)
+        if current is None and not alarm.price:
+            # changes an alarm that was opened before the log started
+            return
+        # evicts the alarm's metadata from the estimator
+        self.store.apply([alarm])
+        if current is not None:
+            current.state = alarm.state
+            current.remain_scale = alarm.remain_scale
+            alarm = current
+        else:
+            self.alarms[alarm.id] = alarm
+        if alarm.state != "active" or alarm.remain_scale <= 0:
+            del self.alarms[alarm.id]
+            self.client.close_alarm(alarm.id)
+        elif current is None:
+            self.client.add_alarm(
+                alarm.id, alarm.price, alarm.remain_scale, created_at=alarm.created_at
+            )
+        else:
+            self.client.update_alarm(alarm.id, alarm.remain_scale)
+
+    def on_record(self, record: dict):
+        kind = record["k"]
+        if kind == "tick":
+            self.apply(
+                Alarm(id=record["id"], price=record["price"], created_at=record["created_at"])
+            )
+        elif kind == "wind":
+            self.apply(Alarm(id=record["id"], remain_scale=record["remain_scale"]))
+            self.apply(
+                Alarm(
+                    id=record["new_id"],
+                    price=record["price"],
+                    created_at=record["created_at"],
+                )
+            )
+        elif kind == "ring":
+            self.apply(Alarm(id=record["id"], state="uninitialized"))
+
+    def land(self, now: float):
+        """Lands the simulated winds that are due by `now`."""
+        due = [wind for wind in self.pending if wind.lands_at <= now]
+        self.pending = [wind for wind in self.pending if wind.lands_at > now]
+        for wind in due:
+            alarm = self.alarms.get(wind.alarm.id)
+            need_base_asset = wind.alarm.need_base_asset
+            need_quote_asset = wind.alarm.need_quote_asset
+            base_asset, quote_asset = self.client.balance
+            if (
+                alarm is None
+                or alarm.remain_scale < wind.alarm.buy_num
+                or base_asset < need_base_asset
+                or quote_asset < need_quote_asset
+            ):
+                if wind.alarm.id in self.wound:
+                    # chosen again while our earlier wind was in flight
+                    self.stats["duplicates"] += 1
+                else:
+                    # someone else was faster, or the wallet ran dry meanwhile
+                    self.stats["missed"] += 1
+                continue
+            self.client.balance = (
+                base_asset - need_base_asset,
+                quote_asset - need_quote_asset,
+            )
+            self.apply(Alarm(id=alarm.id, remain_scale=alarm.remain_scale - wind.alarm.buy_num))
+            self.apply(
+                Alarm(
+                    id=self.next_alarm_id,
+                    price=wind.price,
+                    created_at=int(wind.lands_at),
+                    is_mine=True,
+                    remain_scale=2 * wind.alarm.buy_num,
+                )
+            )
+            self.next_alarm_id += 1
+            self.wound.add(alarm.id)
+            self.stats["landed"] += 1
+            self.stats["expected_profit"] += wind.alarm.except_profit
+
+    async def on_price(self, price: float, now: float):
+        self.stats["prices"] += 1
+        if not self.alarms:
+            return
+        new_price = round(price, 9)
+        started = time.perf_counter()
+        new_price_raw = int((await self.client._convert_price(new_price)).raw_value)
+        base_asset, quote_asset = await self.client._get_user_balance(None)
+        # winds in flight still hold their assets
+        for wind in self.pending:
+            base_asset -= wind.alarm.need_base_asset
+            quote_asset -= wind.alarm.need_quote_asset
+        base_asset, quote_asset = max(base_asset, 0), max(quote_asset, 0)
+        candidates, _ = self.store.find_candidates(new_price, self.threshold)
+        # like bot.main, alarms with a wind in flight are not chosen again
+        in_flight = {wind.alarm.id for wind in self.pending}
+        candidates = [candidate for candidate in candidates if candidate[0].id not in in_flight]
+        max_buy_nums = self.store.max_buy_nums(
+            [alarm.id for alarm, _ in candidates],
+            new_price,
+            int(base_asset),
+            self.client.metadata.min_base_asset_threshold,
+        )
+        selected_alarms = await decide(
+            self.estimator,
+            self.strategy,
+            candidates,
+            new_price_raw,
+            Balance(base_asset, quote_asset),
+            self.confirm,
+            max_buy_nums,
+        )
+        self.decision_seconds.append(time.perf_counter() - started)
+        self.stats["decisions"] += 1
+        self.stats["selected"] += len(selected_alarms)
+        for alarm in selected_alarms:
+            self.pending.append(PendingWind(alarm, new_price, now + self.latency))
+
+    async def run(self, records: Iterable[dict], speed: float = 0):
+        """
+        Replays `records`; with `speed` > 0 the recorded gaps are waited for,
+        divided by `speed`.
+        """
+        started = time.monotonic()
+        first_t: Optional[float] = None
+        last_t = 0.0
+        for record in records:
+            now = record["t"]
+            if first_t is None:
+                first_t = now
+            if speed > 0:
+                delay = (now - first_t) / speed - (time.monotonic() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self.land(now)
+            if record["k"] == "price":
+                # logs written before there were several pairs have no symbol
+                if record.get("symbol", DEFAULT_SYMBOL) == self.symbol:
+                    await self.on_price(record["price"], now)
+            else:
+                self.on_record(record)
+            last_t = now
+        self.land(float("inf") if last_t else 0)
+
+    def report(self) -> List[Tuple[str, str]]:
+        decision_seconds = sorted(self.decision_seconds)
+        rows = [(name, f"{value:g}") for name, value in self.stats.items()]
+        if decision_seconds:
+            p50 = decision_seconds[len(decision_seconds) // 2]
+            p99 = decision_seconds[min(int(len(decision_seconds) * 0.99), len(decision_seconds) - 1)]
+            rows.append(("decision_p50_ms", f"{p50 * 1000:.3f}"))
+            rows.append(("decision_p99_ms", f"{p99 * 1000:.3f}"))
+        base_asset, quote_asset = self.client.balance
+        rows.append(("base_asset_balance", str(int(base_asset))))
+        rows.append(("quote_asset_balance", str(int(quote_asset))))
+        rows.append(("open_alarms", str(len(self.alarms))))
+        return rows
+
+
+async def main(args: argparse.Namespace):
+    backtest = Backtest(
+        strategy=args.strategy,
+        threshold=args.threshold,
+        latency=args.latency,
+        confirm=args.confirm,
+        base_asset_balance=args.base_asset_balance,
+        quote_asset_balance=args.quote_asset_balance,
+        symbol=args.symbol,
+    )
+    await backtest.run(read_log(args.log), args.speed)
+    for name, value in backtest.report():
+        print(f"{name:<22}{value:>20}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("log", help="log written with RECORD_PATH")
+    parser.add_argument("--strategy", default=STRATEGY)
+    parser.add_argument("--symbol", default=DEFAULT_SYMBOL, help="pair of the recorded oracle")
+    parser.add_argument("--threshold", type=float, default=float(THRESHOLD_PRICE))
+    parser.add_argument(
+        "--latency", type=float, default=5.0, help="seconds until a wind lands"
+    )
+    parser.add_argument(
+        "--speed", type=float, default=0, help="0 replays as fast as possible"
+    )
+    parser.add_argument("--confirm", action="store_true", help="confirm every wind estimate")
+    parser.add_argument("--base-asset-balance", type=int, help="in nanoTON")
+    parser.add_argument("--quote-asset-balance", type=int, help="in the quote asset's units")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,192 @@
+import asyncio
+import heapq
+import threading
+import time
+from typing import Dict, List, Set, Tuple
+
+from ticton import TicTonAsyncClient
+from tonsdk.boc import Cell, begin_cell
+
+from events import Trigger
+from mariadb_connector import Alarm
+from metrics import confirmations
+from rate_limiter import request_lane
+from submitter import MESSAGES_PER_EXTERNAL, WalletSender
+
+from log import get_logger
+
+logger = get_logger(__name__)
+
+# our alarms are rung once they are this old
+RING_DELAY = 60
+RING_GAS_FEE = int(0.35 * 10**9)
+# ring again if the ring event did not show up within this time
+RING_RETRY_INTERVAL = 60
+RING_MAX_ATTEMPTS = 3
+
+
+class RingScheduler:
+    """
+    Rings our own alarms in the background.
+
+    Alarms are kept in a heap ordered by the time they become eligible for a
+    ring, RING_DELAY seconds after creation, or right away once they deviate
+    from the market. Due alarms are rung through the shared WalletSender,
+    which sends them after any queued wind. An alarm stays scheduled (for a
+    retry) until the alarm store reports it closed, and is never rung twice
+    at the same time.
+    `schedule` and `on_alarm_change` may be called from any thread.
+    """
+
+    def __init__(self, client: TicTonAsyncClient, sender: WalletSender):
+        self.client = client
+        self.sender = sender
+        self._lock = threading.Lock()
+        self._heap: List[Tuple[float, int]] = []
+        self._due_at: Dict[int, float] = {}
+        self._attempts: Dict[int, int] = {}
+        self._in_flight: Set[int] = set()
+        # rung and waiting for the ring event, no earlier ring until then
+        self._hold_until: Dict[int, float] = {}
+        # closed while a ring for them was in flight, do not retry
+        self._closed: Set[int] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._trigger = Trigger()
+
+    def schedule(self, alarm_id: int, at: float):
+        with self._lock:
+            if alarm_id in self._in_flight:
+                return
+            at = max(at, self._hold_until.get(alarm_id, 0))
+            due_at = self._due_at.get(alarm_id)
+            if due_at is not None and due_at <= at:
+                return
+            # the old heap entry is skipped when popped
+            self._due_at[alarm_id] = at
+            heapq.heappush(self._heap, (at, alarm_id))
+        self._trigger.notify("ring")
+
+    def cancel(self, alarm_id: int):
+        with self._lock:
+            self._due_at.pop(alarm_id, None)
+            self._attempts.pop(alarm_id, None)
+            self._hold_until.pop(alarm_id, None)
+            if alarm_id in self._in_flight:
+                self._closed.add(alarm_id)
+
+    def schedule_alarm(self, alarm: Alarm):
+        self.schedule(alarm.id, alarm.created_at + RING_DELAY)
+
+    def on_alarm_change(self, alarm: Alarm):
+        if alarm.state != "active" or alarm.remain_scale <= 0:
+            self.cancel(alarm.id)
+        elif alarm.is_mine:
+            self.schedule_alarm(alarm)
+
+    def _pop_due(self, now: float) -> List[int]:
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                at, alarm_id = heapq.heappop(self._heap)
+                if self._due_at.get(alarm_id) != at:
+                    continue
+                del self._due_at[alarm_id]
+                self._in_flight.add(alarm_id)
+                due.append(alarm_id)
+        return due
+
+    def _next_due_in(self, now: float) -> float:
+        with self._lock:
+            if not self._heap:
+                return RING_RETRY_INTERVAL
+            return max(self._heap[0][0] - now, 0)
+
+    def build_ring_body(self, alarm_id: int) -> Cell:
+        # same message as TicTonAsyncClient.ring builds, query_id cannot be 0
+        return (
+            begin_cell()
+            .store_uint(0xC3510A29, 32)
+            .store_uint(1, 257)
+            .store_uint(alarm_id, 257)
+            .end_cell()
+        )
+
+    async def _is_active(self, alarm_id: int) -> bool:
+        alarm_address = await self.client.get_alarm_address(alarm_id)
+        return await self.client.get_address_state(alarm_address) == "active"
+
+    async def ring(self, alarm_ids: List[int]):
+        with request_lane("ring"):
+            await self._ring(alarm_ids)
+
+    async def _ring(self, alarm_ids: List[int]):
+        try:
+            states = await asyncio.gather(
+                *[self._is_active(alarm_id) for alarm_id in alarm_ids],
+                return_exceptions=True,
+            )
+            ringable = []
+            for alarm_id, active in zip(alarm_ids, states):
+                if active is False:
+                    logger.info("Ring: alarm %d is not exist", alarm_id)
+                    with self._lock:
+                        self._closed.add(alarm_id)
+                else:
+                    ringable.append(alarm_id)
+            if not ringable:
+                return
+
+            # one request per ring, so the sender can fit single rings into
+            # the room a wind batch leaves
+            seqnos = await asyncio.gather(
+                *[
+                    self.sender.send(
+                        [
+                            (
+                                self.client.oracle.to_string(),
+                                RING_GAS_FEE,
+                                self.build_ring_body(alarm_id),
+                            )
+                        ],
+                        "ring",
+                    )
+                    for alarm_id in ringable
+                ],
+                return_exceptions=True,
+            )
+            hold_until = time.time() + RING_RETRY_INTERVAL
+            for alarm_id, seqno in zip(ringable, seqnos):
+                if isinstance(seqno, BaseException):
+                    logger.error("Error in ring %d %s", alarm_id, seqno)
+                    continue
+                logger.info("Ring message sent, alarm id: %d, seqno: %d", alarm_id, seqno)
+                with self._lock:
+                    self._hold_until[alarm_id] = hold_until
+                confirmations.sent("ring", self.client.oracle.to_string(False), alarm_id)
+        finally:
+            retry_at = time.time() + RING_RETRY_INTERVAL
+            for alarm_id in alarm_ids:
+                with self._lock:
+                    self._in_flight.discard(alarm_id)
+                    if alarm_id in self._closed:
+                        self._closed.discard(alarm_id)
+                        continue
+                    attempts = self._attempts.get(alarm_id, 0) + 1
+                    self._attempts[alarm_id] = attempts
+                if attempts < RING_MAX_ATTEMPTS:
+                    self.schedule(alarm_id, retry_at)
+                else:
+                    self.cancel(alarm_id)
+
+    async def run(self):
+        self._trigger.bind()
+        while True:
+            now = time.time()
+            due = self._pop_due(now)
+            for index in range(0, len(due), MESSAGES_PER_EXTERNAL):
+                task = asyncio.create_task(
+                    self.ring(due[index : index + MESSAGES_PER_EXTERNAL])
+                )
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            await self._trigger.wait(max_staleness=self._next_due_in(time.time()))
@@ -0,0 +1,101 @@
+import os
+import socket
+from typing import List, Optional, Set, Tuple
+
+import redis.asyncio as redis
+from dotenv import load_dotenv
+
+from log import get_logger
+
+load_dotenv()
+
+logger = get_logger(__name__)
+
+# this worker winds the alarms with id % WORKER_COUNT == WORKER_INDEX
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", 0))
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", 1))
+SHARD: Tuple[int, int] = (WORKER_INDEX, WORKER_COUNT)
+# only the first worker backfills and writes the alarm table
+DB_WRITER = WORKER_INDEX == 0
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+REDIS_DB = int(os.getenv("REDIS_DB", 0))
+# lock every alarm in redis before winding it, on by default with several workers
+USE_ALARM_LEASES = (
+    os.getenv("USE_ALARM_LEASES", "true" if WORKER_COUNT > 1 else "false").lower()
+    == "true"
+)
+# long enough for the wind event to reach every worker
+ALARM_LEASE_SECONDS = 30
+ALARM_LEASE_PREFIX = "ticton:lease:"
+
+assert 0 <= WORKER_INDEX < WORKER_COUNT, "WORKER_INDEX must be below WORKER_COUNT"
+
+# deletes a lease only if this worker still holds it
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class AlarmLeases:
+    """
+    Short-lived locks on single alarms, so two workers never wind the same
+    alarm, e.g. while the shards are being changed. A lease is taken right
+    before a wind is sent and simply expires after ALARM_LEASE_SECONDS; it
+    is only released early if the send failed. Without a redis client every
+    lease is granted, if redis is unreachable none is. Each oracle's alarm
+    ids get their own key `prefix`.
+    """
+
+    def __init__(
+        self,
+        redis_client: Optional[redis.Redis] = None,
+        owner: str = f"{socket.gethostname()}:{os.getpid()}:{WORKER_INDEX}",
+        ttl: float = ALARM_LEASE_SECONDS,
+        prefix: str = ALARM_LEASE_PREFIX,
+    ):
+        self.redis_client = redis_client
+        self.owner = owner
+        self.ttl = ttl
+        self.prefix = prefix
+        self._release_script = None
+
+    def key(self, alarm_id: int) -> str:
+        return f"{self.prefix}{alarm_id}"
+
+    async def acquire(self, alarm_ids: List[int]) -> Set[int]:
+        """Returns the ids of `alarm_ids` this worker now holds a lease on."""
+        if self.redis_client is None or not alarm_ids:
+            return set(alarm_ids)
+        try:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for alarm_id in alarm_ids:
+                    pipe.set(self.key(alarm_id), self.owner, nx=True, px=int(self.ttl * 1000))
+                granted = await pipe.execute()
+        except Exception as e:
+            logger.error("Error while leasing alarms %s %s", alarm_ids, e)
+            return set()
+        return {alarm_id for alarm_id, ok in zip(alarm_ids, granted) if ok}
+
+    async def release(self, alarm_ids: List[int]):
+        if self.redis_client is None or not alarm_ids:
+            return
+        try:
+            if self._release_script is None:
+                self._release_script = self.redis_client.register_script(RELEASE_SCRIPT)
+            for alarm_id in alarm_ids:
+                await self._release_script(keys=[self.key(alarm_id)], args=[self.owner])
+        except Exception as e:
+            logger.error("Error while releasing alarm leases %s %s", alarm_ids, e)
+
+
+alarm_leases = AlarmLeases(
+    redis.StrictRedis(
+        host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True
+    )
+    if USE_ALARM_LEASES
+    else None
+)
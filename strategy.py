@@ -1,4 +1,5 @@
-from typing import List, Union
+import time
+from typing import AsyncIterator, Callable, Dict, List, Tuple, Union
 from decimal import Decimal
 
 
@@ -61,3 +62,116 @@ async def greedy_strategy(alarms: List[ProfitableAlarm], balance: Balance):
         else:
             return
     return
+
+
+class _Item:
+    __slots__ = ("alarm", "base", "quote", "profit", "max_num")
+
+    def __init__(self, alarm: ProfitableAlarm):
+        self.alarm = alarm
+        # ProfitableAlarm carries the totals for its buy_num, we need one unit
+        self.base = int(alarm.need_base_asset) // alarm.buy_num
+        self.quote = int(alarm.need_quote_asset) // alarm.buy_num
+        self.profit = alarm.price_delta
+        self.max_num = alarm.buy_num
+
+
+def _fill(
+    items: List[_Item], base_asset: int, quote_asset: int
+) -> Tuple[float, List[Tuple[_Item, int]]]:
+    """Takes as many units as still fit of every item, in the given order."""
+    profit = 0.0
+    picks = []
+    for item in items:
+        num = item.max_num
+        if item.base > 0:
+            num = min(num, base_asset // item.base)
+        if item.quote > 0:
+            num = min(num, quote_asset // item.quote)
+        if num <= 0:
+            continue
+        base_asset -= item.base * num
+        quote_asset -= item.quote * num
+        profit += item.profit * num
+        picks.append((item, num))
+    return profit, picks
+
+
+# weight of the base asset in the combined cost of a unit, tried in order
+_BASE_WEIGHTS = [0.5, 0.0, 1.0, 0.25, 0.75, 0.125, 0.375, 0.625, 0.875]
+
+
+async def knapsack_strategy(
+    alarms: List[ProfitableAlarm],
+    balance: Balance,
+    time_budget: float = 0.005,
+) -> AsyncIterator[ProfitableAlarm]:
+    """
+    Chooses how many units of every alarm to wind under both the base and
+    the quote asset balance, a two-constraint bounded knapsack. The name is
+    the problem, not the solver: this is a greedy heuristic, not an exact
+    DP, and it does not guarantee the maximal expected profit.
+
+    Every pass fills the balance in one order, taking as many units of each
+    alarm as still fit, and skipping an alarm that does not fit rather than
+    ending the search like greedy_strategy does. The first pass uses the
+    by-profit order of greedy_strategy. The others order by profit per unit
+    of combined cost, where the cost of a unit weighs its base and quote
+    asset against the respective balance, for several weightings. The best
+    allocation of the passes wins.
+
+    The first pass is always completed and takes every alarm
+    greedy_strategy takes, so the expected profit is never below that of
+    greedy_strategy. There is no bound relative to the optimum. Each pass
+    costs a sort of the alarms, and another one is only started if it is
+    expected to finish within `time_budget` seconds.
+    """
+    deadline = time.perf_counter() + time_budget
+    base_asset = int(balance.base_asset)
+    quote_asset = int(balance.quote_asset)
+    items = [_Item(alarm) for alarm in alarms if alarm.buy_num > 0]
+    items = [item for item in items if item.profit > 0]
+
+    orders = [lambda item: -item.profit * item.max_num]
+    for weight in _BASE_WEIGHTS:
+        base_cost = weight / max(base_asset, 1)
+        quote_cost = (1 - weight) / max(quote_asset, 1)
+        orders.append(
+            lambda item, base_cost=base_cost, quote_cost=quote_cost: -item.profit
+            / (item.base * base_cost + item.quote * quote_cost + 1e-18)
+        )
+
+    best_profit, best_picks = -1.0, []
+    pass_time = 0.0
+    for index, order in enumerate(orders):
+        started = time.perf_counter()
+        # only start another pass if it is expected to finish in time
+        if index > 0 and started + pass_time > deadline:
+            break
+        profit, picks = _fill(sorted(items, key=order), base_asset, quote_asset)
+        if profit > best_profit:
+            best_profit, best_picks = profit, picks
+        pass_time = max(pass_time, time.perf_counter() - started)
+
+    for item, num in best_picks:
+        need_base_asset = item.base * num
+        need_quote_asset = item.quote * num
+        await balance.update_balance(need_base_asset, need_quote_asset)
+        yield ProfitableAlarm(
+            id=item.alarm.id,
+            price_delta=item.alarm.price_delta,
+            need_base_asset=need_base_asset,
+            need_quote_asset=need_quote_asset,
+            buy_num=num,
+        )
+
+
+STRATEGIES: Dict[str, Callable[..., AsyncIterator[ProfitableAlarm]]] = {
+    "greedy": greedy_strategy,
+    "knapsack": knapsack_strategy,
+}
+
+
+def get_strategy(name: str) -> Callable[..., AsyncIterator[ProfitableAlarm]]:
+    assert name in STRATEGIES, f"unknown strategy {name}, expected one of {list(STRATEGIES)}"
+    return STRATEGIES[name]
@@ -0,0 +1,400 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from decimal import Decimal
+from typing import Dict, List, Optional, Set, Tuple
+
+from ticton import TicTonAsyncClient
+from pytoncenter.address import Address as PyAddress
+from pytoncenter.v3.models import (
+    ExternalMessage,
+    GetSpecifiedJettonWalletRequest,
+    GetWalletRequest,
+)
+from tonsdk.boc import Cell, begin_cell
+from tonsdk.contract import Contract
+from tonsdk.contract.wallet import SendModeEnum
+from tonsdk.utils import Address, bytes_to_b64str
+
+from balance_ledger import balance_ledger
+from mariadb_connector import Alarm
+from metrics import alarms_total, confirmations
+from rate_limiter import request_lane
+from sharding import AlarmLeases, alarm_leases
+from strategy import ProfitableAlarm
+
+from log import get_logger
+
+logger = get_logger(__name__)
+
+# wallet v3/v4 carry at most 4 outgoing messages per external message
+MESSAGES_PER_EXTERNAL = 4
+WIND_GAS_FEE = int(0.5 * 10**9)
+SEQNO_POLL_INTERVAL = 1.0
+# how long a sent message may take to show up as a new wallet seqno
+SEQNO_TIMEOUT = 30.0
+SEND_RETRIES = 3
+# a wound alarm is not chosen again until its wind event shows up, or this
+# long if it never does (the wind bounced)
+WIND_IN_FLIGHT_TIMEOUT = 60.0
+# queued sends go out in this order
+SEND_LANES = ("wind", "ring")
+
+
+class WindResult:
+    def __init__(
+        self,
+        alarm: ProfitableAlarm,
+        seqno: Optional[int] = None,
+        latency: Optional[float] = None,
+        error: Optional[Exception] = None,
+    ):
+        self.alarm = alarm
+        self.seqno = seqno
+        self.latency = latency
+        self.error = error
+
+    def __repr__(self):
+        return f"WindResult({self.alarm.id}, seqno={self.seqno}, latency={self.latency}, error={self.error})"
+
+
+# (destination, amount in nanoTON, body)
+OutMessage = Tuple[str, int, Cell]
+
+
+class SendRequest:
+    def __init__(
+        self, messages: List[OutMessage], lane: str, future: "asyncio.Future[int]"
+    ):
+        self.messages = messages
+        self.lane = lane
+        self.future = future
+
+
+class WalletSender:
+    """
+    Owns the seqno of our wallet. Everything this process sends from the
+    wallet should go through `send`, so two messages never race for the same
+    seqno.
+
+    The seqno is tracked locally. A message is only signed with the next
+    seqno once the previous one was seen on chain, since the wallet rejects
+    anything else. If a send fails, the same seqno is retried as long as the
+    chain has not moved past it; a re-sent message with the same seqno is
+    accepted at most once. If the chain did move past it, the message may
+    have landed after all and the send is given up instead of risking a
+    duplicate.
+
+    Requests are queued and sent by one task, which waits for the seqno
+    without holding anything up: the external message is only composed once
+    the seqno is free. It takes the queued requests in SEND_LANES order,
+    first come first within a lane, and packs as many whole requests as
+    fit into MESSAGES_PER_EXTERNAL messages. A wind queued behind a ring
+    goes first, and rings ride along in the room a wind batch leaves.
+    """
+
+    def __init__(self, client: TicTonAsyncClient):
+        client.assert_wallet_exists()
+        self.client = client
+        self.toncenter = client.toncenter
+        self.wallet = client.wallet
+        self.address = PyAddress(client.wallet.address.to_string())
+        self.seqno: Optional[int] = None
+        self.chain_seqno: Optional[int] = None
+        self._queue: List[Tuple[int, int, SendRequest]] = []
+        self._order = itertools.count()
+        self._queued = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def get_chain_seqno(self) -> int:
+        wallet_info = await self.toncenter.get_wallet(
+            GetWalletRequest(address=self.address)  # type: ignore
+        )
+        assert wallet_info.seqno is not None, "seqno is not found in wallet info"
+        self.chain_seqno = wallet_info.seqno
+        return wallet_info.seqno
+
+    async def wait_for_seqno(self, seqno: int) -> int:
+        deadline = time.monotonic() + SEQNO_TIMEOUT
+        chain_seqno = await self.get_chain_seqno()
+        while chain_seqno < seqno and time.monotonic() < deadline:
+            await asyncio.sleep(SEQNO_POLL_INTERVAL)
+            chain_seqno = await self.get_chain_seqno()
+        return chain_seqno
+
+    def sign(self, messages: List[OutMessage], seqno: int) -> str:
+        assert 0 < len(messages) <= MESSAGES_PER_EXTERNAL, "too many messages"
+        signing_message = self.wallet.create_signing_message(seqno)
+        for to_address, amount, body in messages:
+            header = Contract.create_internal_message_header(
+                Address(to_address), Decimal(amount)
+            )
+            order = Contract.create_common_msg_info(header, None, body)
+            signing_message.bits.write_uint8(
+                SendModeEnum.ignore_errors | SendModeEnum.pay_gas_separately
+            )
+            signing_message.refs.append(order)
+        query = self.wallet.create_external_message(signing_message, seqno)
+        return bytes_to_b64str(query["message"].to_boc(False))
+
+    async def send(self, messages: List[OutMessage], lane: str = "wind") -> int:
+        """
+        Sends up to MESSAGES_PER_EXTERNAL messages in one external message,
+        possibly together with other requests, and returns its seqno.
+        """
+        assert 0 < len(messages) <= MESSAGES_PER_EXTERNAL, "too many messages"
+        request = SendRequest(messages, lane, asyncio.get_running_loop().create_future())
+        heapq.heappush(
+            self._queue, (SEND_LANES.index(lane), next(self._order), request)
+        )
+        self._queued.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return await request.future
+
+    def _take(self) -> List[SendRequest]:
+        batch: List[SendRequest] = []
+        room = MESSAGES_PER_EXTERNAL
+        skipped = []
+        while self._queue:
+            entry = heapq.heappop(self._queue)
+            request = entry[2]
+            if request.future.done():
+                # the caller was cancelled
+                continue
+            if len(request.messages) <= room:
+                batch.append(request)
+                room -= len(request.messages)
+            else:
+                skipped.append(entry)
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+        return batch
+
+    async def _run(self):
+        while True:
+            if not self._queue:
+                self._queued.clear()
+                await self._queued.wait()
+            batch: List[SendRequest] = []
+            try:
+                seqno = await self._ready_seqno(self._queue[0][2].lane)
+                batch = self._take()
+                if not batch:
+                    continue
+                # requests for the batch count in the lane of its most urgent one
+                with request_lane(batch[0].lane):
+                    seqno = await self._send(batch, seqno)
+            except Exception as e:
+                # without a seqno the queued requests fail like the batch
+                for request in batch or self._take():
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_result(seqno)
+
+    async def _ready_seqno(self, lane: str) -> int:
+        """Waits until the chain reached our next seqno and returns it."""
+        with request_lane(lane):
+            if self.seqno is None:
+                self.seqno = await self.get_chain_seqno()
+            seqno = self.seqno
+            if self.chain_seqno is None or self.chain_seqno < seqno:
+                chain_seqno = await self.wait_for_seqno(seqno)
+                if chain_seqno < seqno:
+                    # the previous message never landed, its seqno is free again
+                    logger.error("Seqno %d was not used in time", chain_seqno)
+                    self.seqno = seqno = chain_seqno
+        return seqno
+
+    async def _send(self, batch: List[SendRequest], seqno: int) -> int:
+        messages = [message for request in batch for message in request.messages]
+        error: Optional[Exception] = None
+        for attempt in range(SEND_RETRIES):
+            if attempt:
+                seqno = await self._ready_seqno(batch[0].lane)
+            boc = self.sign(messages, seqno)
+            try:
+                await self.toncenter.send_message(ExternalMessage(boc=boc))
+            except Exception as e:
+                error = e
+                logger.error("Error in send with seqno %d %s", seqno, e)
+                if await self.get_chain_seqno() > seqno:
+                    self.seqno = self.chain_seqno
+                    raise
+                continue
+            self.seqno = seqno + 1
+            return seqno
+        assert error is not None
+        raise error
+
+
+class WindSubmitter:
+    """
+    Sends the winds chosen in one evaluation as fast as the wallet allows.
+
+    Up to MESSAGES_PER_EXTERNAL winds are signed into a single external
+    message and accepted together under one seqno, so a typical batch costs
+    one send. Larger batches follow in consecutive seqnos. Alarms another
+    worker holds a lease on are left out.
+
+    An alarm stays in flight from its send until the alarm store applies
+    the next change of it (see `on_alarm_change`), usually the event of our
+    wind, and the bot does not choose it again meanwhile. Until then the
+    store still shows the units the wind takes.
+    """
+
+    def __init__(
+        self,
+        client: TicTonAsyncClient,
+        sender: WalletSender,
+        leases: AlarmLeases = alarm_leases,
+    ):
+        self.client = client
+        self.sender = sender
+        self.leases = leases
+        self.oracle = client.oracle.to_string(False)
+        self.jetton_wallet_address: Optional[str] = None
+        self._lock = threading.Lock()
+        # alarm id -> when its wind was sent
+        self._in_flight: Dict[int, float] = {}
+
+    def in_flight(self) -> Set[int]:
+        """The alarms whose wind was sent and has not shown up yet."""
+        now = time.monotonic()
+        with self._lock:
+            for alarm_id, sent_at in list(self._in_flight.items()):
+                if now - sent_at > WIND_IN_FLIGHT_TIMEOUT:
+                    del self._in_flight[alarm_id]
+            return set(self._in_flight)
+
+    def on_alarm_change(self, alarm: Alarm):
+        with self._lock:
+            self._in_flight.pop(alarm.id, None)
+
+    async def get_jetton_wallet_address(self) -> str:
+        if self.jetton_wallet_address is None:
+            jetton_wallet = await self.client.toncenter.get_jetton_wallets(
+                GetSpecifiedJettonWalletRequest(
+                    owner_address=self.sender.address,  # type: ignore
+                    jetton_address=self.client.metadata.quote_asset_address,
+                )
+            )
+            assert jetton_wallet is not None, "jetton wallet does not found"
+            self.jetton_wallet_address = jetton_wallet.address.to_string()  # type: ignore
+        return self.jetton_wallet_address
+
+    def build_wind_body(self, alarm: ProfitableAlarm, new_price_raw: int) -> Cell:
+        # same message as TicTonAsyncClient.wind builds
+        forward_ton_amount = int(alarm.need_base_asset) + WIND_GAS_FEE
+        forward_info = (
+            begin_cell()
+            .store_uint(1, 8)
+            .store_uint(alarm.id, 256)
+            .store_uint(alarm.buy_num, 32)
+            .store_uint(new_price_raw, 256)
+            .end_cell()
+        )
+        return (
+            begin_cell()
+            .store_uint(0xF8A7EA5, 32)
+            .store_uint(0, 64)
+            .store_coins(int(alarm.need_quote_asset))
+            .store_address(self.client.oracle)
+            .store_address(self.sender.address)
+            .store_bit(False)
+            .store_coins(forward_ton_amount)
+            .store_ref(forward_info)
+            .end_cell()
+        )
+
+    async def submit(
+        self,
+        alarms: List[ProfitableAlarm],
+        new_price_raw: int,
+        started: Optional[float] = None,
+    ) -> List[WindResult]:
+        """
+        Sends winds for `alarms`, whose need_*_asset must already be known.
+        Latencies are measured from `started` (a time.monotonic() value,
+        e.g. when the price was read) to the moment the batch was accepted.
+        """
+        if started is None:
+            started = time.monotonic()
+        leased = await self.leases.acquire([alarm.id for alarm in alarms])
+        if len(leased) < len(alarms):
+            skipped = [alarm.id for alarm in alarms if alarm.id not in leased]
+            logger.info("Alarms %s are leased by another worker", skipped)
+            alarms_total.inc(len(skipped), oracle=self.oracle, stage="leased")
+            alarms = [alarm for alarm in alarms if alarm.id in leased]
+        # other oracles of the wallet may have spent the balance meanwhile
+        holds = {}
+        for alarm in alarms:
+            hold = balance_ledger.reserve(
+                self.client,
+                alarm.id,
+                # what the wind message carries, the unused gas comes back
+                int(alarm.need_base_asset) + 2 * WIND_GAS_FEE,
+                alarm.need_quote_asset,
+            )
+            if hold is not None:
+                holds[alarm.id] = hold
+        if len(holds) < len(alarms):
+            unfunded = [alarm.id for alarm in alarms if alarm.id not in holds]
+            logger.info("Alarms %s are no longer covered by the balance", unfunded)
+            alarms_total.inc(len(unfunded), oracle=self.oracle, stage="unfunded")
+            await self.leases.release(unfunded)
+            alarms = [alarm for alarm in alarms if alarm.id in holds]
+        if not alarms:
+            return []
+        # before the send, the wind event cannot be seen earlier
+        sent_at = time.monotonic()
+        with self._lock:
+            for alarm in alarms:
+                self._in_flight[alarm.id] = sent_at
+        with request_lane("wind"):
+            results = await self._submit(alarms, new_price_raw, started)
+        failed = [result.alarm.id for result in results if result.error is not None]
+        with self._lock:
+            for alarm_id in failed:
+                self._in_flight.pop(alarm_id, None)
+        for alarm_id in failed:
+            balance_ledger.release(self.client, alarm_id, holds[alarm_id])
+        # let another worker try the alarms whose wind was never sent
+        await self.leases.release(failed)
+        return results
+
+    async def _submit(
+        self, alarms: List[ProfitableAlarm], new_price_raw: int, started: float
+    ) -> List[WindResult]:
+        try:
+            jetton_wallet_address = await self.get_jetton_wallet_address()
+        except Exception as e:
+            return [WindResult(alarm, error=e) for alarm in alarms]
+
+        results: List[WindResult] = []
+        for index in range(0, len(alarms), MESSAGES_PER_EXTERNAL):
+            batch = alarms[index : index + MESSAGES_PER_EXTERNAL]
+            messages = [
+                (
+                    jetton_wallet_address,
+                    int(alarm.need_base_asset) + 2 * WIND_GAS_FEE,
+                    self.build_wind_body(alarm, new_price_raw),
+                )
+                for alarm in batch
+            ]
+            try:
+                seqno = await self.sender.send(messages, "wind")
+            except Exception as e:
+                results.extend(WindResult(alarm, error=e) for alarm in batch)
+                continue
+            latency = time.monotonic() - started
+            for alarm in batch:
+                confirmations.sent("wind", self.oracle, alarm.id)
+                results.append(WindResult(alarm, seqno, latency))
+            alarms_total.inc(len(batch), oracle=self.oracle, stage="sent")
+        return results
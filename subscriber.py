@@ -6,77 +6,186 @@ from ticton.callbacks import (
 )
 import asyncio
 import os
+import time
+from functools import partial
+from typing import Dict, Iterable, List, Optional
 from dotenv import load_dotenv
-import logging
-import redis
-from mariadb_connector import Alarm, update_alarm_to_db
+from log import get_logger
+from mariadb_connector import Alarm, get_checkpoint, init, update_alarm_to_db
+from backfill import backfill
+from balance_ledger import balance_ledger
+from metrics import alarms_total, confirmations
+from oracles import Oracle, configured_oracles
+from recorder import recorder
+from sharding import DB_WRITER
 
-from tonsdk.utils import Address
 from pytoncenter.address import Address as PyAddress
 
 
 load_dotenv()
 
-# set up logger
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
+logger = get_logger(__name__)
 
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
 
+THRESHOLD_PRICE = os.getenv("THRESHOLD_PRICE", 0.7)
 
-REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
-REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
-REDIS_DB = int(os.getenv("REDIS_DB", 0))
+MY_ADDRESS = PyAddress(os.getenv("MY_ADDRESS", "")).to_string(False)
 
-THRESHOLD_PRICE = os.getenv("THRESHOLD_PRICE", 0.7)
+# flush buffered events once this many alarms are pending or after this delay
+EVENT_BATCH_SIZE = int(os.getenv("EVENT_BATCH_SIZE", 256))
+EVENT_BATCH_DELAY = float(os.getenv("EVENT_BATCH_DELAY", 1.0))
+BACKFILL_RETRY_INTERVAL = 5
+# a failed subscription resumes after its last event, first after this
+# many seconds and twice as long after every failure without new events
+SUBSCRIBE_RETRY_INTERVAL = 1.0
+SUBSCRIBE_MAX_RETRY_INTERVAL = 60.0
 
-redis_client = redis.StrictRedis(
-    host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True
-)
 
-MY_ADDRESS = PyAddress(os.getenv("MY_ADDRESS", "")).to_string(False)
+def merge_alarm(pending: Alarm, alarm: Alarm) -> Alarm:
+    # the result of upserting `pending` and then `alarm`, see update_alarm_to_db
+    return Alarm(
+        id=pending.id,
+        price=pending.price,
+        created_at=pending.created_at,
+        state=alarm.state,
+        is_mine=pending.is_mine,
+        remain_scale=alarm.remain_scale,
+        watchmaker=pending.watchmaker,
+    )
+
+
+class EventWriter:
+    """
+    Write-behind buffer between the subscriber callbacks and MariaDB.
+
+    Events are applied to the in-process alarm store right away and
+    coalesced per alarm id in memory. They are flushed as one batched upsert
+    once EVENT_BATCH_SIZE alarms are pending or EVENT_BATCH_DELAY seconds
+    passed, and the lt of the last buffered event is committed as the
+    checkpoint in the same transaction. After a crash the subscriber resumes
+    from a checkpoint that exactly matches what is in the table; replayed
+    events are idempotent upserts. A writer without `write_db` only feeds
+    the alarm store, for workers that follow the table another worker writes.
+    There is one writer per oracle, on the oracle's store and tables. Only
+    the first oracle's events are recorded. `last_lt` is the lt of the
+    newest event either way, a failed subscription resumes after it.
+    """
 
+    def __init__(self, oracle: Oracle, write_db: bool = True):
+        self.oracle = oracle
+        self.store = oracle.store
+        self.write_db = write_db
+        self.record = oracle.first
+        self.pending: Dict[int, Alarm] = {}
+        self.last_lt: Optional[int] = None
+        self.first_pending_at: Optional[float] = None
+        self.lock = asyncio.Lock()
 
-async def on_tick_success(on_tick_success_params: OnTickSuccessParams):
-    logger.info(f"Tick received: {on_tick_success_params}")
+    def _merge(self, alarms: Iterable[Alarm]):
+        for alarm in alarms:
+            pending = self.pending.get(alarm.id)
+            self.pending[alarm.id] = (
+                alarm if pending is None else merge_alarm(pending, alarm)
+            )
+
+    async def add(self, alarms: List[Alarm], lt: int):
+        self.last_lt = lt
+        if not self.write_db:
+            self.store.apply(alarms)
+            return
+        self._merge(alarms)
+        if self.first_pending_at is None:
+            self.first_pending_at = time.monotonic()
+        self.store.apply(alarms)
+
+        if len(self.pending) >= EVENT_BATCH_SIZE:
+            await self.flush()
+
+    async def flush(self) -> bool:
+        async with self.lock:
+            if not self.pending:
+                return True
+            alarms, last_lt = list(self.pending.values()), self.last_lt
+            self.pending = {}
+            first_pending_at, self.first_pending_at = self.first_pending_at, None
+            if await update_alarm_to_db(alarms, last_lt, self.oracle.tables):
+                return True
+
+            # keep the events and put newer ones on top of them again,
+            # self.last_lt already is the lt of the newest event
+            newer, self.pending = self.pending, {alarm.id: alarm for alarm in alarms}
+            self._merge(newer.values())
+            self.first_pending_at = first_pending_at
+            return False
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(EVENT_BATCH_DELAY / 4)
+            if (
+                self.first_pending_at is not None
+                and time.monotonic() - self.first_pending_at >= EVENT_BATCH_DELAY
+            ):
+                await self.flush()
+
+
+async def on_tick_success(
+    on_tick_success_params: OnTickSuccessParams, writer: EventWriter
+):
+    logger.info("Tick received: %s", on_tick_success_params)
     price = round(float(on_tick_success_params.base_asset_price), 9)
     watchmaker = PyAddress(on_tick_success_params.watchmaker).to_string(False)
     is_mine = watchmaker == MY_ADDRESS
 
     lt = on_tick_success_params.tx.lt
-    redis_client.set("last_lt", lt)
 
     alarm = Alarm(
         id=on_tick_success_params.new_alarm_id,
         price=price,
         is_mine=is_mine,
         created_at=on_tick_success_params.created_at,
+        watchmaker=watchmaker,
     )
-    await update_alarm_to_db([alarm])
+    if writer.record:
+        recorder.record(
+            "tick",
+            lt=lt,
+            id=alarm.id,
+            price=price,
+            created_at=alarm.created_at,
+            watchmaker=watchmaker,
+        )
+    if is_mine:
+        balance_ledger.refresh("tick")
+    await writer.add([alarm], lt)
 
 
-async def on_ring_success(on_ring_success_params: OnRingSuccessParams):
-    logger.info(f"Ring received: {on_ring_success_params}")
+async def on_ring_success(
+    on_ring_success_params: OnRingSuccessParams, writer: EventWriter
+):
+    logger.info("Ring received: %s", on_ring_success_params)
 
     lt = on_ring_success_params.tx.lt
-    redis_client.set("last_lt", lt)
 
     alarm = Alarm(id=on_ring_success_params.alarm_id, state="uninitialized")
-    await update_alarm_to_db([alarm])
+    confirmations.confirmed("ring", writer.oracle.raw_address, alarm.id)
+    rung_alarm = writer.store.get(alarm.id)
+    if rung_alarm is not None and rung_alarm.is_mine:
+        # the alarm's assets went back to our wallet
+        balance_ledger.refresh("ring")
+    if writer.record:
+        recorder.record("ring", lt=lt, id=alarm.id)
+    await writer.add([alarm], lt)
 
 
-async def on_wind_success(on_wind_success_params: OnWindSuccessParams):
-    logger.info(f"Wind received: {on_wind_success_params}")
+async def on_wind_success(
+    on_wind_success_params: OnWindSuccessParams, writer: EventWriter
+):
+    logger.info("Wind received: %s", on_wind_success_params)
     price = round(float(on_wind_success_params.new_base_asset_price), 9)
     timekeeper = PyAddress(on_wind_success_params.timekeeper).to_string(False)
     is_mine = timekeeper == MY_ADDRESS
 
     lt = on_wind_success_params.tx.lt
-    redis_client.set("last_lt", lt)
 
     alarm = Alarm(
         id=on_wind_success_params.alarm_id,
@@ -87,24 +196,77 @@ async def on_wind_success(on_wind_success_params: OnWindSuccessParams):
         price=price,
         is_mine=is_mine,
         created_at=on_wind_success_params.created_at,
+        watchmaker=timekeeper,
     )
-    await update_alarm_to_db([alarm, new_alarm])
+    if writer.record:
+        recorder.record(
+            "wind",
+            lt=lt,
+            id=alarm.id,
+            remain_scale=alarm.remain_scale,
+            new_id=new_alarm.id,
+            price=price,
+            created_at=new_alarm.created_at,
+            timekeeper=timekeeper,
+        )
+    oracle = writer.oracle.raw_address
+    if confirmations.confirmed("wind", oracle, alarm.id, ours=is_mine):
+        alarms_total.inc(oracle=oracle, stage="captured" if is_mine else "lost")
+    if is_mine:
+        balance_ledger.settle(oracle, alarm.id)
+    await writer.add([alarm, new_alarm], lt)
 
 
-async def subscribe():
-    client = await TicTonAsyncClient.init(testnet=True)
-    lt = redis_client.get("last_lt")
-    if isinstance(lt, str):
-        lt = int(lt)
+async def subscribe(
+    client: Optional[TicTonAsyncClient] = None, oracle: Optional[Oracle] = None
+):
+    if oracle is None:
+        oracle = configured_oracles()[0]
+    if client is None:
+        client = await oracle.connect()
+    event_writer = EventWriter(oracle, write_db=DB_WRITER)
+    if DB_WRITER:
+        while True:
+            try:
+                if not await init(oracle.tables):
+                    raise Exception("alarm tables could not be created")
+                lt = await backfill(client, MY_ADDRESS, oracle.tables)
+                break
+            except Exception as e:
+                logger.error("Error in backfill %s", e)
+                await asyncio.sleep(BACKFILL_RETRY_INTERVAL)
     else:
-        lt = "latest"  # or oldest
+        # the first worker backfills the table, follow it from its checkpoint
+        # and replay everything since into the alarm store
+        while (lt := await get_checkpoint(oracle.tables.checkpoint)) is None:
+            logger.info("Waiting for the first worker to backfill the alarm table")
+            await asyncio.sleep(BACKFILL_RETRY_INTERVAL)
+    oracle.ready.set()
 
-    await client.subscribe(
-        on_tick_success=on_tick_success,
-        on_wind_success=on_wind_success,
-        on_ring_success=on_ring_success,
-        start_lt=lt,
-    )
+    writer_task = asyncio.create_task(event_writer.run())
+    retry_interval = SUBSCRIBE_RETRY_INTERVAL
+    try:
+        while True:
+            try:
+                await client.subscribe(
+                    on_tick_success=partial(on_tick_success, writer=event_writer),
+                    on_wind_success=partial(on_wind_success, writer=event_writer),
+                    on_ring_success=partial(on_ring_success, writer=event_writer),
+                    start_lt=lt,
+                )
+            except Exception as e:
+                # e.g. a 429 or a timeout of toncenter
+                logger.error("Error in subscription of %s %s", oracle, e)
+            if event_writer.last_lt is not None and event_writer.last_lt >= lt:
+                # the event at last_lt was handled, go on after it
+                lt = event_writer.last_lt + 1
+                retry_interval = SUBSCRIBE_RETRY_INTERVAL
+            logger.info("Resuming the subscription of %s from lt %d", oracle, lt)
+            await asyncio.sleep(retry_interval)
+            retry_interval = min(2 * retry_interval, SUBSCRIBE_MAX_RETRY_INTERVAL)
+    finally:
+        writer_task.cancel()
+        await event_writer.flush()
 
 
 if __name__ == "__main__":
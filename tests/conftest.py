@@ -0,0 +1,16 @@
+import os
+
+import pytest
+
+# subscriber and bot read our wallet address on import
+os.environ.setdefault("MY_ADDRESS", "EQCD39VS5jcptHL8vMjEXrzGaRcCVYto7HUn4bpAOg8xqB2N")
+
+from tests.fake_exchange import FakeExchange  # noqa: E402
+
+
+@pytest.fixture
+def fake_exchange():
+    exchange = FakeExchange()
+    exchange.start()
+    yield exchange
+    exchange.stop()
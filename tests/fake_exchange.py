@@ -0,0 +1,152 @@
+"""
+A local stand-in for the okx ticker endpoints, REST and websocket, that a
+PriceFeed is pointed at through `exchange_config`.
+"""
+import asyncio
+import json
+import threading
+import time
+from typing import List, Optional
+
+from aiohttp import WSMsgType, web
+
+EXCHANGE_ID = "okx"
+SYMBOL = "TON/USDT"
+MARKET_ID = "TON-USDT"
+
+# preloaded, so the feed never downloads the exchange's markets
+MARKETS = {
+    SYMBOL: {
+        "id": MARKET_ID,
+        "symbol": SYMBOL,
+        "base": "TON",
+        "quote": "USDT",
+        "baseId": "TON",
+        "quoteId": "USDT",
+        "type": "spot",
+        "spot": True,
+        "margin": False,
+        "swap": False,
+        "future": False,
+        "option": False,
+        "contract": False,
+        "active": True,
+        "precision": {"amount": 0.000001, "price": 0.0001},
+        "limits": {},
+        "info": {"instType": "SPOT"},
+    }
+}
+
+
+def ticker(price: float) -> dict:
+    return {
+        "instType": "SPOT",
+        "instId": MARKET_ID,
+        "last": str(price),
+        "ts": str(int(time.time() * 1000)),
+    }
+
+
+class FakeExchange:
+    """
+    Serves okx's ticker REST endpoint and public websocket on a free local
+    port, from its own thread and event loop.
+
+    `push` sends a ticker to every subscribed websocket, `disconnect` drops
+    them and refuses new ones until `resume`. The REST endpoint answers
+    with `rest_price` and counts its calls.
+    """
+
+    def __init__(self):
+        self.rest_price = 0.0
+        self.rest_calls = 0
+        self.subscriptions = 0
+        self.down = False
+        self.port = 0
+        self._sockets: List[web.WebSocketResponse] = []
+        self._loop = asyncio.new_event_loop()
+        self._runner: Optional[web.AppRunner] = None
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+
+    @property
+    def config(self) -> dict:
+        """The ccxt options that point okx at this server."""
+        base = f"127.0.0.1:{self.port}"
+        return {
+            "urls": {"api": {"rest": f"http://{base}", "ws": f"ws://{base}/ws/v5"}},
+            "markets": MARKETS,
+        }
+
+    def start(self):
+        self._thread.start()
+        self._call(self._start())
+
+    def stop(self):
+        self._call(self._stop())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def push(self, price: float):
+        self._call(self._push(price))
+
+    def disconnect(self):
+        self.down = True
+        self._call(self._close_sockets())
+
+    def resume(self):
+        self.down = False
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result(5)
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_get("/api/v5/market/ticker", self._rest_ticker)
+        app.router.add_get("/ws/v5/public", self._websocket)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def _stop(self):
+        await self._close_sockets()
+        await self._runner.cleanup()
+
+    async def _rest_ticker(self, request: web.Request) -> web.Response:
+        self.rest_calls += 1
+        return web.json_response({"code": "0", "msg": "", "data": [ticker(self.rest_price)]})
+
+    async def _websocket(self, request: web.Request) -> web.StreamResponse:
+        if self.down:
+            return web.Response(status=503)
+        socket = web.WebSocketResponse()
+        await socket.prepare(request)
+        async for message in socket:
+            if message.type != WSMsgType.TEXT:
+                break
+            if message.data == "ping":
+                await socket.send_str("pong")
+                continue
+            request_data = json.loads(message.data)
+            if request_data.get("op") == "subscribe":
+                for arg in request_data["args"]:
+                    await socket.send_json({"event": "subscribe", "arg": arg})
+                self._sockets.append(socket)
+                self.subscriptions += 1
+        if socket in self._sockets:
+            self._sockets.remove(socket)
+        return socket
+
+    async def _push(self, price: float):
+        message = {
+            "arg": {"channel": "tickers", "instId": MARKET_ID},
+            "data": [ticker(price)],
+        }
+        for socket in list(self._sockets):
+            await socket.send_json(message)
+
+    async def _close_sockets(self):
+        for socket in list(self._sockets):
+            await socket.close()
+        self._sockets.clear()
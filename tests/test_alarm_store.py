@@ -0,0 +1,69 @@
+import random
+from types import SimpleNamespace
+
+from alarm_store import AlarmColumns, AlarmStore
+from mariadb_connector import Alarm
+
+
+def random_alarms(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    return [
+        Alarm(
+            id=alarm_id,
+            # few distinct prices, so deltas tie
+            price=round(rng.uniform(1.0, 3.0), 1),
+            is_mine=rng.random() < 0.2,
+            remain_scale=rng.randint(1, 5),
+        )
+        for alarm_id in rng.sample(range(1, 10 * count), count)
+    ]
+
+
+def test_columns_after_updates():
+    alarms = random_alarms(200, seed=1)
+    columns = AlarmColumns(alarms[:100])
+    for alarm in alarms[100:]:
+        columns.add(alarm)
+    for alarm in alarms[::3]:
+        columns.remove(alarm.id)
+    moved = Alarm(alarms[1].id, price=9.0, remain_scale=1)
+    columns.add(moved)
+
+    expected = {alarm.id: alarm for alarm in alarms}
+    for alarm in alarms[::3]:
+        del expected[alarm.id]
+    expected[moved.id] = moved
+    assert len(columns) == len(expected)
+    assert sorted(columns.ids.tolist()) == sorted(expected)
+    for alarm_id, alarm in expected.items():
+        row = columns.row(alarm_id)
+        assert columns.ids[row] == alarm_id
+        assert columns.prices[row] == alarm.price
+        assert columns.remain_scale[row] == alarm.remain_scale
+    assert columns.row(alarms[0].id) == -1
+
+
+def test_max_buy_num():
+    columns = AlarmColumns([Alarm(1, price=2.0, remain_scale=4), Alarm(2, price=3.0, remain_scale=4)])
+    rows = [columns.row(1), columns.row(2), -1]
+    # scales unknown
+    assert columns.max_buy_num(rows, 2.5, 100, 10).tolist() == [-1, -1, -1]
+    columns.set_scales(1, base_scale=3, quote_scale=1)
+    columns.set_scales(2, base_scale=1, quote_scale=2)
+    # alarm 1 is bought from (one unit each), alarm 2 sold to (three units each)
+    assert columns.max_buy_num(rows, 2.5, 100, 10).tolist() == [3, 2, -1]
+    assert columns.max_buy_num(rows, 2.5, 25, 10).tolist() == [2, 0, -1]
+
+
+def test_store_sizes_other_peoples_alarms_only():
+    store = AlarmStore()
+    store.reset(
+        [
+            Alarm(1, price=2.0, remain_scale=4),
+            Alarm(2, price=2.0, remain_scale=4, is_mine=True),
+        ]
+    )
+    metadata = SimpleNamespace(base_asset_scale=3, quote_asset_scale=1)
+    for alarm_id in (1, 2):
+        store.on_alarm_info(alarm_id, SimpleNamespace(metadata=metadata))
+    assert store.max_buy_nums([1, 2], 2.5, 100, 10) == [3, -1]
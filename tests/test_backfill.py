@@ -0,0 +1,130 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import backfill as backfill_module
+from backfill import backfill
+from mariadb_connector import AlarmTables
+from pytoncenter.address import Address as PyAddress
+
+WATCHMAKER = "EQCD39VS5jcptHL8vMjEXrzGaRcCVYto7HUn4bpAOg8xqB2N"
+MY_ADDRESS = PyAddress(WATCHMAKER).to_string(False)
+
+
+class FakeChain:
+    """An oracle with `total_alarms` active alarms, alarm i priced at i."""
+
+    def __init__(self, total_alarms: int, latest_lt: int = 1000):
+        self.metadata = SimpleNamespace(total_alarms=total_alarms)
+        self.latest_lt = latest_lt
+        self.toncenter = SimpleNamespace(get_transactions=self.get_transactions)
+        self.oracle = SimpleNamespace(to_string=lambda *args: WATCHMAKER)
+        # alarm id -> errors left to raise for it
+        self.failures = {}
+        self.reads = []
+
+    async def get_transactions(self, request):
+        return [SimpleNamespace(lt=self.latest_lt)], None
+
+    async def sync_oracle_metadata(self):
+        pass
+
+    async def get_alarm_address(self, alarm_id):
+        self.reads.append(alarm_id)
+        if self.failures.get(alarm_id):
+            self.failures[alarm_id] -= 1
+            raise ConnectionError("429")
+        return alarm_id
+
+    async def get_address_state(self, alarm_address):
+        return "active"
+
+    async def get_alarm_metadata(self, alarm_address):
+        return SimpleNamespace(
+            base_asset_price=alarm_address,
+            watchmaker_address=WATCHMAKER,
+            created_at=0,
+            remain_scale=1,
+        )
+
+    async def _convert_fixedfloat_to_price(self, price):
+        return float(price.raw_value)
+
+
+class FakeTables:
+    def __init__(self, monkeypatch):
+        self.alarms = {}
+        self.checkpoints = {}
+        monkeypatch.setattr(backfill_module, "get_checkpoint", self.get_checkpoint)
+        monkeypatch.setattr(backfill_module, "get_latest_alarm_id", self.get_latest_alarm_id)
+        monkeypatch.setattr(backfill_module, "get_active_alarms", self.get_active_alarms)
+        monkeypatch.setattr(backfill_module, "update_alarm_to_db", self.update_alarm_to_db)
+
+    async def get_checkpoint(self, name):
+        return self.checkpoints.get(name)
+
+    async def get_latest_alarm_id(self, tables):
+        return max(self.alarms, default=0)
+
+    async def get_active_alarms(self, my_address=None, tables=None):
+        return list(self.alarms.values())
+
+    async def update_alarm_to_db(self, alarms, last_lt=None, tables=None, checkpoint=None):
+        for alarm in alarms:
+            self.alarms[alarm.id] = alarm
+        if last_lt is not None:
+            self.checkpoints[checkpoint or tables.checkpoint] = last_lt
+        return True
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(backfill_module, "FETCH_RETRY_INTERVAL", 0)
+    monkeypatch.setattr(backfill_module, "BACKFILL_BATCH_SIZE", 4)
+
+
+def test_failed_reads_are_retried(monkeypatch):
+    db = FakeTables(monkeypatch)
+    chain = FakeChain(10)
+    chain.failures = {3: backfill_module.FETCH_RETRIES - 1, 7: 1}
+    tables = AlarmTables()
+
+    assert asyncio.run(backfill(chain, MY_ADDRESS, tables)) == 1000
+    assert sorted(db.alarms) == list(range(10))
+    assert db.alarms[3].price == 3 and db.alarms[3].is_mine
+    assert db.checkpoints == {tables.checkpoint: 1000, tables.backfill_checkpoint: 1000}
+
+
+def test_interrupted_backfill_resumes_where_it_stopped(monkeypatch):
+    db = FakeTables(monkeypatch)
+    chain = FakeChain(10)
+    # alarm 9 never comes back, the batches before it are kept
+    chain.failures = {9: backfill_module.FETCH_RETRIES}
+    tables = AlarmTables()
+    with pytest.raises(ConnectionError):
+        asyncio.run(backfill(chain, MY_ADDRESS, tables))
+    assert sorted(db.alarms) == list(range(8))
+    assert db.checkpoints == {tables.backfill_checkpoint: 1000}
+
+    # the chain moved on meanwhile, the subscription must still replay
+    # everything since the first backfill's lt
+    chain.latest_lt = 2000
+    chain.reads = []
+    assert asyncio.run(backfill(chain, MY_ADDRESS, tables)) == 1000
+    assert chain.reads == [8, 9]
+    assert sorted(db.alarms) == list(range(10))
+    assert db.checkpoints[tables.checkpoint] == 1000
+
+
+def test_failure_while_refreshing_starts_over(monkeypatch):
+    db = FakeTables(monkeypatch)
+    chain = FakeChain(10)
+    asyncio.run(backfill(chain, MY_ADDRESS, AlarmTables()))
+
+    # known alarms without a checkpoint, they are read again first
+    tables = AlarmTables("_other")
+    chain.failures = {2: backfill_module.FETCH_RETRIES}
+    with pytest.raises(ConnectionError):
+        asyncio.run(backfill(chain, MY_ADDRESS, tables))
+    assert tables.backfill_checkpoint not in db.checkpoints
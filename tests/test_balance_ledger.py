@@ -0,0 +1,161 @@
+import asyncio
+from decimal import Decimal
+from types import SimpleNamespace
+
+import balance_ledger as ledger_module
+from balance_ledger import BalanceLedger
+from pytoncenter.address import Address as PyAddress
+
+ORACLE = PyAddress("EQCD39VS5jcptHL8vMjEXrzGaRcCVYto7HUn4bpAOg8xqB2N")
+QUOTE_ASSET = "EQCxE6mUtQJKFnGfaROTKOt1lZbDiiX1kCixRv7Nw2Id_sDs"
+
+
+class FakeClient:
+    def __init__(self, base_asset: int, quote_asset: int):
+        self.oracle = ORACLE
+        self.metadata = SimpleNamespace(quote_asset_address=QUOTE_ASSET)
+        self.wallet = (base_asset, quote_asset)
+        # set to hold a read in flight until it is set
+        self.read = None
+
+    async def _get_user_balance(self, owner_address: str):
+        if self.read is not None:
+            await self.read.wait()
+        return self.wallet
+
+
+def seeded(base_asset: int = 100, quote_asset: int = 1000):
+    ledger = BalanceLedger()
+    client = FakeClient(base_asset, quote_asset)
+    assert asyncio.run(ledger.reconcile(client, "owner"))
+    return ledger, client
+
+
+def assets(ledger: BalanceLedger, client: FakeClient):
+    balance = ledger.balance(client)
+    return balance.base_asset, balance.quote_asset
+
+
+def test_reserve_holds_until_settled():
+    ledger, client = seeded()
+    assert ledger.reserve(client, 1, 30, 300) is not None
+    assert assets(ledger, client) == (70, 700)
+    # what is left does not cover a second wind of that size
+    assert ledger.reserve(client, 2, 80, 10) is None
+    assert ledger.reserve(client, 2, 70, 700) is not None
+    assert assets(ledger, client) == (0, 0)
+
+    ledger.settle(ORACLE.to_string(False), 1)
+    assert ledger._assets[ledger_module.BASE_ASSET] == 70
+    assert assets(ledger, client) == (0, 0)
+
+
+def test_release():
+    ledger, client = seeded()
+    first = ledger.reserve(client, 1, 30, 300)
+    second = ledger.reserve(client, 1, 20, 200)
+    ledger.release(client, 1, first)
+    assert assets(ledger, client) == (80, 800)
+    ledger.release(client, 1, second)
+    assert assets(ledger, client) == (100, 1000)
+    assert ledger._holds == {}
+
+
+def test_settle_after_read_does_not_subtract_again():
+    ledger, client = seeded()
+    ledger.reserve(client, 1, 30, 300)
+    # the wind landed before the next read, which already contains it
+    client.wallet = (70, 700)
+    assert asyncio.run(ledger.reconcile(client, "owner"))
+    ledger.settle(ORACLE.to_string(False), 1)
+    # the ledger cannot tell, the wind stays held until a newer read
+    assert assets(ledger, client) == (40, 400)
+    assert "settled_after_read" in ledger._trigger._reasons
+    assert asyncio.run(ledger.reconcile(client, "owner"))
+    assert assets(ledger, client) == (70, 700)
+
+
+def test_wind_landing_after_a_read_stays_held():
+    ledger, client = seeded()
+    ledger.reserve(client, 1, 30, 300)
+    # the read starts after the send, but the wind lands after the read
+    assert asyncio.run(ledger.reconcile(client, "owner"))
+    ledger.settle(ORACLE.to_string(False), 1)
+    assert assets(ledger, client) == (70, 700)
+    assert ledger.reserve(client, 2, 80, 0) is None
+
+
+def test_read_in_flight_during_the_settle_keeps_the_hold():
+    ledger, client = seeded()
+    ledger.reserve(client, 1, 30, 300)
+    assert asyncio.run(ledger.reconcile(client, "owner"))
+
+    async def settle_during_read():
+        client.read = asyncio.Event()
+        task = asyncio.create_task(ledger.reconcile(client, "owner"))
+        await asyncio.sleep(0)
+        ledger.settle(ORACLE.to_string(False), 1)
+        client.read.set()
+        return await task
+
+    # the read may have been taken before the wind landed
+    assert asyncio.run(settle_during_read())
+    assert assets(ledger, client) == (70, 700)
+
+    # one that started after the settle contains it
+    client.read = None
+    client.wallet = (70, 700)
+    assert asyncio.run(ledger.reconcile(client, "owner"))
+    assert assets(ledger, client) == (70, 700)
+    assert ledger._settled == []
+
+
+def test_unknown_settle_asks_for_a_read():
+    ledger, client = seeded()
+    ledger.settle(ORACLE.to_string(False), 7)
+    assert "unknown_wind" in ledger._trigger._reasons
+    assert assets(ledger, client) == (100, 1000)
+
+
+def test_hold_expires(monkeypatch):
+    ledger, client = seeded()
+    now = [1000.0]
+    monkeypatch.setattr(ledger_module.time, "monotonic", lambda: now[0])
+    ledger.reserve(client, 1, 30, 300)
+    now[0] += ledger_module.BALANCE_HOLD_TIMEOUT
+    assert assets(ledger, client) == (70, 700)
+    now[0] += 1
+    assert assets(ledger, client) == (100, 1000)
+    assert ledger._holds == {}
+
+
+def test_balance_is_not_negative():
+    ledger, client = seeded()
+    ledger.reserve(client, 1, 100, 1000)
+    client.wallet = (50, 500)
+    asyncio.run(ledger.reconcile(client, "owner"))
+    assert assets(ledger, client) == (Decimal(0), Decimal(0))
+
+
+def test_failed_run_is_restarted(monkeypatch):
+    monkeypatch.setattr(ledger_module, "RESTART_INTERVAL", 0)
+    ledger = BalanceLedger()
+    runs = []
+
+    async def run(owner_address: str):
+        runs.append(owner_address)
+        if len(runs) < 3:
+            raise ConnectionError("toncenter is down")
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(ledger, "run", run)
+
+    async def main():
+        first = ledger.start("owner")
+        while len(runs) < 3:
+            await asyncio.sleep(0)
+        assert first.done() and not ledger._task.done()
+        ledger._task.cancel()
+
+    asyncio.run(main())
+    assert runs == ["owner"] * 3
@@ -0,0 +1,38 @@
+import asyncio
+
+import bot
+
+
+def test_supervise_restarts_a_failed_component(monkeypatch):
+    monkeypatch.setattr(bot, "RESTART_INTERVAL", 0)
+    starts = []
+
+    async def component():
+        starts.append(len(starts))
+        if len(starts) < 3:
+            raise ConnectionError("toncenter is down")
+
+    asyncio.run(bot.supervise("component", component))
+    assert starts == [0, 1, 2]
+
+
+def test_supervise_keeps_the_others_running(monkeypatch):
+    monkeypatch.setattr(bot, "RESTART_INTERVAL", 0.01)
+    ticks = []
+
+    async def failing():
+        raise RuntimeError()
+
+    async def ticking():
+        while len(ticks) < 5:
+            ticks.append(None)
+            await asyncio.sleep(0.01)
+
+    async def main():
+        failing_task = asyncio.create_task(bot.supervise("failing", failing))
+        await bot.supervise("ticking", ticking)
+        assert not failing_task.done()
+        failing_task.cancel()
+
+    asyncio.run(main())
+    assert len(ticks) == 5
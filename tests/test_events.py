@@ -0,0 +1,72 @@
+import asyncio
+import threading
+import time
+
+from events import Signal, Trigger
+
+
+def test_trigger_returns_reasons_since_last_wake_up():
+    async def main():
+        trigger = Trigger()
+        trigger.notify("price")
+        trigger.bind()
+        assert await trigger.wait(max_staleness=1) == {"price"}
+        trigger.notify("alarm")
+        trigger.notify("price")
+        assert await trigger.wait(max_staleness=1) == {"alarm", "price"}
+
+    asyncio.run(main())
+
+
+def test_trigger_debounce_coalesces_a_burst():
+    async def main():
+        trigger = Trigger()
+        trigger.bind()
+
+        async def burst():
+            for reason in ("a", "b", "c"):
+                trigger.notify(reason)
+                await asyncio.sleep(0.01)
+
+        task = asyncio.create_task(burst())
+        reasons = await trigger.wait(debounce=0.1, max_staleness=1)
+        await task
+        assert reasons == {"a", "b", "c"}
+
+    asyncio.run(main())
+
+
+def test_trigger_max_staleness():
+    async def main():
+        trigger = Trigger()
+        trigger.bind()
+        started = time.monotonic()
+        assert await trigger.wait(max_staleness=0.05) == {"staleness"}
+        assert time.monotonic() - started >= 0.05
+
+    asyncio.run(main())
+
+
+def test_trigger_notify_from_another_thread():
+    async def main():
+        trigger = Trigger()
+        trigger.bind()
+        thread = threading.Timer(0.02, trigger.notify, args=("thread",))
+        thread.start()
+        try:
+            assert await trigger.wait(max_staleness=1) == {"thread"}
+        finally:
+            thread.join()
+
+    asyncio.run(main())
+
+
+def test_signal():
+    async def main():
+        signal = Signal()
+        assert not await signal.wait(timeout=0.01)
+        threading.Timer(0.02, signal.set).start()
+        assert await signal.wait(timeout=1)
+        assert signal.is_set()
+
+    asyncio.run(main())
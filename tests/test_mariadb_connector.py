@@ -0,0 +1,129 @@
+import asyncio
+import threading
+
+import pytest
+
+import mariadb_connector
+from mariadb_connector import ConnectionPool
+
+
+class FakeCursor:
+    def __init__(self, connection, prepared):
+        self.connection = connection
+        self.prepared = prepared
+
+    def execute(self, sql, params):
+        if self.connection.broken:
+            raise ConnectionError("Lost connection to MariaDB")
+        self.connection.executed.append((sql, tuple(params), self.prepared))
+
+
+class FakeConnection:
+    def __init__(self):
+        self.broken = False
+        self.closed = False
+        self.cursors = 0
+        self.commits = 0
+        self.pings = 0
+        self.reconnects = 0
+        self.executed = []
+
+    def cursor(self, prepared=False):
+        self.cursors += 1
+        return FakeCursor(self, prepared)
+
+    def commit(self):
+        self.commits += 1
+
+    def ping(self, reconnect=False):
+        self.pings += 1
+        if self.broken:
+            raise ConnectionError("MySQL Connection not available")
+
+    def reconnect(self, attempts=1, delay=0):
+        self.reconnects += 1
+        self.broken = False
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    created = []
+
+    def create_connection():
+        created.append(FakeConnection())
+        return created[-1]
+
+    monkeypatch.setattr(mariadb_connector, "create_connection", create_connection)
+    return created
+
+
+def query(conn, value):
+    conn.execute("SELECT %s", (value,))
+    return threading.current_thread().name
+
+
+def run(pool: ConnectionPool, func, *args):
+    async def main():
+        return await pool.run(func, *args)
+
+    return asyncio.run(main())
+
+
+def test_connection_is_reused(connections):
+    pool = ConnectionPool(size=2)
+    assert run(pool, query, 1).startswith("mariadb")
+    run(pool, query, 2)
+    assert len(connections) == 1
+    # the prepared statement is created once and committed per call
+    assert connections[0].cursors == 1
+    assert connections[0].commits == 2
+    assert connections[0].executed == [("SELECT %s", (1,), True), ("SELECT %s", (2,), True)]
+    pool.close()
+    assert connections[0].closed
+
+
+def test_broken_connection_is_dropped(connections):
+    pool = ConnectionPool(size=2)
+    run(pool, query, 1)
+    connections[0].broken = True
+    with pytest.raises(ConnectionError):
+        run(pool, query, 2)
+    assert connections[0].closed
+
+    run(pool, query, 3)
+    assert len(connections) == 2
+    assert connections[1].executed == [("SELECT %s", (3,), True)]
+
+
+def test_idle_connection_is_checked_and_reconnected(connections):
+    pool = ConnectionPool(size=1)
+    run(pool, query, 1)
+    conn = pool._idle.get_nowait()
+    pool._idle.put_nowait(conn)
+
+    # used recently, not pinged
+    run(pool, query, 2)
+    assert connections[0].pings == 0
+
+    conn.last_used -= mariadb_connector.HEALTH_CHECK_INTERVAL
+    connections[0].broken = True
+    run(pool, query, 3)
+    assert (connections[0].pings, connections[0].reconnects) == (1, 1)
+    # the statements of the old session were dropped
+    assert connections[0].cursors == 2
+    assert len(connections) == 1
+
+
+def test_batched_writes_use_a_plain_cursor(connections):
+    pool = ConnectionPool(size=1)
+
+    def write(conn, rows):
+        conn.execute("INSERT", rows, prepared=False)
+        conn.execute("INSERT", rows, prepared=False)
+
+    run(pool, write, [1, 2])
+    assert connections[0].cursors == 1
+    assert connections[0].executed == [("INSERT", (1, 2), False)] * 2
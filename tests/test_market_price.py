@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+import market_price
+from market_price import PriceFeed
+from tests.fake_exchange import EXCHANGE_ID, SYMBOL
+
+
+async def wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def run_stream(fake_exchange, scenario):
+    async def main():
+        feed = PriceFeed(
+            [EXCHANGE_ID],
+            symbols=[SYMBOL],
+            streaming=True,
+            exchange_config={EXCHANGE_ID: fake_exchange.config},
+        )
+        prices = []
+        task = asyncio.create_task(
+            feed.stream(
+                EXCHANGE_ID,
+                lambda exchange_id, symbol, price, latency: prices.append(
+                    (exchange_id, symbol, price)
+                ),
+            )
+        )
+        try:
+            await wait_for(lambda: fake_exchange.subscriptions == 1)
+            await scenario(prices)
+        finally:
+            task.cancel()
+            await feed.close()
+
+    asyncio.run(main())
+
+
+def test_stream_delivers_ticks(fake_exchange):
+    async def scenario(prices):
+        await asyncio.to_thread(fake_exchange.push, 2.5)
+        await asyncio.to_thread(fake_exchange.push, 2.51)
+        await wait_for(lambda: len(prices) == 2)
+        assert prices == [(EXCHANGE_ID, SYMBOL, 2.5), (EXCHANGE_ID, SYMBOL, 2.51)]
+        assert fake_exchange.rest_calls == 0
+
+    run_stream(fake_exchange, scenario)
+
+
+def test_stream_falls_back_to_polling(fake_exchange, monkeypatch):
+    monkeypatch.setattr(market_price, "POLL_INTERVAL", 0.05)
+    monkeypatch.setattr(market_price, "STREAM_RETRY_INTERVAL", 60)
+    fake_exchange.rest_price = 2.6
+
+    async def scenario(prices):
+        await asyncio.to_thread(fake_exchange.disconnect)
+        await wait_for(lambda: fake_exchange.rest_calls >= 3)
+        assert prices[-1] == (EXCHANGE_ID, SYMBOL, 2.6)
+        # not retried before STREAM_RETRY_INTERVAL
+        assert fake_exchange.subscriptions == 1
+
+    run_stream(fake_exchange, scenario)
+
+
+def test_stream_resumes_after_retry_interval(fake_exchange, monkeypatch):
+    monkeypatch.setattr(market_price, "POLL_INTERVAL", 0.05)
+    monkeypatch.setattr(market_price, "STREAM_RETRY_INTERVAL", 0.3)
+    fake_exchange.rest_price = 2.6
+
+    async def scenario(prices):
+        await asyncio.to_thread(fake_exchange.disconnect)
+        await wait_for(lambda: fake_exchange.rest_calls >= 1)
+        fake_exchange.resume()
+        await wait_for(lambda: fake_exchange.subscriptions == 2)
+        rest_calls = fake_exchange.rest_calls
+        await asyncio.to_thread(fake_exchange.push, 2.7)
+        await wait_for(lambda: prices[-1] == (EXCHANGE_ID, SYMBOL, 2.7))
+        # polling stopped with the stream back up
+        await asyncio.sleep(0.2)
+        assert fake_exchange.rest_calls <= rest_calls + 1
+
+    run_stream(fake_exchange, scenario)
@@ -0,0 +1,23 @@
+from metrics import ConfirmationTracker, alarms_total, confirmation_seconds
+
+
+def test_confirmations_are_kept_per_oracle():
+    tracker = ConfirmationTracker()
+    observed = confirmation_seconds.count(action="wind")
+    tracker.sent("wind", "0:a", 1)
+    tracker.sent("wind", "0:b", 1)
+
+    # a wind on oracle b's alarm 1 leaves oracle a's alarm 1 alone
+    assert tracker.confirmed("wind", "0:b", 1)
+    assert not tracker.confirmed("wind", "0:b", 1)
+    assert not tracker.confirmed("ring", "0:a", 1)
+    assert tracker.confirmed("wind", "0:a", 1, ours=False)
+    # only our own confirmations are timed
+    assert confirmation_seconds.count(action="wind") == observed + 1
+
+
+def test_alarms_are_counted_per_oracle():
+    alarms_total.inc(2, oracle="0:a", stage="test")
+    alarms_total.inc(oracle="0:b", stage="test")
+    assert alarms_total.get(oracle="0:a", stage="test") == 2
+    assert 'alarms_total{oracle="0:b",stage="test"} 1' in alarms_total.render()
@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+import rate_limiter as rate_limiter_module
+from rate_limiter import MIN_RATE, RateLimiter, request_lane
+
+
+class Throttled(Exception):
+    code = 429
+
+
+def test_free_tokens_are_taken_right_away():
+    async def main():
+        limiter = RateLimiter(qps=5)
+        for _ in range(5):
+            await asyncio.wait_for(limiter.acquire(), timeout=0.01)
+
+    asyncio.run(main())
+
+
+def test_most_urgent_lane_goes_first():
+    async def main():
+        limiter = RateLimiter(qps=50)
+        limiter._tokens = 0.0
+        order = []
+
+        async def request(lane: str):
+            with request_lane(lane):
+                await limiter.acquire()
+            order.append(lane)
+
+        tasks = []
+        for lane in ("background", "ring", "estimate", "wind", "background", "wind"):
+            tasks.append(asyncio.create_task(request(lane)))
+            # queue them in this order
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        return order
+
+    # all of them queued before the next token frees up
+    order = asyncio.run(main())
+    assert order == ["wind", "wind", "estimate", "ring", "background", "background"]
+
+
+def test_unknown_lane():
+    with pytest.raises(AssertionError):
+        with request_lane("urgent"):
+            pass
+
+
+def test_429_halves_the_rate(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rate_limiter_module.time, "monotonic", lambda: now[0])
+
+    async def main():
+        limiter = RateLimiter(qps=8)
+        with pytest.raises(Throttled):
+            async with limiter:
+                raise Throttled()
+        assert limiter.rate == 4
+        assert limiter._tokens == 0
+        assert limiter._take_local() == pytest.approx(1 / 4)
+
+        limiter.throttled()
+        limiter.throttled()
+        limiter.throttled()
+        limiter.throttled()
+        assert limiter.rate == MIN_RATE
+
+        # and grows back to qps
+        now[0] += 10
+        limiter._refill()
+        assert limiter.rate == pytest.approx(MIN_RATE + 10 * rate_limiter_module.RATE_RECOVERY_PER_SECOND)
+        now[0] += 1000
+        limiter._refill()
+        assert limiter.rate == 8
+
+    asyncio.run(main())
+
+
+def test_other_errors_keep_the_rate():
+    async def main():
+        limiter = RateLimiter(qps=8)
+        with pytest.raises(ValueError):
+            async with limiter:
+                raise ValueError()
+        assert limiter.rate == 8
+
+    asyncio.run(main())
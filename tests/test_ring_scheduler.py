@@ -0,0 +1,104 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import ring_scheduler as ring_scheduler_module
+from mariadb_connector import Alarm
+from ring_scheduler import RING_DELAY, RING_MAX_ATTEMPTS, RingScheduler
+
+
+class FakeClient:
+    def __init__(self, inactive=()):
+        self.inactive = set(inactive)
+        self.oracle = SimpleNamespace(to_string=lambda *args: "oracle")
+
+    async def get_alarm_address(self, alarm_id):
+        return alarm_id
+
+    async def get_address_state(self, alarm_address):
+        return "uninitialized" if alarm_address in self.inactive else "active"
+
+
+class FakeSender:
+    def __init__(self, errors=0):
+        self.sent = []
+        self.errors = errors
+
+    async def send(self, messages, lane="wind"):
+        if self.errors:
+            self.errors -= 1
+            raise ConnectionError()
+        self.sent.append((len(messages), lane))
+        return len(self.sent)
+
+
+def test_alarm_is_due_after_ring_delay():
+    scheduler = RingScheduler(FakeClient(), FakeSender())
+    scheduler.schedule_alarm(Alarm(1, created_at=1000, is_mine=True))
+    assert scheduler._pop_due(1000 + RING_DELAY - 1) == []
+    assert scheduler._pop_due(1000 + RING_DELAY) == [1]
+    # in flight, not scheduled again until the ring is done
+    scheduler.schedule(1, 0)
+    assert scheduler._pop_due(float("inf")) == []
+
+
+def test_deviating_alarm_is_rung_sooner():
+    scheduler = RingScheduler(FakeClient(), FakeSender())
+    scheduler.schedule_alarm(Alarm(1, created_at=1000, is_mine=True))
+    scheduler.schedule(1, 1010)
+    # a later time does not postpone it
+    scheduler.schedule(1, 1020)
+    assert scheduler._pop_due(1010) == [1]
+
+
+def test_closed_alarm_is_cancelled():
+    scheduler = RingScheduler(FakeClient(), FakeSender())
+    scheduler.schedule(1, 0)
+    scheduler.on_alarm_change(Alarm(1, state="uninitialized"))
+    assert scheduler._pop_due(float("inf")) == []
+
+
+def test_ring_sends_one_request_per_alarm():
+    sender = FakeSender()
+    scheduler = RingScheduler(FakeClient(inactive={2}), sender)
+    scheduler.schedule(1, 0)
+    scheduler.schedule(2, 0)
+    scheduler.schedule(3, 0)
+    asyncio.run(scheduler.ring(scheduler._pop_due(0)))
+
+    assert sender.sent == [(1, "ring"), (1, "ring")]
+    # rung alarms wait for their ring event, the inactive one is dropped
+    assert sorted(scheduler._due_at) == [1, 3]
+    assert scheduler._due_at[1] >= time.time() + ring_scheduler_module.RING_RETRY_INTERVAL - 1
+    scheduler.schedule(1, 0)
+    assert scheduler._pop_due(time.time()) == []
+
+
+def test_ring_is_given_up_after_max_attempts():
+    scheduler = RingScheduler(FakeClient(), FakeSender(errors=RING_MAX_ATTEMPTS))
+    scheduler.schedule(1, 0)
+    for _ in range(RING_MAX_ATTEMPTS):
+        due = scheduler._pop_due(float("inf"))
+        assert due == [1]
+        asyncio.run(scheduler.ring(due))
+    assert scheduler._pop_due(float("inf")) == []
+    assert scheduler._attempts == {}
+
+
+def test_run_rings_due_alarms():
+    sender = FakeSender()
+    scheduler = RingScheduler(FakeClient(), sender)
+
+    async def main():
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(0)
+        # wakes the scheduler up
+        scheduler.schedule(1, 0)
+        for _ in range(100):
+            if sender.sent:
+                break
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+    asyncio.run(main())
+    assert sender.sent == [(1, "ring")]
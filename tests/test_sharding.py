@@ -0,0 +1,99 @@
+import asyncio
+
+from alarm_store import AlarmStore
+from mariadb_connector import Alarm
+from sharding import AlarmLeases
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    def set(self, key, value, nx=False, px=None):
+        self.commands.append((key, value))
+
+    async def execute(self):
+        if self.redis.down:
+            raise ConnectionError("redis is down")
+        results = []
+        for key, value in self.commands:
+            granted = key not in self.redis.keys
+            if granted:
+                self.redis.keys[key] = value
+            results.append(granted)
+        return results
+
+
+class FakeRedis:
+    def __init__(self):
+        self.keys = {}
+        self.down = False
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def register_script(self, script):
+        async def release(keys, args):
+            # RELEASE_SCRIPT: only the owner's lease is deleted
+            if self.keys.get(keys[0]) == args[0]:
+                del self.keys[keys[0]]
+
+        return release
+
+
+def test_without_redis_every_lease_is_granted():
+    leases = AlarmLeases()
+    assert asyncio.run(leases.acquire([1, 2])) == {1, 2}
+
+
+def test_an_alarm_is_leased_to_one_worker():
+    redis = FakeRedis()
+    first = AlarmLeases(redis, owner="first")
+    second = AlarmLeases(redis, owner="second")
+
+    async def main():
+        assert await first.acquire([1, 2]) == {1, 2}
+        assert await second.acquire([2, 3]) == {3}
+        # a worker can only release its own leases
+        await second.release([1, 2, 3])
+        assert await second.acquire([1, 2]) == set()
+        await first.release([2])
+        assert await second.acquire([2]) == {2}
+
+    asyncio.run(main())
+
+
+def test_no_lease_while_redis_is_down():
+    redis = FakeRedis()
+    redis.down = True
+    assert asyncio.run(AlarmLeases(redis).acquire([1])) == set()
+
+
+def test_oracles_lease_separately():
+    redis = FakeRedis()
+    first = AlarmLeases(redis, prefix="ticton:lease:")
+    second = AlarmLeases(redis, prefix="ticton:lease:abcd1234:")
+
+    async def main():
+        return await first.acquire([1]), await second.acquire([1])
+
+    assert asyncio.run(main()) == ({1}, {1})
+
+
+def test_candidates_of_a_shard():
+    store = AlarmStore()
+    store.reset(
+        [Alarm(alarm_id, price=1.0) for alarm_id in range(10)]
+        + [Alarm(10, price=1.0, is_mine=True), Alarm(11, price=1.0, is_mine=True)]
+    )
+    candidates, deviating_alarm_ids = store.find_candidates(2.0, 0.5, shard=(1, 3))
+    assert sorted(alarm.id for alarm, _ in candidates) == [1, 4, 7]
+    # our own alarms are rung by every worker
+    assert sorted(deviating_alarm_ids) == [10, 11]
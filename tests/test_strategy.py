@@ -0,0 +1,85 @@
+import asyncio
+import random
+
+import pytest
+
+from strategy import Balance, ProfitableAlarm, get_strategy, greedy_strategy, knapsack_strategy
+
+
+def run_strategy(strategy, alarms, balance):
+    async def main():
+        return [alarm async for alarm in strategy(alarms, balance)]
+
+    return asyncio.run(main())
+
+
+def test_get_strategy():
+    assert get_strategy("greedy") is greedy_strategy
+    assert get_strategy("knapsack") is knapsack_strategy
+    with pytest.raises(AssertionError):
+        get_strategy("random")
+
+
+def test_knapsack_skips_what_does_not_fit():
+    # greedy stops at the most profitable alarm it cannot afford
+    alarms = [
+        ProfitableAlarm(1, 3.0, 100, 1000, 1),
+        ProfitableAlarm(2, 1.0, 10, 10, 1),
+    ]
+    assert run_strategy(greedy_strategy, alarms, Balance(50, 50)) == []
+    picked = run_strategy(knapsack_strategy, alarms, Balance(50, 50))
+    assert [(alarm.id, alarm.buy_num) for alarm in picked] == [(2, 1)]
+
+
+def test_knapsack_takes_partial_buy_num():
+    alarms = [ProfitableAlarm(1, 2.0, 30, 60, 5)]
+    balance = Balance(20, 1000)
+    picked = run_strategy(knapsack_strategy, alarms, balance)
+    assert [(alarm.id, alarm.buy_num) for alarm in picked] == [(1, 3)]
+    assert (picked[0].need_base_asset, picked[0].need_quote_asset) == (18, 36)
+    assert (balance.base_asset, balance.quote_asset) == (2, 964)
+
+
+def test_knapsack_balances_both_assets():
+    # the most profitable alarm uses up the quote asset, two cheaper ones
+    # earn more together
+    alarms = [
+        ProfitableAlarm(1, 5.0, 1, 100, 1),
+        ProfitableAlarm(2, 3.0, 1, 50, 1),
+        ProfitableAlarm(3, 3.0, 1, 50, 1),
+    ]
+    picked = run_strategy(knapsack_strategy, alarms, Balance(10, 100))
+    assert sorted(alarm.id for alarm in picked) == [2, 3]
+
+
+def test_knapsack_ignores_unprofitable_alarms():
+    alarms = [ProfitableAlarm(1, 0.0, 1, 1, 1), ProfitableAlarm(2, 1.0, 1, 1, 0)]
+    assert run_strategy(knapsack_strategy, alarms, Balance(10, 10)) == []
+
+
+def test_knapsack_is_never_worse_than_greedy():
+    rng = random.Random(0)
+    for _ in range(200):
+        alarms = []
+        for alarm_id in range(rng.randint(1, 12)):
+            buy_num = rng.randint(1, 5)
+            alarms.append(
+                ProfitableAlarm(
+                    alarm_id,
+                    rng.uniform(0.1, 5.0),
+                    rng.randint(1, 20) * buy_num,
+                    rng.randint(1, 20) * buy_num,
+                    buy_num,
+                )
+            )
+        balance = (rng.randint(0, 100), rng.randint(0, 100))
+        greedy = run_strategy(greedy_strategy, alarms, Balance(*balance))
+        # without a time budget only the first pass, greedy's order, runs
+        knapsack = run_strategy(
+            lambda alarms, balance: knapsack_strategy(alarms, balance, time_budget=0),
+            alarms,
+            Balance(*balance),
+        )
+        assert sum(alarm.except_profit for alarm in knapsack) >= sum(
+            alarm.except_profit for alarm in greedy
+        ) - 1e-9
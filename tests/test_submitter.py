@@ -0,0 +1,185 @@
+import asyncio
+from decimal import Decimal
+from types import SimpleNamespace
+
+import pytest
+
+import submitter as submitter_module
+from balance_ledger import BASE_ASSET, BalanceLedger, quote_asset_key
+from mariadb_connector import Alarm
+from pytoncenter.address import Address as PyAddress
+from sharding import AlarmLeases
+from strategy import ProfitableAlarm
+from submitter import WalletSender, WindSubmitter
+
+ORACLE = PyAddress("EQCD39VS5jcptHL8vMjEXrzGaRcCVYto7HUn4bpAOg8xqB2N")
+QUOTE_ASSET = "EQCxE6mUtQJKFnGfaROTKOt1lZbDiiX1kCixRv7Nw2Id_sDs"
+
+
+class FakeSender:
+    def __init__(self, errors=()):
+        self.address = ORACLE
+        self.sent = []
+        self.errors = list(errors)
+
+    async def send(self, messages, lane="wind"):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append(len(messages))
+        return len(self.sent)
+
+
+def wind_submitter(monkeypatch, sender: FakeSender) -> WindSubmitter:
+    client = SimpleNamespace(
+        oracle=ORACLE, metadata=SimpleNamespace(quote_asset_address=QUOTE_ASSET)
+    )
+    ledger = BalanceLedger()
+    ledger._assets[BASE_ASSET] = Decimal(10**12)
+    ledger._assets[quote_asset_key(client)] = Decimal(10**12)
+    monkeypatch.setattr(submitter_module, "balance_ledger", ledger)
+    submitter = WindSubmitter(client, sender, AlarmLeases())
+    submitter.jetton_wallet_address = QUOTE_ASSET
+    monkeypatch.setattr(submitter, "build_wind_body", lambda alarm, new_price_raw: None)
+    return submitter
+
+
+def winds(*alarm_ids: int):
+    return [ProfitableAlarm(alarm_id, 1.0, 10, 10, 1) for alarm_id in alarm_ids]
+
+
+def test_sent_winds_are_in_flight_until_their_event(monkeypatch):
+    submitter = wind_submitter(monkeypatch, FakeSender())
+    results = asyncio.run(submitter.submit(winds(1, 2), 0))
+    assert [result.error for result in results] == [None, None]
+    assert submitter.in_flight() == {1, 2}
+
+    # the wind event of alarm 1 reaches the alarm store
+    submitter.on_alarm_change(Alarm(1, remain_scale=0))
+    assert submitter.in_flight() == {2}
+
+
+def test_failed_winds_are_not_in_flight(monkeypatch):
+    submitter = wind_submitter(monkeypatch, FakeSender([ConnectionError()]))
+    results = asyncio.run(submitter.submit(winds(1), 0))
+    assert isinstance(results[0].error, ConnectionError)
+    assert submitter.in_flight() == set()
+
+
+def test_in_flight_expires(monkeypatch):
+    submitter = wind_submitter(monkeypatch, FakeSender())
+    now = [1000.0]
+    monkeypatch.setattr(submitter_module.time, "monotonic", lambda: now[0])
+    asyncio.run(submitter.submit(winds(1), 0))
+    now[0] += submitter_module.WIND_IN_FLIGHT_TIMEOUT
+    assert submitter.in_flight() == {1}
+    now[0] += 1
+    assert submitter.in_flight() == set()
+
+
+class FakeToncenter:
+    """A wallet whose seqno moves on once a message with it was accepted."""
+
+    def __init__(self, seqno: int = 5, lands: bool = True):
+        self.seqno = seqno
+        self.lands = lands
+        self.sent = []
+        # errors to raise on the next send_message calls
+        self.errors = []
+        self.moved_on_error = False
+
+    async def get_wallet(self, request):
+        return SimpleNamespace(seqno=self.seqno)
+
+    async def send_message(self, message):
+        if self.errors:
+            if self.moved_on_error:
+                self.seqno += 1
+            raise self.errors.pop(0)
+        self.sent.append(message.boc)
+        if self.lands:
+            self.seqno += 1
+
+
+def wallet_sender(monkeypatch, toncenter: FakeToncenter) -> WalletSender:
+    monkeypatch.setattr(submitter_module, "SEQNO_POLL_INTERVAL", 0)
+    monkeypatch.setattr(submitter_module, "GetWalletRequest", lambda address: None)
+    wallet = SimpleNamespace(address=SimpleNamespace(to_string=lambda *args: ORACLE.to_string()))
+    client = SimpleNamespace(
+        assert_wallet_exists=lambda: None, toncenter=toncenter, wallet=wallet
+    )
+    sender = WalletSender(client)
+    # the boc names the seqno and the messages it carries
+    sender.sign = lambda messages, seqno: f"{seqno}:{','.join(body for _, _, body in messages)}"
+    return sender
+
+
+def message(name: str):
+    return ("destination", 1, name)
+
+
+def test_sends_wait_for_the_previous_seqno(monkeypatch):
+    toncenter = FakeToncenter()
+    sender = wallet_sender(monkeypatch, toncenter)
+
+    async def main():
+        first = await sender.send([message("a")])
+        second = await sender.send([message("b")])
+        return first, second
+
+    assert asyncio.run(main()) == (5, 6)
+    assert toncenter.sent == ["5:a", "6:b"]
+
+
+def test_queued_requests_are_packed_by_lane(monkeypatch):
+    toncenter = FakeToncenter()
+    sender = wallet_sender(monkeypatch, toncenter)
+
+    async def main():
+        return await asyncio.gather(
+            sender.send([message("ring1")], "ring"),
+            sender.send([message("a1"), message("a2")], "wind"),
+            sender.send([message("b1"), message("b2"), message("b3")], "wind"),
+            sender.send([message("ring2")], "ring"),
+        )
+
+    seqnos = asyncio.run(main())
+    # winds first, rings fill the room they leave
+    assert toncenter.sent == ["5:a1,a2,ring1,ring2", "6:b1,b2,b3"]
+    assert seqnos == [5, 5, 6, 5]
+
+
+def test_failed_send_is_retried_with_the_same_seqno(monkeypatch):
+    toncenter = FakeToncenter()
+    toncenter.errors = [ConnectionError(), ConnectionError()]
+    sender = wallet_sender(monkeypatch, toncenter)
+
+    assert asyncio.run(sender.send([message("a")])) == 5
+    assert toncenter.sent == ["5:a"]
+    assert sender.seqno == 6
+
+
+def test_send_is_given_up_once_the_chain_moved_past_it(monkeypatch):
+    toncenter = FakeToncenter()
+    # the message may have landed after all
+    toncenter.errors = [ConnectionError()]
+    toncenter.moved_on_error = True
+    sender = wallet_sender(monkeypatch, toncenter)
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(sender.send([message("a")]))
+    assert toncenter.sent == []
+    assert sender.seqno == 6
+
+
+def test_seqno_that_never_landed_is_used_again(monkeypatch):
+    monkeypatch.setattr(submitter_module, "SEQNO_TIMEOUT", 0)
+    toncenter = FakeToncenter(lands=False)
+    sender = wallet_sender(monkeypatch, toncenter)
+
+    async def main():
+        first = await sender.send([message("a")])
+        second = await sender.send([message("b")])
+        return first, second
+
+    assert asyncio.run(main()) == (5, 5)
+    assert toncenter.sent == ["5:a", "5:b"]
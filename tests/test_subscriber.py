@@ -0,0 +1,154 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import subscriber
+from events import Signal
+from mariadb_connector import Alarm
+from subscriber import EventWriter
+
+
+class FakeStore:
+    def __init__(self):
+        self.applied = []
+
+    def apply(self, alarms):
+        self.applied.extend(alarms)
+
+    def get(self, alarm_id):
+        return None
+
+
+def fake_oracle():
+    return SimpleNamespace(
+        store=FakeStore(), first=False, tables="tables", ready=Signal(), raw_address="0:oracle"
+    )
+
+
+def writer(write_db: bool = True) -> EventWriter:
+    return EventWriter(fake_oracle(), write_db)
+
+
+def record_writes(monkeypatch, results):
+    writes = []
+
+    async def update_alarm_to_db(alarms, last_lt, tables):
+        writes.append(
+            ({alarm.id: (alarm.state, alarm.remain_scale, alarm.price) for alarm in alarms}, last_lt)
+        )
+        return results.pop(0) if results else True
+
+    monkeypatch.setattr(subscriber, "update_alarm_to_db", update_alarm_to_db)
+    return writes
+
+
+def test_events_are_merged_per_alarm(monkeypatch):
+    writes = record_writes(monkeypatch, [])
+
+    async def main():
+        events = writer()
+        await events.add([Alarm(1, price=2.0, remain_scale=3)], lt=10)
+        await events.add([Alarm(2, price=3.0, remain_scale=1)], lt=11)
+        # a wind and then a ring on alarm 1, the price stays the one it was opened at
+        await events.add([Alarm(1, price=0, remain_scale=2)], lt=12)
+        await events.add([Alarm(1, price=0, state="uninitialized", remain_scale=0)], lt=13)
+        assert len(events.store.applied) == 4
+        assert writes == []
+        assert await events.flush()
+        assert events.pending == {} and events.first_pending_at is None
+        # nothing left to write
+        assert await events.flush()
+
+    asyncio.run(main())
+    assert writes == [({1: ("uninitialized", 0, 2.0), 2: ("active", 1, 3.0)}, 13)]
+
+
+def test_failed_flush_keeps_the_events(monkeypatch):
+    writes = record_writes(monkeypatch, [False])
+
+    async def main():
+        events = writer()
+        await events.add([Alarm(1, price=2.0, remain_scale=3)], lt=10)
+        assert not await events.flush()
+        assert events.first_pending_at is not None
+        await events.add([Alarm(1, price=0, remain_scale=2), Alarm(2, price=3.0)], lt=11)
+        assert await events.flush()
+
+    asyncio.run(main())
+    assert writes == [
+        ({1: ("active", 3, 2.0)}, 10),
+        ({1: ("active", 2, 2.0), 2: ("active", 1, 3.0)}, 11),
+    ]
+
+
+def test_full_batch_is_flushed(monkeypatch):
+    writes = record_writes(monkeypatch, [])
+    monkeypatch.setattr(subscriber, "EVENT_BATCH_SIZE", 2)
+
+    async def main():
+        events = writer()
+        await events.add([Alarm(1, price=2.0)], lt=10)
+        await events.add([Alarm(1, price=0, remain_scale=0)], lt=11)
+        assert writes == []
+        await events.add([Alarm(2, price=3.0)], lt=12)
+
+    asyncio.run(main())
+    assert writes == [({1: ("active", 0, 2.0), 2: ("active", 1, 3.0)}, 12)]
+
+
+def test_writer_without_db_only_feeds_the_store(monkeypatch):
+    writes = record_writes(monkeypatch, [])
+
+    async def main():
+        events = writer(write_db=False)
+        await events.add([Alarm(1, price=2.0)], lt=10)
+        assert await events.flush()
+        return events
+
+    events = asyncio.run(main())
+    assert writes == []
+    assert [alarm.id for alarm in events.store.applied] == [1]
+    assert events.last_lt == 10
+
+
+class FailingClient:
+    """Delivers one ring event per subscription, then fails like toncenter."""
+
+    def __init__(self, events):
+        self.events = list(events)
+        self.start_lts = []
+
+    async def subscribe(self, on_tick_success, on_wind_success, on_ring_success, start_lt):
+        self.start_lts.append(start_lt)
+        if not self.events:
+            raise asyncio.CancelledError()
+        event = self.events.pop(0)
+        if event is not None:
+            await on_ring_success(
+                SimpleNamespace(alarm_id=event[0], tx=SimpleNamespace(lt=event[1]))
+            )
+        raise ConnectionError("429")
+
+
+def test_subscription_resumes_after_its_last_event(monkeypatch):
+    writes = record_writes(monkeypatch, [])
+
+    async def init(tables):
+        return True
+
+    async def backfill(client, my_address, tables):
+        return 100
+
+    monkeypatch.setattr(subscriber, "init", init)
+    monkeypatch.setattr(subscriber, "backfill", backfill)
+    monkeypatch.setattr(subscriber, "DB_WRITER", True)
+    monkeypatch.setattr(subscriber, "SUBSCRIBE_RETRY_INTERVAL", 0.001)
+    # fails without an event, then after the events at lt 120 and 130
+    client = FailingClient([None, (1, 120), None, (2, 130)])
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(subscriber.subscribe(client, fake_oracle()))
+
+    assert client.start_lts == [100, 100, 121, 121, 131]
+    # what was buffered is written when the subscriber stops
+    assert writes == [({1: ("uninitialized", 1, 0), 2: ("uninitialized", 1, 0)}, 130)]
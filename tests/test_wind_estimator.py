@@ -0,0 +1,85 @@
+from decimal import Decimal
+from types import SimpleNamespace
+
+from ticton.decoder import AlarmMetadata
+
+from wind_estimator import PRICE_SCALE, AlarmInfo, WindEstimator
+
+# TON/USDT: 9 base asset decimals, 6 quote asset decimals, one unit is 1 TON
+UNIT = 10**9
+WATCHMAKER = "EQCD39VS5jcptHL8vMjEXrzGaRcCVYto7HUn4bpAOg8xqB2N"
+
+
+def raw_price(price: str) -> int:
+    # what TicTonAsyncClient._convert_price stores on chain
+    return int(Decimal(price) * 10**6 / 10**9 * PRICE_SCALE)
+
+
+def alarm_info(price: str, base_scale: int = 5, quote_scale: int = 5, remain_scale: int = 5):
+    metadata = AlarmMetadata(
+        watchmaker_address=WATCHMAKER,
+        base_asset_scale=base_scale,
+        quote_asset_scale=quote_scale,
+        remain_scale=remain_scale,
+        base_asset_price=raw_price(price),
+        base_asset_amount=remain_scale * UNIT,
+        quote_asset_amount=0,
+        created_at=0,
+        alarm_index=1,
+    )
+    return AlarmInfo(None, metadata)
+
+
+def estimator() -> WindEstimator:
+    client = SimpleNamespace(metadata=SimpleNamespace(min_base_asset_threshold=UNIT))
+    return WindEstimator(client)
+
+
+def test_raw_prices():
+    # getAlarmMetadata of an alarm opened at 2.5 USDT/TON
+    assert raw_price("2.5") == 46116860184273879
+    assert raw_price("3") == 55340232221128654
+    assert raw_price("2") == 36893488147419103
+
+
+def test_estimate_price_up():
+    # getEstimate(1, 3 USDT) on an alarm at 2.5 USDT: 1 TON and
+    # 2 * 3 + 2.5 USDT, floored to whole quote units on chain
+    assert estimator().estimate(alarm_info("2.5"), raw_price("3"), 1) == (
+        True,
+        (Decimal(1_000_000_000), Decimal(8_499_999)),
+    )
+    assert estimator().estimate(alarm_info("2.5"), raw_price("3"), 2) == (
+        True,
+        (Decimal(2_000_000_000), Decimal(16_999_999)),
+    )
+
+
+def test_estimate_price_down():
+    # getEstimate(1, 2 USDT) on an alarm at 2.5 USDT: 3 TON and 2 * 2 - 2.5 USDT
+    assert estimator().estimate(alarm_info("2.5"), raw_price("2"), 1) == (
+        True,
+        (Decimal(3_000_000_000), Decimal(1_499_999)),
+    )
+
+
+def test_estimate_quote_asset_is_not_negative():
+    # the alarm pays out more quote asset than the new position needs
+    can_buy, (need_base_asset, need_quote_asset) = estimator().estimate(
+        alarm_info("2.5"), raw_price("1"), 1
+    )
+    assert can_buy
+    assert (need_base_asset, need_quote_asset) == (Decimal(3 * UNIT), Decimal(0))
+
+
+def test_estimate_can_buy():
+    info = alarm_info("2.5", base_scale=2, quote_scale=4, remain_scale=3)
+    wind = estimator()
+    # price up takes from the base asset scale, price down from the quote asset scale
+    assert wind.estimate(info, raw_price("3"), 2)[0]
+    assert not wind.estimate(info, raw_price("3"), 3)[0]
+    assert wind.max_buy_num(info, raw_price("3")) == 2
+    # both capped by the remaining scale
+    assert wind.estimate(info, raw_price("2"), 3)[0]
+    assert not wind.estimate(info, raw_price("2"), 4)[0]
+    assert wind.max_buy_num(info, raw_price("2")) == 4
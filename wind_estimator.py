@@ -0,0 +1,130 @@
+from decimal import Decimal
+from typing import Callable, Dict, List, Optional, Tuple
+
+from ticton import TicTonAsyncClient
+from ticton.decoder import AlarmMetadata
+from pytoncenter.address import Address as PyAddress
+
+from mariadb_connector import Alarm
+from metrics import estimate_seconds
+from rate_limiter import request_lane
+
+from log import get_logger, sampled
+
+logger = get_logger(__name__)
+
+# prices on chain are fixed point numbers with 64 fractional bits
+PRICE_SCALE = 2**64
+
+
+class AlarmInfo:
+    def __init__(self, address: PyAddress, metadata: AlarmMetadata):
+        self.address = address
+        self.metadata = metadata
+
+    def __repr__(self):
+        return f"AlarmInfo({self.address}, {self.metadata})"
+
+
+class WindEstimator:
+    """
+    Estimates the assets a wind needs without going to the chain.
+
+    The alarm address and metadata are fetched once per alarm and cached.
+    An entry is evicted whenever the alarm store applies a delta for that
+    alarm (a wind moves its scales, a ring closes it), so the next lookup
+    reads the new on-chain state. Listeners are called with every fetched
+    alarm info.
+    """
+
+    def __init__(self, client: TicTonAsyncClient):
+        self.client = client
+        self.cache: Dict[int, AlarmInfo] = {}
+        self._listeners: List[Callable[[int, AlarmInfo], None]] = []
+
+    def add_listener(self, listener: Callable[[int, AlarmInfo], None]):
+        self._listeners.append(listener)
+
+    def evict(self, alarm_id: int):
+        self.cache.pop(alarm_id, None)
+
+    def on_alarm_change(self, alarm: Alarm):
+        self.evict(alarm.id)
+
+    async def get_alarm_info(self, alarm_id: int) -> AlarmInfo:
+        alarm_info = self.cache.get(alarm_id)
+        if alarm_info is not None:
+            return alarm_info
+
+        with estimate_seconds.time(call="alarm_info"), request_lane("estimate"):
+            alarm_address = await self.client.get_alarm_address(alarm_id)
+            alarm_status = await self.client.get_address_state(alarm_address)
+            assert alarm_status == "active", "alarm is not active"
+            alarm_metadata = await self.client.get_alarm_metadata(alarm_address)
+
+        alarm_info = AlarmInfo(alarm_address, alarm_metadata)
+        self.cache[alarm_id] = alarm_info
+        for listener in self._listeners:
+            try:
+                listener(alarm_id, alarm_info)
+            except Exception as e:
+                logger.error("Error in alarm info listener %s", e, extra=sampled())
+        return alarm_info
+
+    async def convert_price(self, new_price: float) -> int:
+        """Converts a TON/USDT price to the on-chain fixed point format."""
+        new_price_ff = await self.client._convert_price(new_price)
+        return int(new_price_ff.raw_value)
+
+    def estimate(
+        self, alarm_info: AlarmInfo, new_price_raw: int, buy_num: int
+    ) -> Tuple[bool, Optional[Tuple[Decimal, Decimal]]]:
+        """
+        Mirrors the alarm's getEstimate get-method. The timekeeper takes
+        `buy_num` units out of the alarm at the old price and opens a new
+        position of twice that size at the new price:
+
+        - new price above the old one: buys base asset from the alarm, so it
+          brings 2 * buy_num - buy_num base units and pays the old price for
+          the bought units on top of the new position's quote asset.
+        - new price below the old one: sells base asset to the alarm, so it
+          brings 2 * buy_num + buy_num base units and the quote asset it gets
+          back offsets the new position's quote asset.
+        """
+        metadata = alarm_info.metadata
+        old_price_raw = metadata.base_asset_price
+        unit = self.client.metadata.min_base_asset_threshold
+
+        if new_price_raw > old_price_raw:
+            max_buy_num = metadata.base_asset_scale
+            need_base_asset = buy_num * unit
+            need_quote_asset = buy_num * unit * (2 * new_price_raw + old_price_raw)
+        else:
+            max_buy_num = metadata.quote_asset_scale
+            need_base_asset = 3 * buy_num * unit
+            need_quote_asset = buy_num * unit * (2 * new_price_raw - old_price_raw)
+
+        can_buy = buy_num <= min(max_buy_num, metadata.remain_scale)
+        need_quote_asset = max(need_quote_asset // PRICE_SCALE, 0)
+        return can_buy, (Decimal(need_base_asset), Decimal(need_quote_asset))
+
+    def max_buy_num(self, alarm_info: AlarmInfo, new_price_raw: int) -> int:
+        metadata = alarm_info.metadata
+        if new_price_raw > metadata.base_asset_price:
+            return metadata.base_asset_scale
+        return metadata.quote_asset_scale
+
+    async def confirm(
+        self, alarm_id: int, buy_num: int, new_price_raw: int
+    ) -> Tuple[bool, Tuple[Decimal, Decimal]]:
+        """Asks the alarm contract for the exact amounts of a chosen wind."""
+        alarm_info = await self.get_alarm_info(alarm_id)
+        with estimate_seconds.time(call="confirm"), request_lane("estimate"):
+            (
+                can_buy,
+                need_base_asset,
+                need_quote_asset,
+            ) = await self.client._estimate_from_oracle_get_method(
+                alarm_info.address.to_string(), buy_num, new_price_raw
+            )
+        return can_buy, (Decimal(need_base_asset), Decimal(need_quote_asset))